@@ -0,0 +1,172 @@
+# picks the batch size of a run for num_hits without a default one. The largest batch that fits in the memory budget
+# is worked out with estimate.py - D's step keeps G's forward pass (D's loss backpropagates through it), D's passes over
+# the real and fake batches and, with --gp, the penalty's forward pass and the graph of its gradients, and G's step keeps
+# G's and D's passes over the fake batch, each on top of the models' weights, gradients and optimizer state. Powers of
+# two up to that batch are then timed on a few training steps of randomly initialized models on random jets, and the one
+# training the most jets per second is used. The estimates are up to ~30% low for small models, so the memory the steps
+# actually take is measured too, and batches over the budget are dropped (or, if the smallest is, scaled down to fit).
+# The budget defaults to 80% of the memory available, on the GPU if used
+# python autotune.py <main.py args> e.g. python autotune.py --num-hits 50 --memory-budget 4
+
+import torch
+from model import Graph_GAN
+import estimate
+import profiling
+import distributed
+
+import io
+import os
+import time
+import contextlib
+from copy import deepcopy
+
+
+# larger batches only train faster on many-core machines, and the probe would take a while
+MAX_BATCH_SIZE = 1024
+MIN_BATCH_SIZE = 8
+# fraction of the available memory used when no budget is given, leaving some for the data loader and evaluation
+DEFAULT_BUDGET = 0.8
+# probing stops once a batch trains this much slower than the fastest so far, as larger ones will only be slower still
+SLOWDOWN = 0.9
+
+# values kept per parameter - the weights, gradients and the optimizer's state
+OPTIMIZER_STATE = {'adam': 2, 'rmsprop': 1, 'adadelta': 2}
+
+
+# bytes of memory to fit training into - by default the ranks of data parallel training on a host share its memory
+def memory_budget(args, device):
+    if args.memory_budget: return int(args.memory_budget * 2 ** 30)
+    if device.type == 'cuda': return int(DEFAULT_BUDGET * torch.cuda.mem_get_info(device)[0])
+
+    try:
+        with open("/proc/meminfo", "r") as f:
+            for line in f:
+                if line.startswith("MemAvailable"): return int(DEFAULT_BUDGET * int(line.split()[1]) * 1024) // distributed.local_world_size()
+    except OSError:
+        pass
+    return int(DEFAULT_BUDGET * os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_AVPHYS_PAGES')) // distributed.local_world_size()
+
+
+# estimated peak bytes of D's and G's training steps with the given batch size
+def step_memory(args, batch_size):
+    # activations are kept in bf16 with autocast
+    element_size = 2 if args.precision == 'bf16' else 4
+    G_cost = estimate.estimate(True, args, batch_size=batch_size, element_size=element_size)
+    D_cost = estimate.estimate(False, args, batch_size=batch_size, element_size=element_size)
+    G_temporary = max(stage['temporary'] + stage['recomputed'] for stage in G_cost['stages'].values())
+    D_temporary = max(stage['temporary'] + stage['recomputed'] for stage in D_cost['stages'].values())
+
+    weights = (2 + OPTIMIZER_STATE.get(args.optimizer, 2)) * (G_cost['parameters'] + D_cost['parameters']) * 4
+    # the penalty's double backward keeps about as much again as its forward pass
+    penalty = 2 * D_cost['saved'] if args.gp else 0
+
+    return {'D': weights + G_cost['saved'] + 2 * D_cost['saved'] + penalty + max(G_temporary, D_temporary),
+            'G': weights + G_cost['saved'] + D_cost['saved'] + max(G_temporary, D_temporary)}
+
+
+# the largest batch size (up to maximum) whose steps are estimated to fit in budget bytes, 0 if not even a batch of 1 does
+def largest_batch_size(args, budget, maximum=MAX_BATCH_SIZE):
+    def fits(batch_size):
+        return max(step_memory(args, batch_size).values()) <= budget
+
+    low, high = 0, 1
+    while high <= maximum and fits(high):
+        low, high = high, 2 * high
+    high = min(high, maximum + 1)
+    # low fits and high doesn't
+    while high - low > 1:
+        mid = (low + high) // 2
+        if fits(mid): low = mid
+        else: high = mid
+    return low
+
+
+def gradient_penalty(D, data, gen_data, labels):
+    alpha = torch.rand(data.size(0), 1, 1).to(data.device)
+    interpolated = (alpha * data + (1 - alpha) * gen_data).detach().requires_grad_(True)
+    gradients = torch.autograd.grad(D(interpolated, labels).sum(), interpolated, create_graph=True)[0]
+    return ((gradients.reshape(data.size(0), -1).norm(2, dim=1) - 1) ** 2).mean()
+
+
+# jets per second of D and G steps as in training, with a WGAN loss standing in for the configured one - the losses are
+# a negligible part of a step next to the models - and the peak bytes of memory training takes, None where it can't be
+# measured
+def throughput(args, device, batch_size, steps):
+    torch.manual_seed(4)
+    # the module lists printed by Graph_GAN would bury the results
+    with contextlib.redirect_stdout(io.StringIO()):
+        G = Graph_GAN(gen=True, args=deepcopy(args)).to(device).train()
+        D = Graph_GAN(gen=False, args=deepcopy(args)).to(device).train()
+    G.activation_checkpointing = D.activation_checkpointing = args.activation_checkpointing
+    G.precision = D.precision = args.precision
+    if(args.optimizer == 'rmsprop'):
+        G_optimizer = torch.optim.RMSprop(G.parameters(), lr=args.lr_gen)
+        D_optimizer = torch.optim.RMSprop(D.parameters(), lr=args.lr_disc)
+    elif(args.optimizer == 'adadelta'):
+        G_optimizer = torch.optim.Adadelta(G.parameters(), lr=args.lr_gen)
+        D_optimizer = torch.optim.Adadelta(D.parameters(), lr=args.lr_disc)
+    else:
+        G_optimizer = torch.optim.Adam(G.parameters(), lr=args.lr_gen, betas=(args.beta1, args.beta2))
+        D_optimizer = torch.optim.Adam(D.parameters(), lr=args.lr_disc, betas=(args.beta1, args.beta2))
+
+    noise_size = args.latent_node_size if args.latent_node_size else args.hidden_node_size
+    data = (torch.rand(batch_size, args.num_hits, args.node_feat_size) - 0.5).to(device)
+    labels = torch.rand(batch_size, args.clabels).to(device) if args.clabels else None
+
+    def step():
+        D_optimizer.zero_grad()
+        gen_data = G(torch.randn(batch_size, args.num_hits, noise_size).to(device), labels)
+        D_loss = D(gen_data, labels).mean() - D(data.clone(), labels).mean()
+        if args.gp: D_loss = D_loss + args.gp * gradient_penalty(D, data, gen_data, labels)
+        D_loss.backward()
+        D_optimizer.step()
+
+        G_optimizer.zero_grad()
+        G_loss = -D(G(torch.randn(batch_size, args.num_hits, noise_size).to(device), labels), labels).mean()
+        G_loss.backward()
+        G_optimizer.step()
+
+    # one untimed step, as the first allocates the optimizer state
+    peak = profiling.peak_memory(step, device)
+    if peak is not None: peak += sum(parameter.numel() * parameter.element_size() for parameter in list(G.parameters()) + list(D.parameters()))
+    if device.type == 'cuda': torch.cuda.synchronize(device)
+    start = time.perf_counter()
+    for i in range(steps): step()
+    if device.type == 'cuda': torch.cuda.synchronize(device)
+    return batch_size * steps / (time.perf_counter() - start), peak
+
+
+# the batch size training the most jets per second within the memory budget, with the jets per second of each batch
+# size probed
+def tune(args, device, verbose=True):
+    budget = memory_budget(args, device)
+    largest = largest_batch_size(args, budget)
+    if largest == 0: return 0, {}
+
+    rates = {}
+    size = min(MIN_BATCH_SIZE, largest)
+    while size:
+        rate, peak = throughput(args, device, size, args.autotune_steps)
+        if peak is not None and peak > budget:
+            if verbose: print("batch size %d: %.2f GB, over the budget" % (size, peak / 2 ** 30))
+            if len(rates): break
+            size = int(size * budget / peak)
+            continue
+
+        rates[size] = rate
+        if verbose: print("batch size %d: %.1f jets / s" % (size, rate))
+        if size == largest or rate < SLOWDOWN * max(rates.values()): break
+        size = min(2 * size, largest)
+
+    if verbose: print("estimated largest batch size within %.2f GB: %d" % (budget / 2 ** 30, largest))
+    return max(rates, key=rates.get) if len(rates) else 0, rates
+
+
+if __name__ == "__main__":
+    # main imports this module
+    import sys
+    from main import parse_args, device
+
+    args = parse_args(sys.argv[1:])
+    size, rates = tune(args, device)
+    print("batch size %d" % size if size else "not even a batch of 1 fits in the memory budget")
@@ -0,0 +1,430 @@
+# CPU micro-benchmarks of the jets models and evaluation
+# e.g. python benchmark.py models --grid-num-hits 30 100 -- --clabels 1
+# everything after -- is passed to main.parse_args to set the model config
+# --json saves the results, and --baseline compares them with saved ones, flagging (and exiting with an error on) regressions
+
+import torch
+import torch.nn.functional as F
+import torch.optim as optim
+from model import Graph_GAN
+from main import parse_args
+import profiling
+import utils
+import evaluation
+import save_outputs
+import estimate
+import threads
+from torch.distributions.normal import Normal
+
+import numpy as np
+import matplotlib.pyplot as plt
+
+import io
+import os
+import sys
+import json
+import time
+import argparse
+import itertools
+import tempfile
+import subprocess
+import contextlib
+from copy import deepcopy
+from os.path import dirname, realpath
+from collections import defaultdict
+
+
+def bench_args(argv):
+    args = parse_args(argv)
+    args.device = torch.device('cpu')
+    return args
+
+
+# setup, if given, runs untimed before every call
+def timeit(fn, iters, warmup, setup=None):
+    for i in range(warmup):
+        if setup is not None: setup()
+        fn()
+
+    times = []
+    for i in range(iters):
+        if setup is not None: setup()
+        start = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - start)
+
+    times.sort()
+    return {'median_ms': 1000 * times[len(times) // 2], 'min_ms': 1000 * times[0]}
+
+
+def random_data(args, batch_size):
+    return (torch.rand(batch_size, args.num_hits, args.node_feat_size) - 0.5).to(args.device)
+
+
+# G and D with inputs for each - noise or jets, and conditional labels if used
+def models_and_inputs(args):
+    torch.manual_seed(4)
+    # the module lists printed by Graph_GAN would bury the results
+    with contextlib.redirect_stdout(io.StringIO()):
+        G = Graph_GAN(gen=True, args=deepcopy(args)).to(args.device).train()
+        D = Graph_GAN(gen=False, args=deepcopy(args)).to(args.device).train()
+    G.activation_checkpointing = D.activation_checkpointing = args.activation_checkpointing
+    G.precision = D.precision = args.precision
+    noise = torch.randn(args.batch_size, args.num_hits, args.latent_node_size if args.latent_node_size else args.hidden_node_size).to(args.device)
+    labels = torch.rand(args.batch_size, args.clabels).to(args.device) if args.clabels else None
+    return [('G', G, noise, labels), ('D', D, random_data(args, args.batch_size), labels)]
+
+
+def bench_layers(args, opts):
+    """time, FLOPs and memory of each message passing stage of G and D in a forward + backward pass, from a
+    LayerProfiler, and the passes with and without it attached - unattached it should cost nothing"""
+    results = {}
+    profiler = profiling.LayerProfiler()
+    for model, M, x, labels in models_and_inputs(args):
+        def step():
+            M(x, labels).mean().backward()
+
+        results[model + ' forward + backward'] = timeit(step, opts.iters, opts.warmup)
+        profiler.attach(M)
+        step()
+        results[model + ' profiled'] = timeit(step, opts.iters, 0)
+        profiler.detach()
+
+    # the untimed step's records are of the warmup
+    print(profiler.summary())
+    return results
+
+
+def grid_argv(opts):
+    norms = {'none': [], 'spectral': ['--spectral-norm-gen', '--spectral-norm-disc'], 'batch': ['--batch-norm-gen', '--batch-norm-disc'], 'both': ['--spectral-norm-gen', '--spectral-norm-disc', '--batch-norm-gen', '--batch-norm-disc']}
+    for num_hits, batch_size, hidden_node_size, mp_iters, norm in itertools.product(opts.grid_num_hits, opts.grid_batch_size, opts.grid_hidden_node_size, opts.grid_mp_iters, opts.grid_norm):
+        name = "num hits %d batch %d hidden %d mp %d %s norm" % (num_hits, batch_size, hidden_node_size, mp_iters, norm)
+        yield name, ['--num-hits', str(num_hits), '--batch-size', str(batch_size), '--hidden-node-size', str(hidden_node_size), '--mp-iters', str(mp_iters)] + norms[norm]
+
+
+def bench_models(args, opts):
+    """forward and forward + backward time and peak memory of G and D over a grid of sizes and normalizations. Forward
+    passes record autograd graphs as in training"""
+    results = {}
+    for name, argv in grid_argv(opts):
+        args = bench_args(opts.model_argv + argv)
+        for model, M, x, labels in models_and_inputs(args):
+            passes = {'forward': lambda: M(x, labels), 'forward + backward': lambda: M(x, labels).mean().backward()}
+            for pass_name, fn in passes.items():
+                result = timeit(fn, opts.iters, opts.warmup)
+                peak = profiling.peak_memory(fn, args.device)
+                if peak is not None: result['peak_mb'] = peak / 2 ** 20
+                results[name + " " + model + " " + pass_name] = result
+                M.zero_grad()
+
+    return results
+
+
+def bench_estimate(args, opts):
+    """estimate.py's estimates over the models scenario's grid against built models - the parameter count, and the
+    FLOPs and activations kept of a forward pass counted by a LayerProfiler, and the peak memory of a forward + backward
+    pass - as ratios of estimated to measured, with the time the estimate takes"""
+    results = {}
+    for name, argv in grid_argv(opts):
+        args = bench_args(opts.model_argv + argv)
+        for model, M, x, labels in models_and_inputs(args):
+            result = timeit(lambda: estimate.estimate(model == 'G', args), opts.iters, opts.warmup)
+            cost = estimate.estimate(model == 'G', args)
+            result['parameters_ratio'] = cost['parameters'] / sum(parameter.numel() for parameter in M.parameters() if parameter.requires_grad)
+
+            profiler = profiling.LayerProfiler()
+            profiler.attach(M)
+            M(x, labels)
+            profiler.detach()
+            result['flops_ratio'] = sum(stage['forward_flops'] for stage in cost['stages'].values()) / sum(record['flops'] for record in profiler.records.values())
+            # the profiler's saved tensor hooks take the place of activation checkpointing's, so it counts everything kept without it
+            result['saved_ratio'] = estimate.estimate(model == 'G', args, checkpointing='none')['saved'] / sum(record['saved'] for record in profiler.records.values())
+
+            peak = profiling.peak_memory(lambda: M(x, labels).mean().backward(), args.device)
+            if peak is not None: result['peak_ratio'] = cost['peak'] / peak
+            results[name + " " + model] = result
+
+    return results
+
+
+def bench_activation_checkpointing(args, opts):
+    """forward + backward time and peak memory of G and D over the models scenario's grid with each activation
+    checkpointing mode, with their ratios to those without checkpointing - the time recomputing activations costs for
+    the memory it saves"""
+    results = {}
+    for name, argv in grid_argv(opts):
+        baseline = {}
+        for mode in ['none', 'edges', 'iterations']:
+            args = bench_args(opts.model_argv + argv + ['--activation-checkpointing', mode])
+            for model, M, x, labels in models_and_inputs(args):
+                fn = lambda: M(x, labels).mean().backward()
+                result = timeit(fn, opts.iters, opts.warmup)
+                peak = profiling.peak_memory(fn, args.device)
+                if peak is not None: result['peak_mb'] = peak / 2 ** 20
+                M.zero_grad()
+
+                if mode == 'none': baseline[model] = result
+                else:
+                    result['time_ratio'] = result['median_ms'] / baseline[model]['median_ms']
+                    if peak is not None: result['peak_ratio'] = result['peak_mb'] / baseline[model]['peak_mb']
+                results[name + " " + model + " " + mode + " checkpointing"] = result
+
+    return results
+
+
+def bench_precision(args, opts):
+    """G and D training steps (least squares loss, RMSprop) in fp32 and with bf16 autocast over the models scenario's
+    grid, from the same initialization on the same random batches - the time per step, and as a stability check how far
+    the bf16 losses drift from the fp32 ones (the mean absolute difference relative to the mean fp32 loss) and whether
+    they all stayed finite"""
+    results = {}
+    for name, argv in grid_argv(opts):
+        baseline = {}
+        for precision in ['fp32', 'bf16']:
+            args = bench_args(opts.model_argv + argv + ['--precision', precision])
+            (g, G, noise, labels), (d, D, x, labels) = models_and_inputs(args)
+            G_optimizer = optim.RMSprop(G.parameters(), lr=args.lr_gen)
+            D_optimizer = optim.RMSprop(D.parameters(), lr=args.lr_disc)
+            ones = torch.ones(args.batch_size, 1).to(args.device)
+            zeros = torch.zeros(args.batch_size, 1).to(args.device)
+
+            torch.manual_seed(5)
+            batches = [(random_data(args, args.batch_size), torch.randn_like(noise)) for i in range(opts.precision_steps)]
+            losses = {'D': [], 'G': []}
+            times = []
+            for data, noise in batches:
+                start = time.perf_counter()
+                D_optimizer.zero_grad()
+                D_loss = F.mse_loss(D(data, labels), ones) + F.mse_loss(D(G(noise, labels).detach(), labels), zeros)
+                D_loss.backward()
+                D_optimizer.step()
+
+                G_optimizer.zero_grad()
+                G_loss = F.mse_loss(D(G(noise, labels), labels), ones)
+                G_loss.backward()
+                G_optimizer.step()
+                times.append(time.perf_counter() - start)
+
+                losses['D'].append(D_loss.item())
+                losses['G'].append(G_loss.item())
+
+            times.sort()
+            result = {'median_ms': 1000 * times[len(times) // 2], 'min_ms': 1000 * times[0]}
+            if precision == 'fp32': baseline = dict(losses, median_ms=result['median_ms'])
+            else:
+                result['time_ratio'] = result['median_ms'] / baseline['median_ms']
+                for key in ['D', 'G']:
+                    result[key + '_drift'] = np.mean(np.abs(np.array(losses[key]) - baseline[key])) / np.mean(np.abs(baseline[key]))
+                result['finite'] = float(np.isfinite(losses['D'] + losses['G']).all())
+            results[name + " " + precision] = result
+
+    return results
+
+
+# a G and D training step (least squares loss, RMSprop) on random data, as in the precision scenario
+def training_step_fn(args):
+    (g, G, noise, labels), (d, D, x, labels) = models_and_inputs(args)
+    G_optimizer = optim.RMSprop(G.parameters(), lr=args.lr_gen)
+    D_optimizer = optim.RMSprop(D.parameters(), lr=args.lr_disc)
+    ones = torch.ones(args.batch_size, 1).to(args.device)
+    zeros = torch.zeros(args.batch_size, 1).to(args.device)
+
+    def training_step():
+        D_optimizer.zero_grad()
+        F.mse_loss(D(x, labels), ones).backward()
+        F.mse_loss(D(G(noise, labels).detach(), labels), zeros).backward()
+        D_optimizer.step()
+
+        G_optimizer.zero_grad()
+        F.mse_loss(D(G(noise, labels), labels), ones).backward()
+        G_optimizer.step()
+
+    return training_step
+
+
+# times training steps of the config in argv in a new process, with its thread settings applied first
+training_steps = """
+import sys
+import json
+import threads
+from benchmark import bench_args, timeit, training_step_fn
+args = bench_args(sys.argv[1:])
+threads.apply(args)
+print(json.dumps(timeit(training_step_fn(args), {iters}, {warmup})))
+"""
+
+
+def bench_threads(args, opts):
+    """G and D training steps per second of the config with each thread setting (see threads.py) - intra-op threads
+    (by default powers of two up to the physical cores), inter-op threads and CPU affinities (by default none, cores and,
+    on more than one NUMA node, numa) - each timed in a new process, as torch's inter-op threads can only be set once and
+    its intra-op threads keep the cores they start on. The fastest setting is marked best"""
+    cpus = os.sched_getaffinity(0)
+    cores = len(threads.physical_cores(cpus))
+    intra_op = opts.threads_intra_op or sorted(set([2 ** i for i in range(cores.bit_length())] + [cores]))
+    affinities = opts.threads_affinity or ['none', 'cores'] + (['numa'] if len(threads.numa_nodes(cpus)) > 1 else [])
+
+    results = {}
+    for intra_op_threads, inter_op_threads, affinity in itertools.product(intra_op, opts.threads_inter_op, affinities):
+        argv = opts.model_argv + ['--intra-op-threads', str(intra_op_threads), '--inter-op-threads', str(inter_op_threads), '--cpu-affinity', affinity]
+        script = training_steps.replace("{iters}", str(opts.iters)).replace("{warmup}", str(opts.warmup))
+        out = subprocess.run([sys.executable, "-c", script] + argv, cwd=dirname(realpath(__file__)), check=True, capture_output=True).stdout
+        result = json.loads(out.decode().strip().split("\n")[-1])
+        result['steps_per_s'] = 1000 / result['median_ms']
+        results["intra %d inter %d %s" % (intra_op_threads, inter_op_threads, affinity)] = result
+
+    best = max(results, key=lambda key: results[key]['steps_per_s'])
+    results[best]['best'] = 1
+    return results
+
+
+# replaces each (object, attribute) function with one timing its calls as the stage, restoring them on exit
+@contextlib.contextmanager
+def staged(timer, patches):
+    def timed(fn, stage):
+        def call(*args, **kwargs):
+            with timer.phase(stage):
+                return fn(*args, **kwargs)
+        return call
+
+    originals = [(obj, attr, getattr(obj, attr)) for obj, attr, stage in patches]
+    for obj, attr, stage in patches:
+        setattr(obj, attr, timed(getattr(obj, attr), stage))
+    try:
+        yield
+    finally:
+        for obj, attr, fn in originals:
+            setattr(obj, attr, fn)
+
+
+# time of fn and of each of its stages per call, with the rest of its time as the remainder stage, and the peak memory
+# of its first call, which is untimed as it also loads what's only loaded once e.g. fonts
+def time_stages(fn, patches, remainder, iters, device):
+    timer = profiling.PhaseTimer()
+    with staged(timer, patches):
+        peak = profiling.peak_memory(fn, device)
+        timer.epoch_totals()
+
+        def run():
+            with timer.phase('total'):
+                fn()
+
+        result = timeit(run, iters, 0)
+        totals = timer.epoch_totals()
+
+    total = totals.pop('total')
+    for stage, seconds in totals.items():
+        result[stage + '_ms'] = 1000 * seconds / iters
+    result[remainder + '_ms'] = 1000 * (total - sum(totals.values())) / iters
+    if peak is not None: result['peak_mb'] = peak / 2 ** 20
+    return result
+
+
+def bench_evaluation(args, opts):
+    """calc_w1, calc_jsd and save_sample_outputs with a randomly initialised G and --eval-samples random jets, timed per
+    stage - generation, jet kinematics, W1, JSD, plotting and io (rendering and saving the figures) - with their peak
+    memory. Runs offline. The evaluation sizes are main's, e.g. -- --w1-num-samples 100 1000 --num-samples 1000"""
+    torch.manual_seed(4)
+    with contextlib.redirect_stdout(io.StringIO()):
+        G = Graph_GAN(gen=True, args=deepcopy(args)).to(args.device)
+    normal_dist = Normal(torch.tensor(0.).to(args.device), torch.tensor(args.sd).to(args.device))
+    X = random_data(args, opts.eval_samples)
+    # feature scales the dataset would set, here leaving the random jets' features as they are
+    args.maxepp = [1, 1, 1]
+    args.maxp = 1
+
+    results = {}
+    patches = [(utils, 'gen', 'generation'), (evaluation, 'jet_features', 'kinematics'), (evaluation, 'wasserstein_distance', 'w1'), (evaluation, 'jensenshannon', 'jsd')]
+    results['calc_w1'] = time_stages(lambda: evaluation.calc_w1(args, X, G, normal_dist, defaultdict(list)), patches, 'other', opts.eval_iters, args.device)
+    results['calc_jsd'] = time_stages(lambda: evaluation.calc_jsd(args, X, G, normal_dist), patches, 'other', opts.eval_iters, args.device)
+
+    with tempfile.TemporaryDirectory() as dir:
+        args.name = "bench"
+        args.figs_path = args.losses_path = dir + "/"
+        os.mkdir(dir + "/" + args.name)
+
+        # with w1 scores to plot from every save_epochs
+        epoch = 20 * args.save_epochs
+        losses = {key: np.random.rand(epoch).tolist() for key in ['D', 'Dr', 'Df', 'G', 'gp', 'fid']}
+        for num_samples in args.w1_num_samples:
+            losses['w1_' + str(num_samples) + 'm'] = np.random.rand(epoch // 5, 3).tolist()
+            losses['w1j_' + str(num_samples) + 'm'] = np.random.rand(epoch // 5, len(args.jet_features)).tolist()
+
+        patches = [(utils, 'gen', 'generation'), (evaluation, 'jet_features', 'kinematics'), (plt, 'savefig', 'io')]
+        results['save_sample_outputs'] = time_stages(lambda: save_outputs.save_sample_outputs(args, None, G, X[:args.num_samples], normal_dist, args.name, epoch, losses), patches, 'plotting', opts.eval_iters, args.device)
+
+    return results
+
+
+scenarios = {'layers': bench_layers, 'models': bench_models, 'evaluation': bench_evaluation, 'estimate': bench_estimate, 'activation-checkpointing': bench_activation_checkpointing, 'precision': bench_precision, 'threads': bench_threads}
+
+
+def print_results(name, results):
+    print(name)
+    for key in results:
+        extra = "".join("    %s %.4g" % (k, results[key][k]) for k in results[key] if k not in ['median_ms', 'min_ms'])
+        print("    %-20s median %8.2f ms    min %8.2f ms%s" % (key, results[key]['median_ms'], results[key]['min_ms'], extra))
+
+
+# measurements of results (dicts of scenario -> measurement -> values, as saved by --json) more than tolerance (a
+# fraction) slower or larger in peak memory than in the baseline. Measurements only in one of the two are skipped
+def regressions(results, baseline, tolerance):
+    found = []
+    for scenario in results:
+        for key in results[scenario]:
+            if key not in baseline.get(scenario, {}): continue
+            for value in ['median_ms', 'peak_mb']:
+                new, old = results[scenario][key].get(value), baseline[scenario][key].get(value)
+                if new is not None and old and new > old * (1 + tolerance):
+                    found.append((scenario, key, value, old, new))
+    return found
+
+
+if __name__ == "__main__":
+    argv = sys.argv[1:]
+    model_argv = argv[argv.index('--') + 1:] if '--' in argv else []
+    argv = argv[:argv.index('--')] if '--' in argv else argv
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("scenarios", type=str, nargs='*', default=list(scenarios.keys()), help="scenarios to run - options are " + ", ".join(scenarios.keys()))
+    parser.add_argument("--iters", type=int, default=10, help="timed iterations per measurement")
+    parser.add_argument("--warmup", type=int, default=2, help="untimed iterations before each measurement")
+    parser.add_argument("--threads", type=int, default=0, help="number of torch threads - 0 means torch default")
+    parser.add_argument("--grid-num-hits", type=int, nargs='+', default=[30, 75, 100, 150], help="numbers of hits in the models scenario's grid")
+    parser.add_argument("--grid-batch-size", type=int, nargs='+', default=[16], help="batch sizes in the models scenario's grid")
+    parser.add_argument("--grid-hidden-node-size", type=int, nargs='+', default=[32], help="hidden node sizes in the models scenario's grid")
+    parser.add_argument("--grid-mp-iters", type=int, nargs='+', default=[2], help="numbers of message passing iterations in the models scenario's grid")
+    parser.add_argument("--grid-norm", type=str, nargs='+', default=['none', 'spectral', 'batch'], choices=['none', 'spectral', 'batch', 'both'], help="normalizations of G and D in the models scenario's grid")
+    parser.add_argument("--precision-steps", type=int, default=20, help="training steps in each precision in the precision scenario")
+    parser.add_argument("--threads-intra-op", type=int, nargs='*', default=[], help="intra-op thread counts in the threads scenario - none means powers of two up to the physical cores")
+    parser.add_argument("--threads-inter-op", type=int, nargs='+', default=[0, 1], help="inter-op thread counts in the threads scenario - 0 is torch's default")
+    parser.add_argument("--threads-affinity", type=str, nargs='*', default=[], help="cpu affinities in the threads scenario - none means none, cores and numa if there's more than one NUMA node")
+    parser.add_argument("--eval-iters", type=int, default=3, help="timed calls of each entry point in the evaluation scenario")
+    parser.add_argument("--eval-samples", type=int, default=10000, help="number of random jets evaluated against in the evaluation scenario")
+    parser.add_argument("--json", type=str, default="", help="file to save the results to as JSON")
+    parser.add_argument("--baseline", type=str, default="", help="JSON results file of an earlier run to compare with")
+    parser.add_argument("--tolerance", type=float, default=0.1, help="fraction a measurement can be slower or larger than the baseline's before it's flagged")
+    opts = parser.parse_args(argv)
+    opts.model_argv = model_argv
+
+    if opts.threads: torch.set_num_threads(opts.threads)
+
+    all_results = {}
+    for scenario in opts.scenarios:
+        all_results[scenario] = scenarios[scenario](bench_args(model_argv), opts)
+        print_results(scenario, all_results[scenario])
+
+    if opts.json:
+        with open(opts.json, "w") as f:
+            json.dump(all_results, f, indent=2)
+
+    if opts.baseline:
+        with open(opts.baseline, "r") as f:
+            baseline = json.load(f)
+        found = regressions(all_results, baseline, opts.tolerance)
+        for scenario, key, value, old, new in found:
+            print("REGRESSION %s: %s %s %.4g -> %.4g (%+.1f%%)" % (scenario, key, value, old, new, 100 * (new / old - 1)))
+        if len(found):
+            print(str(len(found)) + " regressions against " + opts.baseline + " - exiting")
+            sys.exit(1)
+        print("no regressions against " + opts.baseline)
@@ -0,0 +1,391 @@
+# checkpoints of state_dicts, snapshotted to CPU memory and written from a background thread so training only
+# blocks for the copy. Tensors are content-addressed by the hash of their bytes, optionally in half precision and
+# compressed, and a tensor whose content is already stored isn't written again - each checkpoint appends only its new
+# tensors as one pack file in the objects directory. The checkpoint itself is then a small index file referencing
+# them, and manifest.json in the model directory records the epochs kept, the packs each references and any evaluation
+# metrics used for retention. Every file is written to a temporary file and atomically renamed into place.
+# Besides the checkpoints at the end of epochs, a single step checkpoint can be saved mid-epoch (replacing the previous
+# one) with the progress through the epoch - the sampler position, RNG states and partial loss sums - to resume from.
+# Each end of epoch checkpoint also exports G's weights (the averaged ones if an EMA is kept) on their own, see export.py
+
+import torch
+from torch.utils.data import Sampler, DataLoader
+from export import generator_name, save_generator
+from model import Graph_GAN
+
+import os
+import json
+import random
+import zlib
+import lzma
+import uuid
+import hashlib
+import queue
+import atexit
+import threading
+from os import listdir, mkdir, remove
+from os.path import exists
+from copy import deepcopy
+
+import numpy as np
+
+
+MANIFEST = "manifest.json"
+OBJECTS = "objects/"
+STEP = "step"
+
+# weights barely compress, so zlib uses its fastest level
+compressors = {'none': (lambda b: b, lambda b: b), 'zlib': (lambda b: zlib.compress(b, 1), zlib.decompress), 'lzma': (lzma.compress, lzma.decompress)}
+
+
+def checkpoint_name(epoch):
+    return "checkpoint_" + str(epoch) + ".pt"
+
+
+# copy of a nested state dict with every tensor copied to CPU memory, and numpy values (e.g. in the losses) converted
+def snapshot(obj):
+    if isinstance(obj, torch.Tensor):
+        return obj.detach().to('cpu', copy=True)
+    elif isinstance(obj, np.ndarray):
+        return torch.from_numpy(obj.copy())
+    elif isinstance(obj, np.generic):
+        return obj.item()
+    elif isinstance(obj, dict):
+        return {key: snapshot(val) for key, val in obj.items()}
+    elif isinstance(obj, (list, tuple)):
+        return type(obj)(snapshot(val) for val in obj)
+    return obj
+
+
+# the args needed to rebuild the models, leaving out anything that isn't a plain python value e.g. the device
+def args_dict(args):
+    return {key: val for key, val in vars(args).items() if isinstance(val, (bool, int, float, str, list, tuple, type(None)))}
+
+
+def atomic_write(path, write):
+    with open(path + ".tmp", "wb") as f:
+        write(f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(path + ".tmp", path)
+
+
+def read_manifest(path):
+    if not exists(path + MANIFEST): return None
+    with open(path + MANIFEST, "r") as f:
+        return json.load(f)
+
+
+# the epoch to resume from - the one in progress in the step checkpoint if there is one, as it's always the most recent
+def latest_epoch(path):
+    manifest = read_manifest(path)
+    if manifest is None: return None
+    return manifest['step']['epoch'] if manifest.get('step') is not None else manifest['latest']
+
+
+# name of the checkpoint to resume the epoch from, or None if there isn't one
+def find(path, epoch):
+    manifest = read_manifest(path)
+    if manifest is None: return None
+    elif manifest.get('step') is not None and manifest['step']['epoch'] == epoch: return STEP
+    elif epoch in manifest['epochs']: return epoch
+    return None
+
+
+def rng_state():
+    state = {'torch': torch.get_rng_state(), 'random': random.getstate()}
+    state['numpy'] = np.random.get_state(legacy=False)
+    state['numpy']['state']['key'] = torch.from_numpy(state['numpy']['state']['key'].astype(np.int64))
+    if torch.cuda.is_available(): state['cuda'] = torch.cuda.get_rng_state_all()
+    return state
+
+
+def set_rng_state(state):
+    torch.set_rng_state(state['torch'].cpu())
+    random.setstate(state['random'])
+    numpy_state = deepcopy(state['numpy'])
+    numpy_state['state']['key'] = numpy_state['state']['key'].cpu().numpy().astype(np.uint32)
+    np.random.set_state(numpy_state)
+    if 'cuda' in state and torch.cuda.is_available(): torch.cuda.set_rng_state_all([s.cpu() for s in state['cuda']])
+
+
+class ResumableSampler(Sampler):
+    # random order like shuffle=True, with its own generator so the order of a partly done epoch can be regenerated
+    # and the epoch restarted from any batch. With data parallel training (see distributed.py) every rank draws the same
+    # order and takes every num_replicas'th sample of it from the rank'th, the order padded with its first samples so
+    # that every rank has as many batches, as DistributedSampler does
+    def __init__(self, data_source, batch_size, num_replicas=1, rank=0):
+        self.data_source = data_source
+        self.batch_size = batch_size
+        self.num_replicas = num_replicas
+        self.rank = rank
+        self.generator = torch.Generator()
+        self.generator.manual_seed(int(torch.empty((), dtype=torch.int64).random_().item()))
+        self.epoch_state = self.generator.get_state()
+        self.start = 0
+
+    def __iter__(self):
+        self.epoch_state = self.generator.get_state()
+        order = torch.randperm(len(self.data_source), generator=self.generator).tolist()
+        order = (order + order[:len(self) * self.num_replicas - len(order)])[self.rank::self.num_replicas]
+        start, self.start = self.start, 0
+        yield from order[start:]
+
+    def __len__(self):
+        return -(-len(self.data_source) // self.num_replicas)
+
+    # state to resume after the given number of batches of the current epoch, or at the start of the next if 0
+    def state_dict(self, batches=0):
+        if batches == 0: return {'generator': self.generator.get_state(), 'start': 0}
+        return {'generator': self.epoch_state, 'start': batches * self.batch_size}
+
+    def load_state_dict(self, state):
+        self.generator.set_state(state['generator'].cpu())
+        self.start = state['start']
+
+
+# data loader in a random order which can be restarted from any batch, and its sampler, over the rank'th of
+# num_replicas shards of X
+def resumable_loader(X, batch_size, loader=DataLoader, num_replicas=1, rank=0, **kwargs):
+    sampler = ResumableSampler(X, batch_size, num_replicas, rank)
+    # the loader draws a seed for its workers every epoch - from its own generator so it doesn't use the global RNG restored on resume
+    return loader(X, sampler=sampler, batch_size=batch_size, generator=torch.Generator(), **kwargs), sampler
+
+
+def get_dtype(name):
+    return getattr(torch, name.split('.')[-1])
+
+
+# unique so a pack is never overwritten, even when an epoch is saved again after restarting from an earlier one
+def pack_name(epoch):
+    return "pack_" + str(epoch) + "_" + uuid.uuid4().hex[:8]
+
+
+# the tensor's bytes in the dtype it's stored in - only floating point tensors are converted
+def tensor_bytes(tensor, dtype):
+    stored = tensor.to(dtype) if tensor.is_floating_point() and dtype is not None else tensor
+    return stored, stored.contiguous().view(-1).view(torch.uint8).numpy().tobytes()
+
+
+# packs is a dict of open pack files, shared between the tensors loaded from one checkpoint
+def load_tensor(path, ref, packs, device):
+    if ref['pack'] not in packs: packs[ref['pack']] = open(path + OBJECTS + ref['pack'], "rb")
+    packs[ref['pack']].seek(ref['offset'])
+    data = compressors[ref['compression']][1](packs[ref['pack']].read(ref['size']))
+    tensor = torch.frombuffer(bytearray(data), dtype=torch.uint8) if len(data) else torch.empty(0, dtype=torch.uint8)
+    tensor = tensor.view(get_dtype(ref['stored_dtype'])).reshape(ref['shape'])
+    return tensor.to(device=device, dtype=get_dtype(ref['dtype']))
+
+
+def is_ref(obj):
+    return isinstance(obj, dict) and 'object' in obj and 'pack' in obj
+
+
+# applies fn to every tensor (or tensor reference) in a nested state dict
+def map_tensors(obj, fn, test=lambda obj: isinstance(obj, torch.Tensor)):
+    if test(obj):
+        return fn(obj)
+    elif isinstance(obj, dict):
+        return {key: map_tensors(val, fn, test) for key, val in obj.items()}
+    elif isinstance(obj, (list, tuple)):
+        return type(obj)(map_tensors(val, fn, test) for val in obj)
+    return obj
+
+
+# lowest scoring epoch by the metric out of those given, or None if none have been scored
+def best_epoch(manifest, epochs, metric):
+    scored = [epoch for epoch in epochs if metric in manifest['metrics'].get(str(epoch), {})]
+    return min(scored, key=lambda epoch: manifest['metrics'][str(epoch)][metric]) if len(scored) else None
+
+
+# epochs kept by the retention policy - the latest, the keep_last most recent (all if 0), every keep_every'th and the best by the metric
+def retained(manifest, keep_last, keep_every, best_metric=None):
+    epochs = manifest['epochs']
+    keep = set(epochs[-keep_last:] if keep_last else epochs)
+    keep.add(manifest['latest'])
+    if keep_every: keep |= {epoch for epoch in epochs if epoch % keep_every == 0}
+    if best_metric is not None and best_epoch(manifest, epochs, best_metric) is not None: keep.add(best_epoch(manifest, epochs, best_metric))
+    return keep
+
+
+class CheckpointWriter(object):
+    # checkpoints kept are recorded in the registry if one is given
+    def __init__(self, args, registry=None):
+        self.args = args
+        self.registry = registry
+        self.path = args.model_path + args.name + "/"
+        self.manifest = read_manifest(self.path) or {'latest': None, 'epochs': []}
+        self.manifest.setdefault('packs', {})
+        self.manifest.setdefault('metrics', {})
+        self.manifest.setdefault('best', None)
+        self.manifest.setdefault('step', None)
+        self.manifest_lock = threading.Lock()
+        if not exists(self.path + OBJECTS): mkdir(self.path + OBJECTS)
+
+        # where each stored tensor's bytes are, by their hash, for the kept checkpoints
+        self.objects = {}
+        for name in self.manifest['epochs'] + ([STEP] if self.manifest.get('step') is not None else []):
+            if exists(self.path + checkpoint_name(name)):
+                index = torch.load(self.path + checkpoint_name(name), weights_only=True)
+                map_tensors(index, lambda ref: self.objects.setdefault(ref['object'], self.location(ref)), test=is_ref)
+
+        self.dtype = get_dtype(args.ckpt_dtype) if args.ckpt_dtype != 'float32' else None
+        self.compression = args.ckpt_compression
+        # lower is better for every metric we pick the best checkpoint by - the manifest's 'best' points to it whenever
+        # the metric is calculated, and it's only kept regardless of the retention policy if ckpt keep best
+        self.best_metric = args.best_metric if (args.w1 if args.best_metric == 'w1' else args.fid) else None
+        # at most one checkpoint waiting behind the one being written, so save() only blocks if writes fall that far behind
+        self.queue = queue.Queue(maxsize=1)
+        self.error = None
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+        atexit.register(self.wait)
+
+    # optimizer states are always stored at full precision, only model weights are stored in the checkpoint dtype.
+    # progress, if given, is saved with the checkpoint as is (see main) - for a step checkpoint it must have the
+    # epoch in progress and number of batches done as 'epoch' and 'batch'
+    def save(self, epoch, D, G, optimizers, G_ema=None, progress=None):
+        self.check()
+        state = {'epoch': epoch, 'args': args_dict(self.args), 'D': D.state_dict(), 'G': G.state_dict(),
+                 'D_optim': optimizers[0].state_dict(), 'G_optim': optimizers[1].state_dict()}
+        if G_ema is not None: state['G_ema'] = G_ema.state_dict()
+        if progress is not None: state['progress'] = progress
+
+        self.queue.put((epoch, snapshot(state)))
+
+    def save_step(self, D, G, optimizers, G_ema, progress):
+        self.save(STEP, D, G, optimizers, G_ema=G_ema, progress=progress)
+
+    def run(self):
+        while True:
+            epoch, state = self.queue.get()
+            try:
+                self.write(epoch, state)
+            except Exception as e:
+                self.error = e
+            finally:
+                self.queue.task_done()
+
+    def location(self, ref):
+        return {key: ref[key] for key in ['object', 'pack', 'offset', 'size', 'compression']}
+
+    def write(self, epoch, state):
+        pack = pack_name(epoch)
+        new = []
+        offset = 0
+        packs = set()
+
+        # reference to the tensor's content, added to this checkpoint's pack if it isn't stored yet
+        def store(tensor, dtype):
+            nonlocal offset
+            stored, data = tensor_bytes(tensor, dtype)
+            key = hashlib.sha256(data).hexdigest()
+            if key not in self.objects:
+                data = compressors[self.compression][0](data)
+                self.objects[key] = {'object': key, 'pack': pack, 'offset': offset, 'size': len(data), 'compression': self.compression}
+                new.append(data)
+                offset += len(data)
+
+            packs.add(self.objects[key]['pack'])
+            return dict(self.objects[key], dtype=str(tensor.dtype), stored_dtype=str(stored.dtype), shape=list(tensor.shape))
+
+        index = {}
+        for key, val in state.items():
+            dtype = self.dtype if key in ['D', 'G', 'G_ema'] else None
+            index[key] = map_tensors(val, lambda tensor: store(tensor, dtype))
+
+        if len(new): atomic_write(self.path + OBJECTS + pack, lambda f: f.writelines(new))
+        atomic_write(self.path + checkpoint_name(epoch), lambda f: torch.save(index, f))
+        if epoch != STEP:
+            save_generator(self.path + generator_name(epoch), dict(state['G'], **state['G_ema']['shadow']) if 'G_ema' in state else state['G'], state['args'])
+
+        with self.manifest_lock:
+            self.manifest['packs'][str(epoch)] = sorted(packs)
+            if epoch == STEP:
+                self.manifest['step'] = {'epoch': state['progress']['epoch'], 'batch': state['progress']['batch']}
+            else:
+                self.manifest['epochs'] = sorted(set(self.manifest['epochs'] + [epoch]))
+                self.manifest['latest'] = epoch
+                # an end of epoch checkpoint is always newer than the step checkpoint
+                self.manifest['step'] = None
+                self.manifest['packs'].pop(STEP, None)
+                if exists(self.path + checkpoint_name(STEP)): remove(self.path + checkpoint_name(STEP))
+                dropped = self.prune()
+            self.write_manifest()
+            best = self.manifest.get('best') if self.best_metric is not None else None
+            best_value = self.manifest['metrics'][str(best)][self.best_metric] if best is not None else None
+
+        if self.registry is not None and epoch != STEP:
+            self.registry.add_checkpoint(self.args.name, epoch, self.path + checkpoint_name(epoch))
+            self.registry.remove_checkpoints(self.args.name, dropped)
+            if best is not None: self.registry.set_best_checkpoint(self.args.name, self.best_metric, best, best_value, self.path + checkpoint_name(best))
+
+        self.collect_garbage()
+
+    def write_manifest(self):
+        atomic_write(self.path + MANIFEST, lambda f: f.write(json.dumps(self.manifest, indent=4).encode()))
+
+    # records an evaluation metric of an epoch about to be saved, to be used by the retention policy
+    def record_metric(self, epoch, name, value):
+        with self.manifest_lock:
+            self.manifest['metrics'].setdefault(str(epoch), {})[name] = float(value)
+            self.write_manifest()
+
+    # drops the checkpoints outside the retention policy from the manifest, and their index and exported G files, returning their epochs
+    def prune(self):
+        keep = retained(self.manifest, self.args.ckpt_keep_last, self.args.ckpt_keep_every, self.best_metric if self.args.ckpt_keep_best else None)
+        if self.best_metric is not None: self.manifest['best'] = best_epoch(self.manifest, keep, self.best_metric)
+
+        for epoch in self.manifest['epochs']:
+            if epoch not in keep:
+                self.manifest['packs'].pop(str(epoch), None)
+                if exists(self.path + checkpoint_name(epoch)): remove(self.path + checkpoint_name(epoch))
+                for ext in [".json", ".bin"]:
+                    if exists(self.path + generator_name(epoch) + ext): remove(self.path + generator_name(epoch) + ext)
+
+        dropped = [epoch for epoch in self.manifest['epochs'] if epoch not in keep]
+        self.manifest['epochs'] = sorted(keep)
+        # the metrics of the epochs after the latest are of checkpoints still waiting to be written
+        self.manifest['metrics'] = {epoch: values for epoch, values in self.manifest['metrics'].items() if int(epoch) in keep or int(epoch) > self.manifest['latest']}
+        return dropped
+
+    # removes packs no longer referenced by any kept checkpoint - only called after the manifest is written. Weights change
+    # every step so a pack is normally dropped whole once its checkpoint is, but it's kept while any of its tensors is used
+    def collect_garbage(self):
+        with self.manifest_lock:
+            referenced = set().union(*self.manifest['packs'].values())
+        for pack in listdir(self.path + OBJECTS):
+            if pack not in referenced: remove(self.path + OBJECTS + pack)
+        self.objects = {key: location for key, location in self.objects.items() if location['pack'] in referenced}
+
+    # blocks until every queued checkpoint is on disk
+    def wait(self):
+        self.queue.join()
+        self.check()
+
+    def check(self):
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise RuntimeError("error writing checkpoint") from error
+
+
+# name is an epoch or STEP
+def load(path, name, device='cpu'):
+    index = torch.load(path + checkpoint_name(name), map_location=device, weights_only=True)
+    packs = {}
+    try:
+        return map_tensors(index, lambda ref: load_tensor(path, ref, packs, device), test=is_ref)
+    finally:
+        for f in packs.values(): f.close()
+
+
+def build_models(args):
+    return Graph_GAN(gen=True, args=deepcopy(args)), Graph_GAN(gen=False, args=deepcopy(args))
+
+
+# rebuilds G and D from args and restores their weights from the checkpoint
+def load_models(args, state):
+    G, D = build_models(args)
+    G.load_state_dict(state['G'])
+    D.load_state_dict(state['D'])
+    return G.to(args.device), D.to(args.device)
@@ -0,0 +1,63 @@
+import torch
+from contextlib import contextmanager, nullcontext
+
+
+class EMA(object):
+    # exponential moving average of a model's trainable parameters, kept as separate tensors and swapped into
+    # the model in place of its own parameters (by pointer, no copies) when evaluating
+    def __init__(self, model, decay=0.999):
+        self.decay = decay
+        self.names = [name for name, p in model.named_parameters() if p.requires_grad]
+        self.params = [p for p in model.parameters() if p.requires_grad]
+        self.shadow = [p.detach().clone() for p in self.params]
+        self.num_updates = 0
+        self.warmup = True
+        self.applied = False
+
+    @torch.no_grad()
+    def update(self):
+        assert not self.applied, "can't update the EMA while it is applied to the model"
+        self.num_updates += 1
+        # shorter averaging window early on so the average isn't dominated by the initial weights
+        decay = min(self.decay, (1 + self.num_updates) / (10 + self.num_updates)) if self.warmup else self.decay
+        torch._foreach_lerp_(self.shadow, self.params, 1 - decay)
+
+    def swap(self):
+        for i, p in enumerate(self.params):
+            data = p.data
+            p.data = self.shadow[i]
+            self.shadow[i] = data
+
+        self.applied = not self.applied
+
+    @contextmanager
+    def average_parameters(self):
+        self.swap()
+        try:
+            yield
+        finally:
+            self.swap()
+
+    # the averaged weights are keyed by parameter name so they can be loaded straight into a model with load_state_dict(..., strict=False)
+    def state_dict(self):
+        shadow = self.params if self.applied else self.shadow
+        return {'decay': self.decay, 'num_updates': self.num_updates, 'warmup': self.warmup, 'shadow': dict(zip(self.names, shadow))}
+
+    @torch.no_grad()
+    def load_state_dict(self, state_dict):
+        self.decay = state_dict['decay']
+        self.num_updates = state_dict['num_updates']
+        self.warmup = state_dict['warmup']
+        torch._foreach_copy_(self.shadow, [state_dict['shadow'][name].to(self.shadow[0].device) for name in self.names])
+
+    @torch.no_grad()
+    def load_model(self, model):
+        # initialise the average from a model holding averaged weights e.g. an exported G_ema checkpoint
+        torch._foreach_copy_(self.shadow, [p.data for p in model.parameters() if p.requires_grad])
+        # the checkpoint is past the warmup so only the full decay applies from here
+        self.warmup = False
+
+
+# context in which G evaluates with its averaged weights, or unchanged if there is no EMA
+def averaged(ema):
+    return ema.average_parameters() if ema is not None else nullcontext()
@@ -0,0 +1,150 @@
+# what a Graph_GAN config costs, worked out from the args alone without building the model - parameter count, forward
+# and backward FLOPs of each message passing stage (named as by profiling.LayerProfiler) and the activation memory kept
+# for the backward pass, for a batch of a given size. FLOPs are of the linear layers (2 * in features * out features per
+# row, and twice that backward), memory is of float32 activations as kept on CPU, where dropout keeps a float mask
+# (1 byte per value on GPU). The layer sizes follow Graph_GAN.__init__, and the benchmark's estimate scenario checks
+# the estimates against built models.
+# python estimate.py <main.py args> e.g. python estimate.py --num-hits 100 --batch-size 32
+
+import sys
+from collections import OrderedDict
+
+
+# (fe sizes, fn sizes, size of the node features going in) of each message passing iteration, and the fnd sizes (or
+# None) - the sizes include the input, as in the args lists Graph_GAN.__init__ builds
+def layer_sizes(gen, args):
+    mp_iters = args.mp_iters_gen if gen else args.mp_iters_disc
+    fe1 = args.fe1g if gen else args.fe1d
+
+    anc = 0
+    if args.pos_diffs:
+        if args.deltacoords:
+            if args.coords == 'cartesian':
+                anc += 3
+            elif args.coords == 'polar' or args.coords == 'polarrel':
+                anc += 2
+        if args.deltar:
+            anc += 1
+
+    if args.mask:
+        anc += 1
+
+    anc += int(args.int_diffs)
+    fe = [2 * args.hidden_node_size + anc + args.clabels_hidden_layers] + list(args.fe)
+    fn = [args.fe[-1] + args.hidden_node_size + args.clabels_hidden_layers] + list(args.fn) + [args.hidden_node_size]
+
+    if gen:
+        node_size = args.latent_node_size if args.latent_node_size else args.hidden_node_size
+    else:
+        node_size = args.node_feat_size
+
+    fe1 = [2 * node_size + anc + args.clabels_first_layer] + list(fe1 if fe1 else args.fe)
+    fn1 = [fe1[-1] + node_size + args.clabels_first_layer] + list(args.fn) + [args.hidden_node_size]
+
+    iterations = [(fe1, fn1, node_size)] + [(fe, fn, args.hidden_node_size)] * (mp_iters - 1)
+    fnd = [args.hidden_node_size] + list(args.fnd) + [1] if not gen and args.dea else None
+    return iterations, fnd
+
+
+def parameters(gen, args):
+    iterations, fnd = layer_sizes(gen, args)
+    batch_norm = args.batch_norm_gen if gen else args.batch_norm_disc
+    stacks = [fe for fe, fn, node_size in iterations] + [fn for fe, fn, node_size in iterations] + ([fnd] if fnd is not None else [])
+
+    count = 0
+    for sizes in stacks:
+        for j in range(len(sizes) - 1):
+            count += sizes[j] * sizes[j + 1] + sizes[j + 1]
+            # every layer has a batch norm, even the last of the fn and fnd stacks where it isn't used
+            if batch_norm: count += 2 * sizes[j + 1]
+    return count
+
+
+# forward FLOPs and values kept for backward of a stack of layers applied to rows rows, each layer but the last
+# (unless activate_last) followed by a leaky relu, batch norm and dropout. The linear layer keeps its input, the leaky
+# relu its input, batch norm its input and dropout (if p > 0) its mask
+def stack_cost(sizes, rows, batch_norm, dropout, activate_last=True):
+    flops, saved = 0, 0
+    for j in range(len(sizes) - 1):
+        flops += 2 * rows * sizes[j] * sizes[j + 1]
+        saved += rows * sizes[j]
+        if activate_last or j < len(sizes) - 2:
+            saved += rows * sizes[j + 1] * (1 + int(batch_norm))
+        if dropout: saved += rows * sizes[j + 1]
+    return flops, saved
+
+
+# estimated cost of a forward and backward pass of G (gen) or D over batch_size graphs of num_hits nodes, with each
+# stage's forward and backward FLOPs, bytes kept for the backward pass, bytes of its largest temporaries and bytes
+# recomputed by the backward pass with activation checkpointing (as Graph_GAN.activation_checkpointing, by default the
+# args'), and the peak - everything kept, plus the most memory any stage needs on top in the backward pass
+def estimate(gen, args, batch_size=None, num_hits=None, element_size=4, checkpointing=None):
+    batch_size = batch_size if batch_size is not None else args.batch_size
+    num_hits = num_hits if num_hits is not None else args.num_hits
+    checkpointing = checkpointing if checkpointing is not None else args.activation_checkpointing
+    batch_norm = args.batch_norm_gen if gen else args.batch_norm_disc
+    dropout = (args.gen_dropout if gen else args.disc_dropout) > 0
+    iterations, fnd = layer_sizes(gen, args)
+
+    edges = batch_size * num_hits * num_hits
+    nodes = batch_size * num_hits
+    stages = OrderedDict()
+
+    def add(name, flops, saved, temporary):
+        stages[name] = {'forward_flops': flops, 'backward_flops': 2 * flops, 'saved': saved * element_size, 'temporary': temporary * element_size, 'recomputed': 0}
+
+    for i, (fe, fn, node_size) in enumerate(iterations):
+        # the node features repeated for both ends of every edge, and the distances' norm keeps the coordinate
+        # differences and its output when the features need gradients, which the inputs to the model don't
+        norm = edges * ((3 if args.coords == 'cartesian' else 2) + 1) if args.pos_diffs and args.deltar and i else 0
+        add("mp%d getA" % i, 0, norm, 2 * edges * node_size)
+
+        flops, saved = stack_cost(fe, edges, batch_norm, dropout)
+        # in the backward pass the gradients of a layer's input, output and output before the activation are alive at once
+        add("mp%d fe" % i, flops, saved, max(edges * (fe[j] + 2 * fe[j + 1]) for j in range(len(fe) - 1)))
+
+        add("mp%d aggregate" % i, 0, 0, nodes * fe[-1])
+
+        flops, saved = stack_cost(fn, nodes, batch_norm, dropout, activate_last=False)
+        add("mp%d fn" % i, flops, saved, max(nodes * (fn[j] + 2 * fn[j + 1]) for j in range(len(fn) - 1)))
+
+    if fnd is not None:
+        flops, saved = stack_cost(fnd, batch_size, batch_norm, dropout, activate_last=False)
+        add("dea", flops, saved, max(batch_size * (fnd[j] + 2 * fnd[j + 1]) for j in range(len(fnd) - 1)))
+
+    # a checkpointed block of stages keeps only its input, and its forward pass runs again in the backward pass,
+    # re-creating what it would have kept while its gradients are computed
+    if checkpointing != 'none':
+        names = ['getA', 'fe', 'aggregate'] + (['fn'] if checkpointing == 'iterations' else [])
+        for i, (fe, fn, node_size) in enumerate(iterations):
+            block = [stages["mp%d %s" % (i, name)] for name in names]
+            recomputed = sum(stage['saved'] for stage in block)
+            for stage in block:
+                stage['backward_flops'] += stage['forward_flops']
+                stage['saved'] = 0
+                stage['recomputed'] = recomputed
+            block[0]['saved'] = nodes * node_size * element_size
+
+    saved = sum(stage['saved'] for stage in stages.values())
+    return {'parameters': parameters(gen, args), 'stages': stages, 'saved': saved, 'peak': saved + max(stage['temporary'] + stage['recomputed'] for stage in stages.values())}
+
+
+def summary(name, cost):
+    lines = [name + ": %d parameters" % cost['parameters'], "    %-16s %12s %12s %10s" % ("stage", "fwd GFLOPs", "bwd GFLOPs", "saved MB")]
+    for stage, values in cost['stages'].items():
+        lines.append("    %-16s %12.3f %12.3f %10.2f" % (stage, values['forward_flops'] / 1e9, values['backward_flops'] / 1e9, values['saved'] / 2 ** 20))
+    forward = sum(values['forward_flops'] for values in cost['stages'].values())
+    backward = sum(values['backward_flops'] for values in cost['stages'].values())
+    lines.append("    %-16s %12.3f %12.3f %10.2f" % ("total", forward / 1e9, backward / 1e9, cost['saved'] / 2 ** 20))
+    lines.append("    peak activation memory %.2f MB" % (cost['peak'] / 2 ** 20))
+    return "\n".join(lines)
+
+
+if __name__ == "__main__":
+    # main imports this module through autotune
+    from main import parse_args
+
+    args = parse_args(sys.argv[1:])
+    print("batch size %d, %d hits" % (args.batch_size, args.num_hits))
+    print(summary("G", estimate(True, args)))
+    print(summary("D", estimate(False, args)))
@@ -143,6 +143,24 @@ def get_fid(args, C, G, dist, mu2, sigma2):
 rng = np.random.default_rng()
 
 
+# mass and pt of each jet, from its particles' (eta, phi, pt). With mask, particles with a mask feature (the fourth) <= 0
+# are left out
+def jet_features(jets, mask=False):
+    features = []
+    for jet in jets:
+        jetv = LorentzVector()
+
+        for part in jet:
+            if not mask or part[3] > 0:
+                vec = LorentzVector()
+                vec.setptetaphim(part[2], part[0], part[1], 0)
+                jetv += vec
+
+        features.append([jetv.mass, jetv.pt])
+
+    return np.array(features)
+
+
 # make sure to deepcopy G passing in
 def calc_jsd(args, X, G, dist):
     print("evaluating JSD")
@@ -200,32 +218,12 @@ def calc_w1(args, X, G, dist, losses, X_loaded=None):
             w1s.append(w1)
 
             if args.jf:
-                realj = []
-                genj = []
-
-                for i in range(args.w1_num_samples[k]):
-                    jetv = LorentzVector()
-
-                    for part in sample[i]:
-                        vec = LorentzVector()
-                        vec.setptetaphim(part[2], part[0], part[1], 0)
-                        jetv += vec
-
-                    realj.append([jetv.mass, jetv.pt])
-
-                for i in range(args.w1_num_samples[k]):
-                    jetv = LorentzVector()
-
-                    for part in gen_out[i]:
-                        vec = LorentzVector()
-                        vec.setptetaphim(part[2], part[0], part[1], 0)
-                        jetv += vec
-
-                    genj.append([jetv.mass, jetv.pt])
+                realj = jet_features(sample)
+                genj = jet_features(gen_out)
 
                 w1j = []
                 for i in range(len(args.jet_features)):
-                    w1j.append(wasserstein_distance(np.array(realj)[:, i], np.array(genj)[:, i]))
+                    w1j.append(wasserstein_distance(realj[:, i], genj[:, i]))
 
                 w1js.append(w1j)
 
@@ -2,18 +2,20 @@
 
 import torch
 from model import Graph_GAN
-import utils, save_outputs, evaluation, augment
+import utils, save_outputs, evaluation, augment, ema, checkpoint, metrics, registry, stopping, profiling, autotune, distributed, threads
 from jets_dataset import JetsDataset
-from torch.utils.data import DataLoader
 from torch.distributions.normal import Normal
+from torch.utils.data import DataLoader
 
 import torch.optim as optim
 from tqdm import tqdm
 
-from os import listdir, mkdir
+from os import listdir, mkdir, environ
 from os.path import exists, dirname, realpath
 
 import sys
+import time
+import signal
 import argparse
 from copy import deepcopy
 
@@ -23,7 +25,7 @@ import numpy as np
 device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
 
 
-def parse_args():
+def parse_args(argv=None):
     dir_path = dirname(realpath(__file__))
 
     parser = argparse.ArgumentParser()
@@ -50,7 +52,10 @@ def parse_args():
     utils.add_bool_arg(parser, "save-zero", "save the initial figure", default=False)
     parser.add_argument("--save-epochs", type=int, default=5, help="save outputs per how many epochs")
 
-    utils.add_bool_arg(parser, "debug", "debug mode", default=False)
+    parser.add_argument("--debug", type=int, nargs='?', const=1, default=0, help="debug level - 1 prints what's being trained and D's outputs, 2 also turns on autograd anomaly detection, which slows every backward")
+    parser.add_argument("--no-debug", dest="debug", action="store_const", const=0, help="don't debug - the same as --debug 0")
+    parser.add_argument("--profile-steps", type=int, default=0, help="number of training steps (batches) to trace with torch.profiler, saved as a chrome trace in the losses dir - 0 means none")
+    parser.add_argument("--profile-start", type=int, default=10, help="training step of this run the profiler trace starts from")
 
     parser.add_argument("--jets", type=str, default="g", help="jet type - options are g or t")
 
@@ -109,11 +114,23 @@ def parse_args():
     parser.add_argument("--lr-gen", type=float, default=1e-5, help="learning rate generator")
     parser.add_argument("--beta1", type=float, default=0.9, help="Adam optimizer beta1")
     parser.add_argument("--beta2", type=float, default=0.999, help="Adam optimizer beta2")
-    parser.add_argument("--batch-size", type=int, default=0, help="batch size")
+    parser.add_argument("--batch-size", type=int, default=0, help="batch size - 0 means 128 for 30 hits, 32 for 100 and otherwise picked by the autotuner")
+    utils.add_bool_arg(parser, "autotune-batch-size", "pick the batch size training the fastest within the memory budget, by timing a few training steps - on when there's no batch size for num hits", default=False)
+    parser.add_argument("--memory-budget", type=float, default=0, help="GB of memory the autotuned batch size has to fit training in - 0 means 80%% of the memory available")
+    parser.add_argument("--autotune-steps", type=int, default=3, help="number of training steps timed per batch size by the autotuner")
 
+    parser.add_argument("--accumulation-steps", type=int, default=1, help="number of micro-batches each batch is split into, accumulating their gradients for one optimizer step - batch norm statistics are of the micro-batches")
     parser.add_argument("--num-critic", type=int, default=1, help="number of critic updates for each generator update")
     parser.add_argument("--num-gen", type=int, default=1, help="number of generator updates for each critic update (num-critic must be 1 for this to apply)")
 
+    parser.add_argument("--activation-checkpointing", type=str, default="none", help="message passing activations to recompute in the backward pass instead of keeping, saving memory for time - options are none, edges (each iteration's edge network) or iterations (whole iterations)")
+    parser.add_argument("--precision", type=str, default="fp32", help="precision of G's and D's message passing - options are fp32 or bf16 (autocast, with the weights, losses, spectral norm and gradient penalty in fp32)")
+    parser.add_argument("--world-size", type=int, default=1, help="number of processes to spawn on this host for data parallel training, each with batches of batch size - not needed when started with torchrun, see distributed.py")
+    parser.add_argument("--intra-op-threads", type=int, default=threads.env_default("intra-op-threads", 0), help="number of threads torch uses within ops - 0 means one per core the process is pinned to, or torch's default split between the data parallel ranks on the host")
+    parser.add_argument("--inter-op-threads", type=int, default=threads.env_default("inter-op-threads", 0), help="number of threads torch runs independent ops in parallel on - 0 means torch's default")
+    parser.add_argument("--cpu-affinity", type=str, default=threads.env_default("cpu-affinity", "none"), help="cores each process is pinned to - options are none, cores (a block of physical cores for each data parallel rank on the host) or numa (ranks placed on the NUMA nodes in turn), see threads.py")
+    parser.add_argument("--num-workers", type=int, default=threads.env_default("num-workers", 0), help="number of DataLoader worker processes, each with one thread - 0 means loading in the training process")
+
     # regularization
 
     utils.add_bool_arg(parser, "batch-norm-disc", "use batch normalization", default=False)
@@ -143,8 +160,23 @@ def parse_args():
     utils.add_bool_arg(parser, "adaptive-prob", "adaptive augment probability", default=False)
     parser.add_argument("--aug-prob", type=float, default=1.0, help="probability of being augmented")
 
+    # checkpoints
+
+    parser.add_argument("--ckpt-dtype", type=str, default="float32", help="dtype model weights are stored in in checkpoints - options are float32, float16 or bfloat16")
+    parser.add_argument("--ckpt-compression", type=str, default="none", help="checkpoint compression - options are none, zlib or lzma")
+    parser.add_argument("--ckpt-keep-last", type=int, default=5, help="number of most recent checkpoints to keep - 0 means keep all")
+    parser.add_argument("--ckpt-keep-every", type=int, default=100, help="also keep the checkpoints every this many epochs - 0 means none")
+    utils.add_bool_arg(parser, "ckpt-keep-best", "also keep the checkpoint with the best --best-metric", default=True)
+    parser.add_argument("--best-metric", type=str, default="w1", help="metric the best checkpoint is picked by and early stopping is decided by, lower being better - options are w1 (summed over particle features, with the largest w1 num samples) or fid")
+    parser.add_argument("--ckpt-interval", type=float, default=0, help="also save a mid-epoch checkpoint to resume from every this many minutes - 0 means only at the end of epochs")
+
+    utils.add_bool_arg(parser, "registry", "record the run's config, metrics, checkpoints and timings in registry.db in the dir path", default=True)
+
     # evaluation
 
+    utils.add_bool_arg(parser, "ema", "evaluate, plot and export an exponential moving average of G's weights", default=True)
+    parser.add_argument("--ema-decay", type=float, default=0.999, help="G weights EMA decay per G update")
+
     utils.add_bool_arg(parser, "fid", "calc fid", default=False)
     parser.add_argument("--fid-eval-size", type=int, default=8192, help="number of samples generated for evaluating fid")
     parser.add_argument("--fid-batch-size", type=int, default=32, help="batch size when generating samples for fid eval")
@@ -155,7 +187,13 @@ def parse_args():
 
     parser.add_argument("--jet-features", type=str, nargs='*', default=['mass', 'pt'], help='jet level features to evaluate')
 
-    args = parser.parse_args()
+    # early stopping
+
+    parser.add_argument("--early-stopping-patience", type=int, default=0, help="stop training once the --best-metric hasn't improved in this many epochs - 0 means always train for num epochs")
+    parser.add_argument("--early-stopping-min-delta", type=float, default=0, help="fraction of the best --best-metric so far an evaluation has to be lower by to improve on it")
+    parser.add_argument("--early-stopping-smoothing", type=float, default=0, help="weight of the previous average in the exponential moving average of the --best-metric early stopping compares - 0 means no smoothing")
+
+    args = parser.parse_args(argv)
 
     if(args.aug_t or args.aug_f or args.aug_r90 or args.aug_s):
         args.augment = True
@@ -192,6 +230,65 @@ def parse_args():
         print("acgd can't have num critic or num gen > 1 - exiting")
         sys.exit()
 
+    if(args.ema and not (0 <= args.ema_decay < 1)):
+        print("ema decay must be in [0, 1) - exiting")
+        sys.exit()
+
+    if(not(args.activation_checkpointing == 'none' or args.activation_checkpointing == 'edges' or args.activation_checkpointing == 'iterations')):
+        print("invalid activation checkpointing - exiting")
+        sys.exit()
+
+    if(not(args.precision == 'fp32' or args.precision == 'bf16')):
+        print("invalid precision - exiting")
+        sys.exit()
+
+    if(args.accumulation_steps < 1):
+        print("accumulation steps must be at least 1 - exiting")
+        sys.exit()
+
+    if(args.accumulation_steps > 1 and (args.batch_norm_disc or args.batch_norm_gen)):
+        print("batch norm statistics will be of micro-batches of the batch, not the whole batch")
+
+    if(not(args.cpu_affinity == 'none' or args.cpu_affinity == 'cores' or args.cpu_affinity == 'numa')):
+        print("invalid cpu affinity - exiting")
+        sys.exit()
+
+    if(args.intra_op_threads < 0 or args.inter_op_threads < 0 or args.num_workers < 0):
+        print("intra-op threads, inter-op threads and num workers can't be negative - exiting")
+        sys.exit()
+
+    if(args.world_size < 1):
+        print("world size must be at least 1 - exiting")
+        sys.exit()
+
+    if(args.memory_budget < 0 or args.autotune_steps < 1):
+        print("memory budget can't be negative and autotune steps must be at least 1 - exiting")
+        sys.exit()
+
+    if(args.profile_steps < 0 or args.profile_start < 0):
+        print("profile steps and start can't be negative - exiting")
+        sys.exit()
+
+    if(not(args.ckpt_dtype == 'float32' or args.ckpt_dtype == 'float16' or args.ckpt_dtype == 'bfloat16')):
+        print("invalid checkpoint dtype - exiting")
+        sys.exit()
+
+    if(not(args.ckpt_compression == 'none' or args.ckpt_compression == 'zlib' or args.ckpt_compression == 'lzma')):
+        print("invalid checkpoint compression - exiting")
+        sys.exit()
+
+    if(not(args.best_metric == 'w1' or args.best_metric == 'fid')):
+        print("invalid best metric - exiting")
+        sys.exit()
+
+    if(args.early_stopping_patience < 0 or not (0 <= args.early_stopping_min_delta < 1) or not (0 <= args.early_stopping_smoothing < 1)):
+        print("early stopping patience can't be negative and min delta and smoothing must be in [0, 1) - exiting")
+        sys.exit()
+
+    if(args.early_stopping_patience and not (args.w1 if args.best_metric == 'w1' else args.fid)):
+        print("early stopping needs the best metric to be calculated - exiting")
+        sys.exit()
+
     if(args.n and args.lx):
         print("can't be on nautilus and lxplus both - exiting")
         sys.exit()
@@ -220,6 +317,8 @@ def parse_args():
             args.batch_size = 128
         elif args.num_hits == 100:
             args.batch_size = 32
+        else:
+            args.autotune_batch_size = True
 
     if not args.mp_iters_gen: args.mp_iters_gen = args.mp_iters
     if not args.mp_iters_disc: args.mp_iters_disc = args.mp_iters
@@ -235,10 +334,7 @@ def parse_args():
     return args
 
 
-def init(args):
-    torch.manual_seed(4)
-    torch.autograd.set_detect_anomaly(True)
-
+def set_paths(args):
     args.model_path = args.dir_path + '/models/'
     args.losses_path = args.dir_path + '/losses/'
     args.args_path = args.dir_path + '/args/'
@@ -248,35 +344,51 @@ def init(args):
     args.eval_path = args.dir_path + '/evaluation/'
     args.noise_path = args.dir_path + '/noise/'
 
-    if(not exists(args.model_path)):
-        mkdir(args.model_path)
-    if(not exists(args.losses_path)):
-        mkdir(args.losses_path)
-    if(not exists(args.args_path)):
-        mkdir(args.args_path)
-    if(not exists(args.figs_path)):
-        mkdir(args.figs_path)
-    if(not exists(args.err_path)):
-        mkdir(args.err_path)
-    # if(not exists(args.noise_path)):
-    #     mkdir(args.noise_path)
-    if(not exists(args.dataset_path)):
-        mkdir(args.dataset_path)
-
-    prev_models = [f[:-4] for f in listdir(args.args_path)]  # removing .txt
-
-    if (args.name in prev_models):
-        print("name already used")
-        # if(not args.load_model):
-        #    sys.exit()
-    else:
-        mkdir(args.losses_path + args.name)
-        mkdir(args.model_path + args.name)
-        mkdir(args.figs_path + args.name)
+
+def load_dataset(args):
+    return JetsDataset(args)
+
+
+def init(args):
+    torch.manual_seed(4)
+    torch.autograd.set_detect_anomaly(args.debug >= 2)
+
+    set_paths(args)
+
+    # the other ranks wait for rank 0 to set up the directories
+    if(distributed.is_main()):
+        if(not exists(args.model_path)):
+            mkdir(args.model_path)
+        if(not exists(args.losses_path)):
+            mkdir(args.losses_path)
+        if(not exists(args.args_path)):
+            mkdir(args.args_path)
+        if(not exists(args.figs_path)):
+            mkdir(args.figs_path)
+        if(not exists(args.err_path)):
+            mkdir(args.err_path)
+        # if(not exists(args.noise_path)):
+        #     mkdir(args.noise_path)
+        if(not exists(args.dataset_path)):
+            mkdir(args.dataset_path)
+
+        prev_models = [f[:-4] for f in listdir(args.args_path)]  # removing .txt
+
+        if (args.name in prev_models):
+            print("name already used")
+            # if(not args.load_model):
+            #    sys.exit()
+        else:
+            mkdir(args.losses_path + args.name)
+            mkdir(args.model_path + args.name)
+            mkdir(args.figs_path + args.name)
+    distributed.barrier()
 
     if args.load_model:
         if args.start_epoch == -1:
-            prev_models = [int(f[:-3].split('_')[-1]) for f in listdir(args.model_path + args.name + '/')]
+            args.start_epoch = checkpoint.latest_epoch(args.model_path + args.name + '/')
+            # runs from before the checkpoint manifest only have the pickled models
+            prev_models = [int(f[:-3].split('_')[-1]) for f in listdir(args.model_path + args.name + '/') if f.endswith('.pt')] if args.start_epoch is None else [args.start_epoch]
             if len(prev_models):
                 args.start_epoch = max(prev_models)
             else:
@@ -287,10 +399,22 @@ def init(args):
     else:
         args.start_epoch = 0
 
+    # the tuned batch size is saved with the args, so resumed runs keep it. What has to fit in memory is a micro-batch,
+    # so with gradient accumulation the batch is that many tuned micro-batches. It's tuned on rank 0, for every rank
+    if(args.autotune_batch_size and (not args.load_model or args.override_args)):
+        print("autotuning batch size")
+        args.batch_size = distributed.broadcast_object(autotune.tune(args, device)[0] if distributed.is_main() else None)
+        if(not args.batch_size):
+            print("a batch of 1 doesn't fit in the memory budget - exiting")
+            sys.exit()
+        args.batch_size *= args.accumulation_steps
+        print("batch size " + str(args.batch_size))
+
     if(not args.load_model):
-        f = open(args.args_path + args.name + ".txt", "w+")
-        f.write(str(vars(args)))
-        f.close()
+        if(distributed.is_main()):
+            f = open(args.args_path + args.name + ".txt", "w+")
+            f.write(str(vars(args)))
+            f.close()
     elif(not args.override_args):
         temp = args.start_epoch, args.num_epochs
         f = open(args.args_path + args.name + ".txt", "r")
@@ -304,30 +428,49 @@ def init(args):
         args.load_model = True
         args.start_epoch, args.num_epochs = temp
 
-    args.device = device
+    args.device = distributed.device(device)
 
     return args
 
 
-def main(args):
+# X is the dataset when already loaded e.g. into shared memory by sweep.py, for all of its runs, and member the run's
+# pbt.Member when it's one of a population
+def main(args, X=None, member=None):
+    distributed.init()
+    thread_config = threads.apply(args)
     args = init(args)
+    main_rank = distributed.is_main()
 
     print("loading data")
 
-    X = JetsDataset(args)
-    X_loaded = DataLoader(X, shuffle=True, batch_size=args.batch_size, pin_memory=True)
+    if X is None: X = load_dataset(args)
+    X_loaded, sampler = checkpoint.resumable_loader(X, args.batch_size, num_replicas=distributed.world_size(), rank=distributed.rank(), num_workers=args.num_workers, worker_init_fn=threads.worker_init_fn(thread_config), pin_memory=True)
+    # every rank has to draw the same order to take its shard of
+    sampler.load_state_dict(distributed.broadcast_object(sampler.state_dict()))
+    distributed.seed_ranks()
 
     print("loaded data")
 
     # model
 
-    if(args.load_model):
+    state = None
+    if(args.load_model and checkpoint.find(args.model_path + args.name + '/', args.start_epoch) is not None):
+        state = checkpoint.load(args.model_path + args.name + '/', checkpoint.find(args.model_path + args.name + '/', args.start_epoch), args.device)
+        G, D = checkpoint.load_models(args, state)
+    elif(args.load_model):
         G = torch.load(args.model_path + args.name + "/G_" + str(args.start_epoch) + ".pt", map_location=args.device)
         D = torch.load(args.model_path + args.name + "/D_" + str(args.start_epoch) + ".pt", map_location=args.device)
     else:
         G = Graph_GAN(gen=True, args=deepcopy(args)).to(args.device)
         D = Graph_GAN(gen=False, args=deepcopy(args)).to(args.device)
 
+    G.activation_checkpointing = D.activation_checkpointing = args.activation_checkpointing
+    G.precision = D.precision = args.precision
+
+    # G and D's forward passes to average the gradients of over the ranks - the batch norms of the last fn (and fnd)
+    # layers aren't used
+    G_parallel, D_parallel = distributed.wrap(G, args.batch_norm_gen), distributed.wrap(D, args.batch_norm_disc)
+
     print("Models loaded")
 
     # optimizer
@@ -349,12 +492,22 @@ def main(args):
         D_optimizer = optim.Adam(D_params, lr=args.lr_disc, weight_decay=5e-4, betas=(args.beta1, args.beta2))
 
     if(args.load_model):
-        G_optimizer.load_state_dict(torch.load(args.model_path + args.name + "/G_optim_" + str(args.start_epoch) + ".pt", map_location=args.device))
-        D_optimizer.load_state_dict(torch.load(args.model_path + args.name + "/D_optim_" + str(args.start_epoch) + ".pt", map_location=args.device))
+        G_optimizer.load_state_dict(state['G_optim'] if state is not None else torch.load(args.model_path + args.name + "/G_optim_" + str(args.start_epoch) + ".pt", map_location=args.device))
+        D_optimizer.load_state_dict(state['D_optim'] if state is not None else torch.load(args.model_path + args.name + "/D_optim_" + str(args.start_epoch) + ".pt", map_location=args.device))
 
     print("optimizers loaded")
 
-    if args.fid: C, mu2, sigma2 = evaluation.load(args, X_loaded)
+    G_ema = ema.EMA(G, args.ema_decay) if args.ema else None
+
+    if(args.load_model and args.ema):
+        try:
+            if state is not None: G_ema.load_state_dict(state['G_ema'])
+            else: G_ema.load_model(torch.load(args.model_path + args.name + "/G_ema_" + str(args.start_epoch) + ".pt", map_location=args.device))
+        except:
+            print("Error loading G ema - starting from the current G weights")
+
+    # the real jets' statistics are of the whole dataset, not rank 0's shard
+    if args.fid and main_rank: C, mu2, sigma2 = evaluation.load(args, X_loaded if distributed.world_size() == 1 else DataLoader(X, batch_size=args.batch_size))
 
     normal_dist = Normal(torch.tensor(0.).to(args.device), torch.tensor(args.sd).to(args.device))
 
@@ -369,83 +522,124 @@ def main(args):
 
     losses = {}
 
-    if(args.load_model):
-        losses['D'] = np.loadtxt(args.losses_path + args.name + "/" + "D.txt").tolist()[:args.start_epoch]
-        losses['Dr'] = np.loadtxt(args.losses_path + args.name + "/" + "Dr.txt").tolist()[:args.start_epoch]
-        losses['Df'] = np.loadtxt(args.losses_path + args.name + "/" + "Df.txt").tolist()[:args.start_epoch]
-        losses['G'] = np.loadtxt(args.losses_path + args.name + "/" + "G.txt").tolist()[:args.start_epoch]
-        if args.fid: losses['fid'] = np.loadtxt(args.losses_path + args.name + "/" + "fid.txt").tolist()[:args.start_epoch]
-        if(args.gp): losses['gp'] = np.loadtxt(args.losses_path + args.name + "/" + "gp.txt").tolist()[:args.start_epoch]
-
-        if args.w1:
-            for k in range(len(args.w1_num_samples)):
-                losses['w1_' + str(args.w1_num_samples[k]) + 'm'] = np.loadtxt(args.losses_path + args.name + "/w1_" + str(args.w1_num_samples[k]) + 'm.txt')
-                losses['w1_' + str(args.w1_num_samples[k]) + 'std'] = np.loadtxt(args.losses_path + args.name + "/w1_" + str(args.w1_num_samples[k]) + 'std.txt')
-                if losses['w1_' + str(args.w1_num_samples[k]) + 'm'].ndim == 1: np.expand_dims(losses['w1_' + str(args.w1_num_samples[k]) + 'm'], 0)
-                if losses['w1_' + str(args.w1_num_samples[k]) + 'std'].ndim == 1: np.expand_dims(losses['w1_' + str(args.w1_num_samples[k]) + 'std'], 0)
-                losses['w1_' + str(args.w1_num_samples[k]) + 'm'] = losses['w1_' + str(args.w1_num_samples[k]) + 'm'].tolist()[:args.start_epoch]
-                losses['w1_' + str(args.w1_num_samples[k]) + 'std'] = losses['w1_' + str(args.w1_num_samples[k]) + 'std'].tolist()[:args.start_epoch]
-
-            if args.jf:
-                for k in range(len(args.w1_num_samples)):
-                    losses['w1j_' + str(args.w1_num_samples[k]) + 'm'] = np.loadtxt(args.losses_path + args.name + "/w1j_" + str(args.w1_num_samples[k]) + 'm.txt').tolist()[:args.start_epoch]
-                    losses['w1j_' + str(args.w1_num_samples[k]) + 'std'] = np.loadtxt(args.losses_path + args.name + "/w1j_" + str(args.w1_num_samples[k]) + 'std.txt').tolist()[:args.start_epoch]
-                    if losses['w1j_' + str(args.w1_num_samples[k]) + 'm'].ndim == 1: np.expand_dims(losses['w1j_' + str(args.w1_num_samples[k]) + 'm'], 0).tolist()[:args.start_epoch]
-                    if losses['wj1_' + str(args.w1_num_samples[k]) + 'std'].ndim == 1: np.expand_dims(losses['w1j_' + str(args.w1_num_samples[k]) + 'std'], 0).tolist()[:args.start_epoch]
-    else:
-        losses['D'] = []
-        losses['Dr'] = []
-        losses['Df'] = []
-        losses['G'] = []
-
-        if args.w1:
-            for k in range(len(args.w1_num_samples)):
-                losses['w1_' + str(args.w1_num_samples[k]) + 'm'] = []
-                losses['w1_' + str(args.w1_num_samples[k]) + 'std'] = []
-
-            if args.jf:
-                for k in range(len(args.w1_num_samples)):
-                    losses['w1j_' + str(args.w1_num_samples[k]) + 'm'] = []
-                    losses['w1j_' + str(args.w1_num_samples[k]) + 'std'] = []
-
-        if args.fid: losses['fid'] = []
-        if(args.gp): losses['gp'] = []
+    # only rank 0 logs
+    metrics_log = metrics.MetricsLog(args.losses_path + args.name + "/") if main_rank else None
+    # runs from before the metrics log only have the losses saved as text files
+    if(main_rank and args.load_model and not exists(metrics_log.file)):
+        metrics.convert(args.losses_path + args.name + "/")
+        metrics_log = metrics.MetricsLog(args.losses_path + args.name + "/")
+    # the epochs after the one resumed from are trained again
+    if(main_rank): metrics_log.truncate(args.start_epoch if args.load_model else -1)
+
+    runs = registry.Registry(args.dir_path + "/") if args.registry and main_rank else None
+    if(runs is not None):
+        runs.register_run(args.name, checkpoint.args_dict(args))
+        runs.truncate(args.name, args.start_epoch if args.load_model else -1)
+
+    # exact progress through training when the checkpoint has it, otherwise the losses are read from the metrics log
+    progress = state['progress'] if state is not None and 'progress' in state else None
+
+    if(progress is not None):
+        losses = checkpoint.map_tensors(progress['losses'], lambda tensor: tensor.cpu().numpy())
+    elif(args.load_model and main_rank):
+        losses = metrics_log.read()
+
+    keys = ['D', 'Dr', 'Df', 'G'] + (['fid'] if args.fid else []) + (['gp'] if args.gp else [])
+    if args.w1:
+        for k in range(len(args.w1_num_samples)):
+            keys += ['w1_' + str(args.w1_num_samples[k]) + 'm', 'w1_' + str(args.w1_num_samples[k]) + 'std']
+            if args.jf: keys += ['w1j_' + str(args.w1_num_samples[k]) + 'm', 'w1j_' + str(args.w1_num_samples[k]) + 'std']
+
+    for key in keys:
+        losses.setdefault(key, [])
 
     Y_real = torch.ones(args.batch_size, 1).to(args.device)
     Y_fake = torch.zeros(args.batch_size, 1).to(args.device)
 
-    def train_D(data, labels=None, gen_data=None):
-        if args.debug: print("dtrain")
-        D.train()
-        D_optimizer.zero_grad()
+    checkpoints = checkpoint.CheckpointWriter(args, registry=runs) if main_rank else None
 
-        run_batch_size = data.shape[0]
-        deb = run_batch_size != args.batch_size
+    # stops training once the best metric plateaus, continuing from its values already in the metrics log when resuming
+    best_key = 'w1_' + str(args.w1_num_samples[-1]) + 'm' if args.best_metric == 'w1' else 'fid'
+    stopper = stopping.EarlyStopping(args.early_stopping_patience, args.early_stopping_min_delta, args.early_stopping_smoothing) if args.early_stopping_patience and main_rank else None
+    if(stopper is not None and best_key in metrics_log.columns):
+        for epoch, value in zip(*metrics_log.column(best_key)): stopper.step(epoch, np.sum(value))
 
-        if gen_data is None:
-            gen_data = utils.gen(args, G, normal_dist, run_batch_size, labels=labels)
+    # a checkpoint is saved whenever the best metric improves on its lowest value so far, so the best checkpoint is of the best
+    # evaluated epoch - epoch 0's initial evaluation has no checkpoint
+    best_value = float('inf')
+    if(main_rank and best_key in metrics_log.columns):
+        best_value = min([float(np.sum(value)) for epoch, value in zip(*metrics_log.column(best_key)) if epoch > 0 and np.isfinite(np.sum(value))] + [best_value])
 
-        if args.augment:
-            p = args.aug_prob if not args.adaptive_prob else losses['p'][-1]
-            data = augment.augment(args, data, p)
-            gen_data = augment.augment(args, gen_data, p)
+    optimizers = (D_optimizer, G_optimizer)
 
-        D_real_output = D(data.clone(), labels, deb)
+    timer = profiling.PhaseTimer()
+    trace = profiling.TraceWindow(args.losses_path + args.name + "/trace.json", args.profile_start, args.profile_steps) if args.profile_steps and main_rank else None
 
-        if args.debug or run_batch_size != args.batch_size:
-            print("D real output: ")
-            print(D_real_output[:10])
+    # on preemption save a step checkpoint after the current batch and exit
+    stop = []
+    signal.signal(signal.SIGTERM, lambda signum, frame: stop.append(signum))
 
-        D_fake_output = D(gen_data, labels, deb)
+    # everything besides the models and optimizers needed to continue training exactly from after the given number of batches of the epoch
+    def progress_state(epoch, batches, accumulators):
+        return {'epoch': epoch, 'batch': batches, 'accumulators': accumulators, 'losses': losses, 'rng': checkpoint.rng_state(), 'sampler': sampler.state_dict(batches)}
 
-        if args.debug or run_batch_size != args.batch_size:
-            print("D fake output: ")
-            print(D_fake_output[:10])
+    # (start, end) of the micro-batches a batch is split into, with gradients accumulated over them and one optimizer step
+    def micro_batches(run_batch_size):
+        size = -(-run_batch_size // args.accumulation_steps)
+        return [(start, min(start + size, run_batch_size)) for start in range(0, run_batch_size, size)]
+
+    def train_D(data, labels=None, gen_data=None):
+        if args.debug: print("dtrain")
+        D.train()
+        D_optimizer.zero_grad()
 
-        D_loss, D_loss_items = utils.calc_D_loss(args, D, data, gen_data, D_real_output, D_fake_output, run_batch_size, Y_real, Y_fake)
-        D_loss.backward()
+        run_batch_size = data.shape[0]
+        deb = run_batch_size != args.batch_size
 
-        D_optimizer.step()
+        # each micro-batch's losses are weighted by its share of the batch, so the gradients and losses are of the batch's means
+        D_loss_items = {}
+        for start, end in micro_batches(run_batch_size):
+            weight = (end - start) / run_batch_size
+            micro_data = data[start:end]
+            micro_labels = labels[start:end] if labels is not None else None
+            # the gradients are averaged over the ranks once, in the last micro-batch's backward pass
+            D_forward = D_parallel if end == run_batch_size else D
+
+            if gen_data is None:
+                with timer.phase('G forward'):
+                    micro_gen_data = utils.gen(args, G, normal_dist, end - start, labels=micro_labels)
+            else: micro_gen_data = gen_data[start:end]
+
+            if args.augment:
+                with timer.phase('augment'):
+                    p = args.aug_prob if not args.adaptive_prob else losses['p'][-1]
+                    micro_data = augment.augment(args, micro_data, p)
+                    micro_gen_data = augment.augment(args, micro_gen_data, p)
+
+            with timer.phase('D forward real'):
+                D_real_output = D_forward(micro_data.clone(), micro_labels, deb)
+
+            if args.debug or deb:
+                print("D real output: ")
+                print(D_real_output[:10])
+
+            with timer.phase('D forward fake'):
+                D_fake_output = D_forward(micro_gen_data, micro_labels, deb)
+
+            if args.debug or deb:
+                print("D fake output: ")
+                print(D_fake_output[:10])
+
+            with timer.phase('D loss'):
+                D_loss, micro_loss_items = utils.calc_D_loss(args, D_forward, micro_data, micro_gen_data, D_real_output, D_fake_output, end - start, Y_real, Y_fake)
+            with timer.phase('backward'):
+                (D_loss * weight).backward()
+
+            for key, value in micro_loss_items.items():
+                D_loss_items[key] = D_loss_items.get(key, 0) + weight * value
+
+        with timer.phase('optimizer step'):
+            D_optimizer.step()
         return D_loss_items
 
     def train_G(data, labels=None):
@@ -455,49 +649,87 @@ def main(args):
 
         run_batch_size = labels.shape[0] if labels is not None else args.batch_size
 
-        gen_data = utils.gen(args, G, normal_dist, run_batch_size, labels=labels)
+        G_loss_item = 0
+        for start, end in micro_batches(run_batch_size):
+            weight = (end - start) / run_batch_size
+            micro_labels = labels[start:end] if labels is not None else None
 
-        if args.augment:
-            p = args.aug_prob if not args.adaptive_prob else losses['p'][-1]
-            gen_data = augment.augment(args, gen_data, p)
+            with timer.phase('G forward'):
+                gen_data = utils.gen(args, G_parallel if end == run_batch_size else G, normal_dist, end - start, labels=micro_labels)
 
-        D_fake_output = D(gen_data, labels)
+            if args.augment:
+                with timer.phase('augment'):
+                    p = args.aug_prob if not args.adaptive_prob else losses['p'][-1]
+                    gen_data = augment.augment(args, gen_data, p)
 
-        if args.debug:
-            print("D fake output: ")
-            print(D_fake_output[:10])
+            with timer.phase('D forward fake'):
+                D_fake_output = D(gen_data, micro_labels)
 
-        G_loss = utils.calc_G_loss(args, D_fake_output, Y_real, run_batch_size)
+            if args.debug:
+                print("D fake output: ")
+                print(D_fake_output[:10])
 
-        G_loss.backward()
-        G_optimizer.step()
+            G_loss = utils.calc_G_loss(args, D_fake_output, Y_real, end - start)
 
-        return G_loss.item()
+            with timer.phase('backward'):
+                (G_loss * weight).backward()
+            G_loss_item += weight * G_loss.item()
 
-    def train():
-        if(args.fid): losses['fid'].append(evaluation.get_fid(args, C, G, normal_dist, mu2, sigma2))
-        # if(args.w1): evaluation.calc_w1(args, X, G, normal_dist, losses)
-        if(args.start_epoch == 0 and args.save_zero):
-            # mean, std = evaluation.calc_jsd(args, X, G, normal_dist)
-            # print("JSD = " + str(mean) + " ± " + str(std))
-            # losses['jsdm'].append(mean)
-            # losses['jsdstd'].append(std)
-            save_outputs.save_sample_outputs(args, D, G, X[:args.num_samples][0], normal_dist, args.name, 0, losses, X_loaded=X_loaded)
+        with timer.phase('optimizer step'):
+            G_optimizer.step()
+            if args.ema: G_ema.update()
+
+        return G_loss_item
+
+    # appends the losses added since the last call to the metrics log and the registry, with the seconds spent in each phase
+    def log_metrics(epoch, timings):
+        if(not main_rank): return
+        for values in metrics_log.extend(epoch, losses, {'time_' + key: seconds for key, seconds in timings.items()}):
+            if(runs is not None): runs.log_metrics(args.name, epoch, values)
+        if(runs is not None and len(timings)): runs.log_timings(args.name, epoch, timings)
 
+    def train():
+        nonlocal best_value
+        # the initial evaluation is already in the losses restored with the progress
+        if(progress is None):
+            with ema.averaged(G_ema), threads.widened(thread_config):
+                with timer.phase('evaluation'):
+                    if(args.fid and main_rank): losses['fid'].append(evaluation.get_fid(args, C, G, normal_dist, mu2, sigma2))
+                # if(args.w1): evaluation.calc_w1(args, X, G, normal_dist, losses)
+                if(args.start_epoch == 0 and args.save_zero and main_rank):
+                    # mean, std = evaluation.calc_jsd(args, X, G, normal_dist)
+                    # print("JSD = " + str(mean) + " ± " + str(std))
+                    # losses['jsdm'].append(mean)
+                    # losses['jsdstd'].append(std)
+                    with timer.phase('plotting'):
+                        save_outputs.save_sample_outputs(args, D, G, X[:args.num_samples][0], normal_dist, args.name, 0, losses, X_loaded=X_loaded)
+            log_metrics(0, timer.epoch_totals())
+        else:
+            sampler.load_state_dict(progress['sampler'])
+            checkpoint.set_rng_state(progress['rng'])
+            distributed.seed_ranks()
+
+        last_save = time.time()
         for i in range(args.start_epoch, args.num_epochs):
             print("Epoch %d %s" % ((i + 1), args.name))
+            epoch_start = time.time()
             Dr_loss = 0
             Df_loss = 0
             G_loss = 0
             D_loss = 0
             gp_loss = 0
+            start_batch = 0
+            if(i == args.start_epoch and progress is not None and progress['batch']):
+                D_loss, Dr_loss, Df_loss, G_loss, gp_loss = [progress['accumulators'][key] for key in ['D', 'Dr', 'Df', 'G', 'gp']]
+                start_batch = progress['batch']
             lenX = len(X_loaded)
-            for batch_ndx, data in tqdm(enumerate(X_loaded), total=lenX):
-                if args.clabels:
-                    labels = data[1].to(args.device)
-                else: labels = None
+            for batch_ndx, data in tqdm(enumerate(timer.iterate('data', X_loaded), start_batch), total=lenX, initial=start_batch, disable=not main_rank):
+                with timer.phase('data'):
+                    if args.clabels:
+                        labels = data[1].to(args.device)
+                    else: labels = None
 
-                data = data[0].to(args.device)
+                    data = data[0].to(args.device)
 
                 # write as just one if statement each for g and d
 
@@ -524,6 +756,27 @@ def main(args):
                     if(batch_ndx == 10):
                         return
 
+                if(trace is not None): trace.step()
+
+                # every rank stops and saves together, and the checkpoint has the loss sums averaged over the ranks
+                stopping, due = distributed.any_rank(len(stop), args.ckpt_interval and time.time() - last_save > args.ckpt_interval * 60)
+                if(stopping or due):
+                    distributed.synchronize(D)
+                    distributed.synchronize(G)
+                    accumulators = dict(zip(['D', 'Dr', 'Df', 'G', 'gp'], distributed.mean([D_loss, Dr_loss, Df_loss, G_loss, gp_loss])))
+                    if(main_rank): checkpoints.save_step(D, G, optimizers, G_ema, progress_state(i, batch_ndx + 1, accumulators))
+                    last_save = time.time()
+                    if stopping:
+                        if(main_rank): checkpoints.wait()
+                        print("saved step checkpoint - exiting")
+                        sys.exit()
+
+            train_time = time.time() - epoch_start
+
+            D_loss, Dr_loss, Df_loss, G_loss, gp_loss = distributed.mean([D_loss, Dr_loss, Df_loss, G_loss, gp_loss])
+            distributed.synchronize(D)
+            distributed.synchronize(G)
+
             losses['D'].append(D_loss / (lenX / args.num_gen))
             losses['Dr'].append(Dr_loss / (lenX / args.num_gen))
             losses['Df'].append(Df_loss / (lenX / args.num_gen))
@@ -537,24 +790,58 @@ def main(args):
 
             if(args.gp): print("gp loss: " + str(losses['gp'][-1]))
 
-            if((i + 1) % 5 == 0):
-                optimizers = (D_optimizer, G_optimizer)
-                save_outputs.save_models(args, D, G, optimizers, args.name, i + 1)
-                if args.w1: evaluation.calc_w1(args, X[:][0], G, normal_dist, losses, X_loaded=X_loaded)
-
-            if(args.fid and (i + 1) % 1 == 0):
-                losses['fid'].append(evaluation.get_fid(args, C, G, normal_dist, mu2, sigma2))
-
-            if((i + 1) % args.save_epochs == 0):
-                # mean, std = evaluation.calc_jsd(args, X, G, normal_dist)
-                # print("JSD = " + str(mean) + " ± " + str(std))
-                # losses['jsdm'].append(mean)
-                # losses['jsdstd'].append(std)
-                save_outputs.save_sample_outputs(args, D, G, X[:args.num_samples][0], normal_dist, args.name, i + 1, losses, X_loaded=X_loaded)
+            evaluations = len(losses.get(best_key, []))
+
+            if((i + 1) % 5 == 0 and args.w1 and main_rank):
+                with ema.averaged(G_ema), threads.widened(thread_config), timer.phase('evaluation'): evaluation.calc_w1(args, X[:][0], G, normal_dist, losses, X_loaded=X_loaded)
+
+            with ema.averaged(G_ema), threads.widened(thread_config):
+                if(args.fid and (i + 1) % 1 == 0 and main_rank):
+                    with timer.phase('evaluation'):
+                        losses['fid'].append(evaluation.get_fid(args, C, G, normal_dist, mu2, sigma2))
+
+                if((i + 1) % args.save_epochs == 0 and main_rank):
+                    # mean, std = evaluation.calc_jsd(args, X, G, normal_dist)
+                    # print("JSD = " + str(mean) + " ± " + str(std))
+                    # losses['jsdm'].append(mean)
+                    # losses['jsdstd'].append(std)
+                    with timer.phase('plotting'):
+                        save_outputs.save_sample_outputs(args, D, G, X[:args.num_samples][0], normal_dist, args.name, i + 1, losses, X_loaded=X_loaded)
+
+            log_metrics(i + 1, dict(timer.epoch_totals(), train=train_time))
+
+            # every rank stops together, after saving a checkpoint, once an evaluation leaves the best metric without an
+            # improvement for the patience
+            evaluated = len(losses.get(best_key, [])) > evaluations
+            value = float(np.sum(losses[best_key][-1])) if evaluated else None
+            new_best = evaluated and value < best_value
+            if(new_best): best_value = value
+            plateaued = stopper is not None and evaluated and stopper.step(i + 1, value)
+            plateaued, = distributed.any_rank(plateaued)
+
+            # a member of a population may take over a better member's models and optimizers with new hyperparameters,
+            # before the checkpoint so resuming continues from them
+            if(member is not None and (i + 1) % member.interval == 0 and i + 1 < args.num_epochs and not plateaued):
+                member.exploit(i + 1, args, losses, D, G, optimizers, G_ema)
+
+            # after the evaluation so the checkpoint's losses include this epoch's, and its metric is there for the retention policy
+            if(((i + 1) % 5 == 0 or new_best or plateaued) and main_rank):
+                if(evaluated): checkpoints.record_metric(i + 1, checkpoints.best_metric, value)
+                checkpoints.save(i + 1, D, G, optimizers, G_ema=G_ema, progress=progress_state(i + 1, 0, dict.fromkeys(['D', 'Dr', 'Df', 'G', 'gp'], 0)))
+
+            if(plateaued):
+                if(main_rank):
+                    checkpoints.wait()
+                    print("%s hasn't improved since epoch %d - stopping, the best checkpoint is epoch %s" % (args.best_metric, stopper.best_epoch, checkpoints.manifest.get('best')))
+                break
 
     train()
+    if(trace is not None): trace.stop()
+    if(main_rank): checkpoints.wait()
 
 
 if __name__ == "__main__":
     args = parse_args()
-    main(args)
+    # started by torchrun when the world size is in the environment
+    if(args.world_size > 1 and 'WORLD_SIZE' not in environ): distributed.spawn(main, args, args.world_size)
+    else: main(args)
@@ -2,6 +2,8 @@ import numpy as np
 import torch
 import matplotlib.pyplot as plt
 import utils
+import export
+import checkpoint
 from jets_dataset import JetsDataset
 from torch.utils.data import DataLoader
 from torch.distributions.normal import Normal
@@ -12,6 +14,7 @@ from scipy.stats import wasserstein_distance
 import energyflow as ef
 import energyflow.utils as ut
 from matplotlib.colors import LogNorm
+from os.path import exists
 from mpl_toolkits.axes_grid1 import make_axes_locatable
 plt.rcParams.update({'font.size': 16})
 plt.style.use(hep.style.CMS)
@@ -19,12 +22,18 @@ plt.style.use(hep.style.CMS)
 device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
 
 model = 7
-epoch = 790
+# the run's best checkpoint by its best metric if its manifest has one
+manifest = checkpoint.read_manifest('./models/' + str(model) + '/')
+epoch = manifest['best'] if manifest is not None and manifest.get('best') is not None else 790
 name = str(model) + '_' + str(epoch)
 figpath = "figs/" + str(model) + '/' + name
 
 
-G = torch.load('./models/' + str(model) + '/G_' + str(epoch) + '.pt', map_location=device)
+# exported weights if the run has them, otherwise the pickled model from older runs
+if exists('./models/' + str(model) + '/' + export.generator_name(epoch) + '.json'):
+    G = export.load_generator('./models/' + str(model) + '/' + export.generator_name(epoch), device)
+else:
+    G = torch.load('./models/' + str(model) + '/G_' + str(epoch) + '.pt', map_location=device)
 # w1m = np.loadtxt('./losses/7/w1_100m.txt')
 # w1std = np.loadtxt('./losses/7/w1_100std.txt')
 #
@@ -0,0 +1,149 @@
+# per epoch losses and evaluation metrics of a run in one append-only file, in place of a text file per metric rewritten
+# in full at every save. metrics.bin starts with a JSON header listing the metrics and their shapes, followed by fixed
+# size rows of float64s - the epoch, then every metric's values, NaN for those not computed in the epoch. Appending an
+# epoch is a single write, and reading the file is one np.fromfile with each metric a slice of columns. A metric seen
+# for the first time adds columns, rewriting the file once, so in practice only in the first epochs of a run.
+# python metrics.py <losses dir> imports the text files of runs from before the log
+
+import numpy as np
+
+import os
+import sys
+import json
+from os import listdir
+from os.path import exists
+
+
+LOG = "metrics.bin"
+# the header is padded to a multiple of this so the rows are aligned
+HEADER_ALIGNMENT = 64
+
+
+class MetricsLog(object):
+    def __init__(self, path):
+        self.file = path + LOG
+        # name -> [first column, shape], column 0 being the epoch
+        self.columns = {}
+        self.header_size = 0
+        if exists(self.file):
+            with open(self.file, "rb") as f:
+                size = int(np.frombuffer(f.read(8), dtype=np.uint64)[0])
+                self.columns = json.loads(f.read(size).decode())
+            self.header_size = 8 + size
+            # drops a row left partly written when a run was killed, so appends stay aligned
+            rows = (os.path.getsize(self.file) - self.header_size) // self.row_size()
+            os.truncate(self.file, self.header_size + rows * self.row_size())
+
+        # number of values of each metric in the log, so extend() knows which are new
+        self.counts = {name: len(values) for name, values in self.read().items()}
+
+    def width(self):
+        return 1 + sum(int(np.prod(shape)) for start, shape in self.columns.values())
+
+    def row_size(self):
+        return 8 * self.width()
+
+    def rows(self):
+        if not exists(self.file): return np.zeros((0, self.width()))
+        data = np.fromfile(self.file, dtype=np.float64, offset=self.header_size)
+        return data.reshape(-1, self.width())
+
+    def write(self, rows):
+        header = json.dumps(self.columns).encode()
+        header += b" " * (-(8 + len(header)) % HEADER_ALIGNMENT)
+        with open(self.file + ".tmp", "wb") as f:
+            f.write(np.array([len(header)], dtype=np.uint64).tobytes())
+            f.write(header)
+            f.write(rows.tobytes())
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(self.file + ".tmp", self.file)
+        self.header_size = 8 + len(header)
+
+    # new metrics by name and shape, with NaN for every epoch already in the log
+    def add_columns(self, shapes):
+        rows = self.rows()
+        for name, shape in shapes.items():
+            self.columns[name] = [self.width(), list(shape)]
+        self.write(np.concatenate((rows, np.full((len(rows), self.width() - rows.shape[1]), np.nan)), 1))
+
+    # values is a dict of metric name -> scalar or array, all from the given epoch
+    def append(self, epoch, values):
+        if not len(values): return
+        values = {name: np.asarray(value, dtype=np.float64) for name, value in values.items()}
+        new = {name: value.shape for name, value in values.items() if name not in self.columns}
+        if len(new): self.add_columns(new)
+
+        row = np.full(self.width(), np.nan)
+        row[0] = epoch
+        for name, value in values.items():
+            start, shape = self.columns[name]
+            assert list(value.shape) == shape, "metric " + name + " changed shape"
+            row[start:start + value.size] = value.ravel()
+            self.counts[name] = self.counts.get(name, 0) + 1
+
+        with open(self.file, "ab") as f:
+            f.write(row.tobytes())
+            f.flush()
+            os.fsync(f.fileno())
+
+    # appends the values added to each of the losses lists since they were last logged, with one row per value if more
+    # than one was added to a list (e.g. by the g only mode), and returns them. extra values of the epoch which aren't
+    # kept in lists, e.g. timings, are added to its first row
+    def extend(self, epoch, losses, extra={}):
+        new = {name: values[self.counts.get(name, 0):] for name, values in losses.items()}
+        rows = [{name: values[i] for name, values in new.items() if i < len(values)} for i in range(max([len(values) for values in new.values()] + [0]))]
+        for i, values in enumerate(rows if len(rows) else [{}]):
+            self.append(epoch, dict(values, **extra) if i == 0 else values)
+        return rows
+
+    # epochs the metric was computed in and its values, as arrays
+    def column(self, name):
+        rows = self.rows()
+        start, shape = self.columns[name]
+        values = rows[:, start:start + int(np.prod(shape))]
+        computed = ~np.isnan(values).all(1)
+        return rows[computed, 0].astype(int), values[computed].reshape([-1] + shape)
+
+    # every metric's values in the order they were added, as lists like the losses in main
+    def read(self):
+        return {name: self.column(name)[1].tolist() for name in self.columns}
+
+    # drops the rows after the given epoch e.g. those of the epochs being trained again when resuming from a checkpoint
+    def truncate(self, epoch):
+        if not exists(self.file): return
+        rows = np.searchsorted(self.rows()[:, 0], epoch, side='right')
+        os.truncate(self.file, self.header_size + rows * self.row_size())
+        self.counts = {name: len(values) for name, values in self.read().items()}
+
+
+# imports a directory of text files saved by np.savetxt, one per metric, into its log. Each file is given epochs by its
+# length relative to the losses', as they were saved - one more value is an initial evaluation at epoch 0, fewer are evenly spaced
+def convert(path):
+    files = {f[:-4]: np.loadtxt(path + f, ndmin=2) for f in sorted(listdir(path)) if f.endswith('.txt')}
+    if not len(files): return
+    num_epochs = len(files['D']) if 'D' in files else max(len(values) for values in files.values())
+
+    epochs = {}
+    for name, values in files.items():
+        if len(values) == num_epochs + 1: epochs[name] = np.arange(len(values))
+        elif len(values) == num_epochs or len(values) == 0: epochs[name] = np.arange(1, len(values) + 1)
+        else: epochs[name] = np.arange(1, len(values) + 1) * max(num_epochs // len(values), 1)
+
+    rows = {}
+    for name, values in files.items():
+        for epoch, value in zip(epochs[name].tolist(), values):
+            rows.setdefault(epoch, {})[name] = value if values.shape[1] > 1 else value[0]
+
+    if exists(path + LOG): os.remove(path + LOG)
+    log = MetricsLog(path)
+    # a single column is a metric saved as a flat list, with a scalar per epoch
+    log.add_columns({name: values.shape[1:] if values.shape[1] > 1 else () for name, values in files.items()})
+    for epoch in sorted(rows):
+        log.append(epoch, rows[epoch])
+
+
+if __name__ == "__main__":
+    for path in sys.argv[1:]:
+        convert(path.rstrip('/') + '/')
+        print("converted " + path)
@@ -0,0 +1,178 @@
+# registry of every run in a directory in a local SQLite database, registry.db - each run's config, per epoch metrics,
+# retained checkpoints and the best of them, timings and the sweeps they're part of - for comparing runs without parsing
+# their args and losses files. The database is in WAL mode, so it can be read while being written, and every write is
+# its own short transaction on a new connection, which waits for any other writer - so training, the checkpoint writer
+# thread and evaluation processes can all write to it.
+# python registry.py best <metric> lists the best epoch of each config by the metric, python registry.py runs every run,
+# python registry.py checkpoints each run's best checkpoint and python registry.py sweep <metric> --sweep <sweep> the
+# runs of a sweep (see sweep.py), best first
+
+import sqlite3
+
+import json
+import time
+import hashlib
+import argparse
+from os.path import dirname, realpath
+
+
+DATABASE = "registry.db"
+
+# args which don't change what is trained, left out of a run's config when comparing
+RUN_ARGS = ['name', 'load_model', 'start_epoch', 'num_epochs', 'override_args', 'debug', 'registry']
+
+SCHEMA = """
+create table if not exists runs (name text primary key, config text, config_hash text, started real, updated real, epoch integer);
+create table if not exists metrics (run text, name text, epoch integer, value real, primary key (run, name, epoch));
+create table if not exists components (run text, name text, epoch integer, component integer, value real, primary key (run, name, epoch, component));
+create table if not exists checkpoints (run text, epoch integer, path text, saved real, primary key (run, epoch));
+create table if not exists timings (run text, name text, epoch integer, seconds real, primary key (run, name, epoch));
+create table if not exists sweeps (sweep text, run text, params text, status text, started real, finished real, primary key (sweep, run));
+create table if not exists best_checkpoints (run text primary key, metric text, epoch integer, value real, path text);
+create index if not exists runs_config on runs (config_hash);
+create index if not exists metrics_value on metrics (name, run, value, epoch);
+"""
+
+
+def config(args):
+    return {key: val for key, val in args.items() if key not in RUN_ARGS and not key.endswith('_path') and not key.startswith('ckpt_')}
+
+
+def config_hash(config):
+    return hashlib.sha256(json.dumps(config, sort_keys=True).encode()).hexdigest()[:16]
+
+
+class Registry(object):
+    def __init__(self, path):
+        self.file = path + DATABASE
+        conn = self.connect()
+        try:
+            conn.execute("pragma journal_mode=wal")
+            conn.executescript(SCHEMA)
+        finally:
+            conn.close()
+
+    # waits up to a minute for other writers to finish
+    def connect(self):
+        return sqlite3.connect(self.file, timeout=60)
+
+    def write(self, sql, rows):
+        conn = self.connect()
+        try:
+            with conn:
+                conn.executemany(sql, rows)
+        finally:
+            conn.close()
+
+    def query(self, sql, params=()):
+        conn = self.connect()
+        try:
+            return conn.execute(sql, params).fetchall()
+        finally:
+            conn.close()
+
+    # args is a dict of the run's args with plain values (see checkpoint.args_dict)
+    def register_run(self, name, args):
+        run_config = config(args)
+        self.write("insert into runs values (?, ?, ?, ?, ?, 0) on conflict (name) do update set config = excluded.config, config_hash = excluded.config_hash, updated = excluded.updated",
+                   [(name, json.dumps(run_config, sort_keys=True), config_hash(run_config), time.time(), time.time())])
+
+    # drops the metrics and timings after the given epoch, like the run's metrics log when resuming
+    def truncate(self, name, epoch):
+        conn = self.connect()
+        try:
+            with conn:
+                for table in ['metrics', 'components', 'timings']:
+                    conn.execute("delete from " + table + " where run = ? and epoch > ?", (name, epoch))
+                conn.execute("update runs set epoch = min(epoch, ?) where name = ?", (max(epoch, 0), name))
+        finally:
+            conn.close()
+
+    # values is a dict of metric name -> scalar or array. An array's sum is its value for comparing runs (as for the
+    # checkpoints' retention), with its components stored separately
+    def log_metrics(self, name, epoch, values):
+        metrics, components = [], []
+        for metric, value in values.items():
+            value = value.tolist() if hasattr(value, 'tolist') else value
+            if isinstance(value, list):
+                components += [(name, metric, epoch, i, float(component)) for i, component in enumerate(value)]
+                value = sum(value)
+            metrics.append((name, metric, epoch, float(value)))
+
+        conn = self.connect()
+        try:
+            with conn:
+                conn.executemany("insert or replace into metrics values (?, ?, ?, ?)", metrics)
+                conn.executemany("insert or replace into components values (?, ?, ?, ?, ?)", components)
+                conn.execute("update runs set epoch = max(epoch, ?), updated = ? where name = ?", (epoch, time.time(), name))
+        finally:
+            conn.close()
+
+    def log_timings(self, name, epoch, timings):
+        self.write("insert or replace into timings values (?, ?, ?, ?)", [(name, key, epoch, seconds) for key, seconds in timings.items()])
+
+    def add_checkpoint(self, name, epoch, path):
+        self.write("insert or replace into checkpoints values (?, ?, ?, ?)", [(name, epoch, path, time.time())])
+
+    def remove_checkpoints(self, name, epochs):
+        self.write("delete from checkpoints where run = ? and epoch = ?", [(name, epoch) for epoch in epochs])
+
+    # the retained checkpoint with the lowest value of the metric, as the checkpoints' manifest has it
+    def set_best_checkpoint(self, name, metric, epoch, value, path):
+        self.write("insert or replace into best_checkpoints values (?, ?, ?, ?, ?)", [(name, metric, epoch, value, path)])
+
+    def best_checkpoints(self):
+        return self.query("select run, metric, epoch, value, path from best_checkpoints order by run")
+
+    # lowest value of a metric of each config, as (config hash, run, epoch, value), best first - each run's lowest is
+    # found from the metrics_value index alone, then those of the runs of each config are compared
+    def best(self, metric):
+        return self.query("""select runs.config_hash, best.run, best.epoch, min(best.value) from
+                             (select run, epoch, min(value) as value from metrics where name = ? group by run) as best join runs on runs.name = best.run
+                             group by runs.config_hash order by min(best.value)""", (metric,))
+
+    def runs(self):
+        return self.query("select name, config_hash, epoch, updated from runs order by updated")
+
+    # a run of a sweep, with the values it was given of the args swept over. Its status is running until
+    # finish_sweep_run() sets it to finished, failed or stopped
+    def add_sweep_run(self, sweep, name, params):
+        self.write("insert into sweeps values (?, ?, ?, 'running', ?, null) on conflict (sweep, run) do update set params = excluded.params, status = excluded.status, started = excluded.started, finished = null",
+                   [(sweep, name, json.dumps(params, sort_keys=True), time.time())])
+
+    # the values a run of a sweep continues with, when they change while it runs e.g. in population based training
+    def update_sweep_run(self, sweep, name, params):
+        self.write("update sweeps set params = ? where sweep = ? and run = ?", [(json.dumps(params, sort_keys=True), sweep, name)])
+
+    def finish_sweep_run(self, sweep, name, status):
+        self.write("update sweeps set status = ?, finished = ? where sweep = ? and run = ?", [(status, time.time(), sweep, name)])
+
+    # the runs of a sweep as (run, params, status, epoch, value) with the lowest value of the metric and its epoch, best
+    # first and those without the metric yet last
+    def sweep(self, sweep, metric):
+        return self.query("""select sweeps.run, sweeps.params, sweeps.status, best.epoch, best.value from sweeps left join
+                             (select run, epoch, min(value) as value from metrics where name = ? group by run) as best on best.run = sweeps.run
+                             where sweeps.sweep = ? order by best.value is null, best.value""", (metric, sweep))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("command", type=str, help="best - the best epoch of each config by the metric, runs - every run, checkpoints - each run's best checkpoint, or sweep - the runs of the sweep by the metric")
+    parser.add_argument("metric", type=str, nargs='?', default="w1_10000m", help="metric to compare configs by")
+    parser.add_argument("--sweep", type=str, default="", help="name of the sweep to list the runs of")
+    parser.add_argument("--dir-path", type=str, default=dirname(realpath(__file__)), help="path where the runs' output is stored")
+    opts = parser.parse_args()
+
+    registry = Registry(opts.dir_path + "/")
+    if opts.command == 'best':
+        for row in registry.best(opts.metric):
+            print("%s  %-20s epoch %5d    %s %.6g" % (row[0], row[1], row[2], opts.metric, row[3]))
+    elif opts.command == 'runs':
+        for row in registry.runs():
+            print("%-20s %s  epochs %5s    updated %s" % (row[0], row[1], row[2], time.strftime("%Y-%m-%d %H:%M", time.localtime(row[3]))))
+    elif opts.command == 'checkpoints':
+        for row in registry.best_checkpoints():
+            print("%-20s epoch %5d    %s %.6g    %s" % (row[0], row[2], row[1], row[3], row[4]))
+    elif opts.command == 'sweep':
+        for row in registry.sweep(opts.sweep, opts.metric):
+            print("%-20s %-9s epoch %5s    %s %s    %s" % (row[0], row[2], row[3] if row[3] is not None else "-", opts.metric, "%.6g" % row[4] if row[4] is not None else "-", row[1]))
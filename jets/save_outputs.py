@@ -2,9 +2,9 @@ import numpy as np
 import torch
 import matplotlib.pyplot as plt
 import utils
+import evaluation
 from os import remove
 import mplhep as hep
-from skhep.math.vectors import LorentzVector
 
 plt.switch_backend('agg')
 
@@ -68,30 +68,8 @@ def save_sample_outputs(args, D, G, X, dist, name, epoch, losses, X_loaded=None)
     print(Xplot[0][:10])
     print(gen_out[0][:10])
 
-    real_masses = []
-    gen_masses = []
-
-    for i in range(args.num_samples):
-        jetv = LorentzVector()
-
-        for part in Xplot[i]:
-            if not args.mask or part[3] > 0:
-                vec = LorentzVector()
-                vec.setptetaphim(part[2], part[0], part[1], 0)
-                jetv += vec
-
-        real_masses.append(jetv.mass)
-
-    for i in range(args.num_samples):
-        jetv = LorentzVector()
-
-        for part in gen_out[i]:
-            if not args.mask or part[3] > 0:
-                vec = LorentzVector()
-                vec.setptetaphim(part[2], part[0], part[1], 0)
-                jetv += vec
-
-        gen_masses.append(jetv.mass)
+    real_masses = evaluation.jet_features(Xplot[:args.num_samples], mask=args.mask)[:, 0]
+    gen_masses = evaluation.jet_features(gen_out[:args.num_samples], mask=args.mask)[:, 0]
 
     if args.mask:
         Xp = Xplot[Xplot[:, :, args.node_feat_size - 1] > 0]
@@ -151,33 +129,8 @@ def save_sample_outputs(args, D, G, X, dist, name, epoch, losses, X_loaded=None)
     plt.close()
 
     if args.jf:
-        real_masses = []
-        real_pts = []
-
-        gen_masses = []
-        gen_pts = []
-
-        for i in range(args.num_samples):
-            jetv = LorentzVector()
-
-            for part in Xplot[i]:
-                vec = LorentzVector()
-                vec.setptetaphim(part[2], part[0], part[1], 0)
-                jetv += vec
-
-            real_masses.append(jetv.mass)
-            real_pts.append(jetv.pt)
-
-        for i in range(args.num_samples):
-            jetv = LorentzVector()
-
-            for part in gen_out[i]:
-                vec = LorentzVector()
-                vec.setptetaphim(part[2], part[0], part[1], 0)
-                jetv += vec
-
-            gen_masses.append(jetv.mass)
-            gen_pts.append(jetv.pt)
+        real_masses, real_pts = evaluation.jet_features(Xplot[:args.num_samples]).T
+        gen_masses, gen_pts = evaluation.jet_features(gen_out[:args.num_samples]).T
 
         mass_bins = np.arange(0, 400, 4)
         pt_bins = np.arange(0, 3000, 30)
@@ -276,9 +229,6 @@ def save_sample_outputs(args, D, G, X, dist, name, epoch, losses, X_loaded=None)
             plt.savefig(args.losses_path + name + "_w1j.pdf", bbox_inches='tight')
             plt.close()
 
-    for key in losses:
-        np.savetxt(args.losses_path + args.name + "/" + key + '.txt', losses[key])
-
     try:
         remove(args.losses_path + args.name + "/" + str(epoch - args.save_epochs) + ".pdf")
         remove(args.losses_path + args.name + "/" + str(epoch - args.save_epochs) + "_w1.pdf")
@@ -287,11 +237,3 @@ def save_sample_outputs(args, D, G, X, dist, name, epoch, losses, X_loaded=None)
         print("couldn't remove loss file")
 
     print("saved figs")
-
-
-def save_models(args, D, G, optimizers, name, epoch):
-    torch.save(D, args.model_path + args.name + "/D_" + str(epoch) + ".pt")
-    torch.save(G, args.model_path + args.name + "/G_" + str(epoch) + ".pt")
-
-    torch.save(optimizers[0].state_dict(), args.model_path + args.name + "/D_optim_" + str(epoch) + ".pt")
-    torch.save(optimizers[1].state_dict(), args.model_path + args.name + "/G_optim_" + str(epoch) + ".pt")
@@ -66,5 +66,7 @@ class SpectralNorm(nn.Module):
 
 
     def forward(self, *args):
-        self._update_u_v()
+        # the power iteration and normalization stay in fp32 under autocast
+        with torch.autocast(getattr(self.module, self.name + "_bar").device.type, enabled=False):
+            self._update_u_v()
         return self.module.forward(*args)
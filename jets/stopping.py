@@ -0,0 +1,30 @@
+# early stopping - ends training once the metric the best checkpoint is picked by (--best-metric, W1 or FID) has
+# plateaued, instead of always running to num epochs. Evaluations are noisy, so each value is first smoothed by an
+# exponential moving average, --early-stopping-smoothing being the weight of the previous average, and only improves on
+# the best smoothed value so far if it's lower by more than --early-stopping-min-delta of it. Once
+# --early-stopping-patience epochs have passed without an improvement the run saves a checkpoint and stops, with the
+# best checkpoint kept and pointed to by the manifest's 'best' and the registry. Resuming rebuilds the state from the
+# metric's values in the metrics log
+
+import math
+
+
+class EarlyStopping(object):
+    def __init__(self, patience, min_delta=0, smoothing=0):
+        self.patience = patience
+        self.min_delta = min_delta
+        self.smoothing = smoothing
+        self.smoothed = None
+        self.best = None
+        self.best_epoch = None
+
+    # adds the metric's value evaluated at the epoch, returning whether training should stop. Values which aren't
+    # finite e.g. from a diverged G never improve
+    def step(self, epoch, value):
+        if math.isfinite(value):
+            self.smoothed = value if self.smoothed is None else self.smoothing * self.smoothed + (1 - self.smoothing) * value
+            if self.best is None or self.smoothed < self.best * (1 - self.min_delta):
+                self.best, self.best_epoch = self.smoothed, epoch
+        elif self.best_epoch is None:
+            self.best_epoch = epoch
+        return epoch - self.best_epoch >= self.patience
@@ -0,0 +1,148 @@
+# where training runs on many-core CPUs - the number of threads torch uses within ops (intra-op) and to run ops in
+# parallel (inter-op), and the cores each process is pinned to. With --cpu-affinity cores the physical cores this
+# process may run on (one hardware thread of each) are split into contiguous blocks, one for each data parallel rank on
+# the host (see distributed.py), and with numa the ranks are placed on the NUMA nodes in turn, splitting a node's cores
+# between the ranks placed on it. DataLoader workers (--num-workers) run one thread each, on cores taken from the end of
+# the rank's block when it has more cores than workers. Evaluation, which only rank 0 runs while the other ranks wait,
+# widens rank 0 to all of the host's cores. Each flag can also be set in the environment, for launchers that can't
+# pass arguments to every process e.g. GRAPH_GAN_CPU_AFFINITY=numa for --cpu-affinity numa, with flags given on the
+# command line taking precedence. The benchmark's threads scenario times training steps with each setting and picks the
+# fastest
+
+import torch
+import distributed
+
+import os
+from os.path import exists
+from functools import partial
+from contextlib import contextmanager
+
+
+ENV_PREFIX = "GRAPH_GAN_"
+NODES = "/sys/devices/system/node/"
+
+
+# the flag's value set in the environment, or default
+def env_default(flag, default):
+    value = os.environ.get(ENV_PREFIX + flag.upper().replace('-', '_'))
+    return type(default)(value) if value is not None else default
+
+
+# cpus of a list like "0-3,8,10-11", as in /sys
+def parse_cpu_list(text):
+    cpus = []
+    for part in text.strip().split(','):
+        if '-' in part:
+            start, end = part.split('-')
+            cpus += range(int(start), int(end) + 1)
+        elif part:
+            cpus.append(int(part))
+    return cpus
+
+
+def read_cpu_list(path):
+    try:
+        with open(path, "r") as f:
+            return parse_cpu_list(f.read())
+    except OSError:
+        return None
+
+
+# one cpu of each physical core among the cpus given - a core's hardware threads share its execution units, so a
+# second torch thread on one rarely helps. All of them where the topology isn't known
+def physical_cores(cpus):
+    cores = []
+    seen = set()
+    for cpu in sorted(cpus):
+        siblings = read_cpu_list("/sys/devices/system/cpu/cpu%d/topology/thread_siblings_list" % cpu) or [cpu]
+        if not seen & set(siblings): cores.append(cpu)
+        seen.update(siblings)
+    return cores
+
+
+# the cpus given on each NUMA node, or all on one node where the topology isn't known
+def numa_nodes(cpus):
+    cpus = set(cpus)
+    nodes = []
+    if exists(NODES):
+        for name in sorted((name for name in os.listdir(NODES) if name.startswith('node') and name[4:].isdigit()), key=lambda name: int(name[4:])):
+            node = [cpu for cpu in read_cpu_list(NODES + name + "/cpulist") or [] if cpu in cpus]
+            if len(node): nodes.append(node)
+    return nodes if len(nodes) else [sorted(cpus)]
+
+
+# the index'th of parts contiguous blocks of cores, sharing a core when there are more parts than cores
+def block(cores, parts, index):
+    if len(cores) < parts: return [cores[index % len(cores)]]
+    size = len(cores) // parts
+    return cores[index * size:(index + 1) * size]
+
+
+# where the local_rank'th of local_world_size processes on the host, allowed to run on cpus, runs - 'cpus' to pin it
+# to (None to leave it), 'workers' the cpus to pin its DataLoader workers to (None to leave them on the process's),
+# its intra-op and inter-op threads (0 to leave torch's default) and 'host' the cpus of the whole host
+def plan(args, local_rank=0, local_world_size=1, cpus=None):
+    cpus = sorted(cpus if cpus is not None else os.sched_getaffinity(0))
+    config = {'cpus': None, 'workers': None, 'intra_op_threads': args.intra_op_threads, 'inter_op_threads': args.inter_op_threads, 'host': cpus}
+
+    if args.cpu_affinity == 'none':
+        # the ranks on a host share its cores, instead of each running a thread on every one
+        if not config['intra_op_threads'] and local_world_size > 1:
+            config['intra_op_threads'] = max(1, len(physical_cores(cpus)) // local_world_size)
+        return config
+
+    if args.cpu_affinity == 'numa':
+        nodes = numa_nodes(cpus)
+        node = local_rank % len(nodes)
+        sharing = [rank for rank in range(local_world_size) if rank % len(nodes) == node]
+        cores = block(physical_cores(nodes[node]), len(sharing), sharing.index(local_rank))
+    else:
+        cores = block(physical_cores(cpus), local_world_size, local_rank)
+
+    if args.num_workers and len(cores) > args.num_workers:
+        config['workers'] = cores[-args.num_workers:]
+        cores = cores[:-args.num_workers]
+    config['cpus'] = cores
+    if not config['intra_op_threads']: config['intra_op_threads'] = len(cores)
+    return config
+
+
+# pins this process and sets its threads as planned for its rank, returning the plan. Has to run before torch's first
+# parallel op, as the threads it starts then keep their cores and the inter-op threads can only be set once
+def apply(args):
+    config = plan(args, int(os.environ.get('LOCAL_RANK', 0)), distributed.local_world_size())
+    if config['cpus'] is not None: os.sched_setaffinity(0, config['cpus'])
+    if config['intra_op_threads']: torch.set_num_threads(config['intra_op_threads'])
+    if config['inter_op_threads']:
+        try:
+            torch.set_num_interop_threads(config['inter_op_threads'])
+        except RuntimeError:
+            print("inter-op threads already started - keeping " + str(torch.get_num_interop_threads()))
+    return config
+
+
+def init_worker(cpus, worker_id):
+    torch.set_num_threads(1)
+    if cpus is not None: os.sched_setaffinity(0, [cpus[worker_id % len(cpus)]])
+
+
+# DataLoader worker_init_fn for the plan
+def worker_init_fn(config):
+    return partial(init_worker, config['workers'])
+
+
+# widens rank 0 to all of the host's cores, with a thread on each, while the other ranks wait for it e.g. evaluating
+@contextmanager
+def widened(config):
+    if distributed.world_size() == 1 or not distributed.is_main():
+        yield
+        return
+
+    cpus, num_threads = os.sched_getaffinity(0), torch.get_num_threads()
+    os.sched_setaffinity(0, config['host'])
+    torch.set_num_threads(len(physical_cores(config['host'])))
+    try:
+        yield
+    finally:
+        os.sched_setaffinity(0, cpus)
+        torch.set_num_threads(num_threads)
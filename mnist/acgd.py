@@ -3,7 +3,52 @@ import math
 import torch
 import torch.autograd as autograd
 
-from cgd_utils import zero_grad, general_conjugate_gradient, Hvp_vec
+
+class FlatParams(object):
+    # parameters of one player stored in a single contiguous buffer, with each parameter's data and grad
+    # replaced by views into the buffers so updates and hessian vector products need no concatenation
+    def __init__(self, params, device):
+        self.params = list(params)
+        self.shapes = [p.shape for p in self.params]
+        self.sizes = [p.numel() for p in self.params]
+
+        dtype = self.params[0].dtype if len(self.params) else torch.float
+        self.data = torch.zeros(sum(self.sizes), dtype=dtype, device=device)
+        self.grad = torch.zeros_like(self.data)
+
+        self.data_views = self.views(self.data)
+        self.grad_views = self.views(self.grad)
+
+        with torch.no_grad():
+            for p, view in zip(self.params, self.data_views):
+                view.copy_(p.data)
+                p.data = view
+
+        self.attach_grads()
+
+    def views(self, flat):
+        return [v.view(shape) for v, shape in zip(flat.split(self.sizes), self.shapes)]
+
+    def buffer(self):
+        return torch.zeros_like(self.data)
+
+    def attach_grads(self):
+        for p, view in zip(self.params, self.grad_views):
+            p.grad = view
+
+    def hvp(self, grad_vec, vec_views):
+        # d(grad_vec)/d(params) * vec, accumulated in place into the zeroed grad buffer
+        self.grad.zero_()
+        outputs = [(g, v) for g, v in zip(grad_vec, vec_views) if g.requires_grad]
+        if len(outputs):
+            autograd.backward([g for g, v in outputs], grad_tensors=[v for g, v in outputs], inputs=self.params, retain_graph=True)
+        return self.grad
+
+
+# scale of x minimising the A-norm error of the scaled x as a solution of A x = b, x^T b / x^T A x, for A symmetric
+# positive definite and Ax = A x
+def a_norm_scale(x, b, Ax):
+    return (torch.dot(x, b) / torch.dot(x, Ax)).item()
 
 
 class ACGD(object):
@@ -12,25 +57,61 @@ class ACGD(object):
                  eps=1e-5, beta=0.99,
                  tol=1e-12, atol=1e-20,
                  device=torch.device('cpu'),
-                 solve_x=False, collect_info=True):
-        self.max_params = list(max_params)
-        self.min_params = list(min_params)
+                 solve_x=False, collect_info=True,
+                 max_iter=None, warm_start='previous', precondition=False):
+        self.max = FlatParams(max_params, device)
+        self.min = FlatParams(min_params, device)
+        self.max_params = self.max.params
+        self.min_params = self.min.params
         self.state = {'lr_max': lr_max, 'lr_min': lr_min,
                       'eps': eps, 'solve_x': solve_x,
                       'tol': tol, 'atol': atol,
                       'beta': beta, 'step': 0,
                       'old_max': None, 'old_min': None,  # start point of CG
-                      'sq_exp_avg_max': None, 'sq_exp_avg_min': None}  # save last update
+                      'sq_exp_avg_max': self.max.buffer(), 'sq_exp_avg_min': self.min.buffer()}  # save last update
         self.info = {'grad_x': None, 'grad_y': None,
                      'hvp_x': None, 'hvp_y': None,
                      'cg_x': None, 'cg_y': None,
-                     'time': 0, 'iter_num': 0}
+                     'time': 0, 'iter_num': 0,
+                     'residuals': [], 'iter_times': [], 'warm_start_scale': None}
         self.device = device
         self.collect_info = collect_info
 
+        # conjugate gradient budget and options - warm_start is one of none, previous or adaptive
+        self.max_iter = max_iter
+        self.warm_start = warm_start
+        self.precondition = precondition
+
+        self.max.sq_avg = self.state['sq_exp_avg_max']
+        self.min.sq_avg = self.state['sq_exp_avg_min']
+
+        # preallocated work buffers, all updated in place every step
+        for side in (self.max, self.min):
+            side.grad_d = side.buffer()
+            side.grad_d_views = side.views(side.grad_d)
+            side.lr = side.buffer()
+            side.sqrt_lr = side.buffer()
+            side.scaled_grad = side.buffer()
+            side.scaled_grad_views = side.views(side.scaled_grad)
+            side.b = side.buffer()
+            side.old = side.buffer()
+            side.update = side.buffer()
+            side.update_views = side.views(side.update)
+            # conjugate gradient
+            side.r = side.buffer()
+            side.p = side.buffer()
+            side.Ap = side.buffer()
+            side.lr_p = side.buffer()
+            side.lr_p_views = side.views(side.lr_p)
+            side.z = side.buffer()
+            side.M_inv = side.buffer()
+
     def zero_grad(self):
-        zero_grad(self.max_params)
-        zero_grad(self.min_params)
+        self.max.grad.zero_()
+        self.min.grad.zero_()
+        # in case anything replaced the grads since
+        self.max.attach_grads()
+        self.min.attach_grads()
 
     def get_info(self):
         if self.info['grad_x'] is None:
@@ -41,14 +122,110 @@ class ACGD(object):
         return self.state
 
     def load_state_dict(self, state_dict):
-        self.state.update(state_dict)
+        for key in state_dict:
+            if key in ['old_max', 'old_min'] and state_dict[key] is not None:
+                side = self.max if key == 'old_max' else self.min
+                side.old.copy_(state_dict[key])
+                self.state[key] = side.old
+            elif key in ['sq_exp_avg_max', 'sq_exp_avg_min'] and state_dict[key] is not None:
+                self.state[key].copy_(state_dict[key])
+            elif key not in ['old_max', 'old_min', 'sq_exp_avg_max', 'sq_exp_avg_min']:
+                self.state[key] = state_dict[key]
         print('Load state: {}'.format(state_dict))
 
+    def set_cg_budget(self, max_iter=None, tol=None):
+        self.max_iter = max_iter
+        if tol is not None: self.state['tol'] = tol
+
     def set_lr(self, lr_max, lr_min):
         self.state.update({'lr_max': lr_max, 'lr_min': lr_min})
         print('Maximizing side learning rate: {:.4f}\n '
               'Minimizing side learning rate: {:.4f}'.format(lr_max, lr_min))
 
+    @torch.no_grad()
+    def conjugate_gradient(self, grad_x, grad_y, x_side, y_side, x, tol, atol, nsteps=None):
+        # solves A x = b, A = I + sqrt(lr_x) * D_xy * lr_y * D_yx * sqrt(lr_x), in place in x_side.old
+        # tol is relative to the squared norm of the initial residual, nsteps defaults to the dimension of x
+        lr_x, lr_y = x_side.sqrt_lr, y_side.lr
+        b, r, p, Ap, lr_p = x_side.b, x_side.r, x_side.p, x_side.Ap, x_side.lr_p
+
+        def A(v, out):
+            torch.mul(lr_x, v, out=lr_p)
+            h_1 = y_side.hvp(grad_x, x_side.lr_p_views).mul_(lr_y)
+            h_2 = x_side.hvp(grad_y, y_side.grad_views).mul_(lr_x)
+            return torch.add(v, h_2, out=out)
+
+        warm_start_scale = 1.
+        if x is None or self.warm_start == 'none':
+            x = x_side.old.zero_()
+            r.copy_(b)
+        else:
+            A(x, Ap)
+            if self.warm_start == 'adaptive':
+                # rescale the previous solution to minimise the A-norm error along it, dropping it if it points away
+                warm_start_scale = a_norm_scale(x, b, Ap)
+                if warm_start_scale <= 0:
+                    warm_start_scale = 0.
+                    x.zero_()
+                    r.copy_(b)
+                else:
+                    x.mul_(warm_start_scale)
+                    torch.sub(b, Ap.mul_(warm_start_scale), out=r)
+            else:
+                torch.sub(b, Ap, out=r)
+
+        if nsteps is None:
+            nsteps = b.shape[0]
+
+        # diagonal preconditioner approximating the mixed hessians by outer products of the gradients,
+        # with the squared gradient averages standing in for the squared gradients
+        if self.precondition:
+            z = x_side.z
+            M_inv = torch.mul(x_side.lr, x_side.sq_avg, out=x_side.M_inv)
+            M_inv.mul_(torch.dot(y_side.lr, y_side.sq_avg)).add_(1).reciprocal_()
+            torch.mul(M_inv, r, out=z)
+        else:
+            z = r
+
+        p.copy_(z)
+        rdotr = torch.dot(r, r)
+        rdotz = torch.dot(r, z) if self.precondition else rdotr
+        residual_tol = tol * rdotr
+
+        if self.collect_info:
+            residuals = [rdotr.sqrt().item()]
+            iter_times = []
+
+        for i in range(nsteps):
+            if self.collect_info: timer = time.time()
+
+            A(p, Ap)
+
+            alpha = rdotz / torch.dot(p, Ap)
+            x.add_(torch.mul(alpha, p, out=lr_p))
+            r.sub_(torch.mul(alpha, Ap, out=lr_p))
+            if self.precondition:
+                torch.mul(M_inv, r, out=z)
+                new_rdotr = torch.dot(r, r)
+                new_rdotz = torch.dot(r, z)
+            else:
+                new_rdotr = new_rdotz = torch.dot(r, r)
+            beta = new_rdotz / rdotz
+            p.mul_(beta).add_(z)
+            rdotr, rdotz = new_rdotr, new_rdotz
+
+            if self.collect_info:
+                residuals.append(rdotr.sqrt().item())
+                iter_times.append(time.time() - timer)
+
+            if rdotr < residual_tol or rdotr < atol:
+                break
+
+        if self.collect_info:
+            self.info.update({'residuals': residuals, 'iter_times': iter_times, 'warm_start_scale': warm_start_scale})
+
+        return x, i + 1
+
     def step(self, loss):
         lr_max = self.state['lr_max']
         lr_min = self.state['lr_min']
@@ -59,88 +236,75 @@ class ACGD(object):
         time_step = self.state['step'] + 1
         self.state['step'] = time_step
 
+        X, Y = self.max, self.min
+
         grad_x = autograd.grad(loss, self.max_params, create_graph=True, retain_graph=True)
-        grad_x_vec = torch.cat([g.contiguous().view(-1) for g in grad_x])
         grad_y = autograd.grad(loss, self.min_params, create_graph=True, retain_graph=True)
-        grad_y_vec = torch.cat([g.contiguous().view(-1) for g in grad_y])
-        grad_x_vec_d = grad_x_vec.clone().detach()
-        grad_y_vec_d = grad_y_vec.clone().detach()
-
-        sq_avg_x = self.state['sq_exp_avg_max']
-        sq_avg_y = self.state['sq_exp_avg_min']
-        sq_avg_x = torch.zeros_like(grad_x_vec_d, requires_grad=False) if sq_avg_x is None else sq_avg_x
-        sq_avg_y = torch.zeros_like(grad_y_vec_d, requires_grad=False) if sq_avg_y is None else sq_avg_y
-        sq_avg_x.mul_(beta).addcmul_(1 - beta, grad_x_vec_d, grad_x_vec_d)
-        sq_avg_y.mul_(beta).addcmul_(1 - beta, grad_y_vec_d, grad_y_vec_d)
-
-        bias_correction = 1 - beta ** time_step
-        lr_max = math.sqrt(bias_correction) * lr_max / sq_avg_x.sqrt().add(eps)
-        lr_min = math.sqrt(bias_correction) * lr_min / sq_avg_y.sqrt().add(eps)
-
-        scaled_grad_x = torch.mul(lr_max, grad_x_vec_d)
-        scaled_grad_y = torch.mul(lr_min, grad_y_vec_d)
-        hvp_x_vec = Hvp_vec(grad_y_vec, self.max_params, scaled_grad_y,
-                            retain_graph=True)  # h_xy * d_y
-        hvp_y_vec = Hvp_vec(grad_x_vec, self.min_params, scaled_grad_x,
-                            retain_graph=True)  # h_yx * d_x
-        p_x = torch.add(grad_x_vec_d, - hvp_x_vec)
-        p_y = torch.add(grad_y_vec_d, hvp_y_vec)
-        if self.collect_info:
-            norm_px = torch.norm(hvp_x_vec, p=2).item()
-            norm_py = torch.norm(hvp_y_vec, p=2).item()
-            timer = time.time()
-
-        if self.state['solve_x']:
-            p_y.mul_(lr_min.sqrt())
-            cg_y, iter_num = general_conjugate_gradient(grad_x=grad_y_vec, grad_y=grad_x_vec,
-                                                        x_params=self.min_params, y_params=self.max_params,
-                                                        b=p_y, x=self.state['old_min'],
-                                                        tol=tol, atol=atol,
-                                                        lr_x=lr_min, lr_y=lr_max, device=self.device)
-            old_min = cg_y.detach_()
-            min_update = cg_y.mul(- lr_min.sqrt())
-            hcg = Hvp_vec(grad_y_vec, self.max_params, min_update).detach_()
-            hcg.add_(grad_x_vec_d)
-            max_update = hcg.mul(lr_max)
-            old_max = hcg.mul(lr_max.sqrt())
-        else:
-            p_x.mul_(lr_max.sqrt())
-            cg_x, iter_num = general_conjugate_gradient(grad_x=grad_x_vec, grad_y=grad_y_vec,
-                                                        x_params=self.max_params, y_params=self.min_params,
-                                                        b=p_x, x=self.state['old_max'],
-                                                        tol=tol, atol=atol,
-                                                        lr_x=lr_max, lr_y=lr_min, device=self.device)
-            old_max = cg_x.detach_()
-            max_update = cg_x.mul(lr_max.sqrt())
-            hcg = Hvp_vec(grad_x_vec, self.min_params, max_update).detach_()
-            hcg.add_(grad_y_vec_d)
-            min_update = hcg.mul(- lr_min)
-            old_min = hcg.mul(lr_min.sqrt())
-        self.state.update({'old_max': old_max, 'old_min': old_min,
-                           'sq_exp_avg_max': sq_avg_x, 'sq_exp_avg_min': sq_avg_y})
 
-        if self.collect_info:
-            timer = time.time() - timer
-            self.info.update({'time': timer, 'iter_num': iter_num,
-                              'hvp_x': norm_px, 'hvp_y': norm_py})
-
-        index = 0
-        for p in self.max_params:
-            p.data.add_(max_update[index: index + p.numel()].reshape(p.shape))
-            index += p.numel()
-        assert index == max_update.numel(), 'Maximizer CG size mismatch'
-
-        index = 0
-        for p in self.min_params:
-            p.data.add_(min_update[index: index + p.numel()].reshape(p.shape))
-            index += p.numel()
-        assert index == min_update.numel(), 'Minimizer CG size mismatch'
+        with torch.no_grad():
+            torch._foreach_copy_(X.grad_d_views, grad_x)
+            torch._foreach_copy_(Y.grad_d_views, grad_y)
 
-        if self.collect_info:
-            norm_gx = torch.norm(grad_x_vec, p=2).item()
-            norm_gy = torch.norm(grad_y_vec, p=2).item()
-            norm_cgx = torch.norm(max_update, p=2).item()
-            norm_cgy = torch.norm(min_update, p=2).item()
-            self.info.update({'grad_x': norm_gx, 'grad_y': norm_gy,
-                              'cg_x': norm_cgx, 'cg_y': norm_cgy})
+            sq_avg_x = self.state['sq_exp_avg_max']
+            sq_avg_y = self.state['sq_exp_avg_min']
+            sq_avg_x.mul_(beta).addcmul_(X.grad_d, X.grad_d, value=1 - beta)
+            sq_avg_y.mul_(beta).addcmul_(Y.grad_d, Y.grad_d, value=1 - beta)
+
+            # same operations as scalar / tensor
+            bias_correction = 1 - beta ** time_step
+            torch.sqrt(sq_avg_x, out=X.lr).add_(eps).reciprocal_().mul_(math.sqrt(bias_correction) * lr_max)
+            torch.sqrt(sq_avg_y, out=Y.lr).add_(eps).reciprocal_().mul_(math.sqrt(bias_correction) * lr_min)
+            torch.sqrt(X.lr, out=X.sqrt_lr)
+            torch.sqrt(Y.lr, out=Y.sqrt_lr)
+
+            torch.mul(X.lr, X.grad_d, out=X.scaled_grad)
+            torch.mul(Y.lr, Y.grad_d, out=Y.scaled_grad)
+            hvp_x_vec = X.hvp(grad_y, Y.scaled_grad_views)  # h_xy * d_y
+            torch.sub(X.grad_d, hvp_x_vec, out=X.b)
+            if self.collect_info: norm_px = torch.norm(hvp_x_vec, p=2).item()
+            hvp_y_vec = Y.hvp(grad_x, X.scaled_grad_views)  # h_yx * d_x
+            torch.add(Y.grad_d, hvp_y_vec, out=Y.b)
+            if self.collect_info:
+                norm_py = torch.norm(hvp_y_vec, p=2).item()
+                timer = time.time()
+
+            if self.state['solve_x']:
+                Y.b.mul_(Y.sqrt_lr)
+                cg_y, iter_num = self.conjugate_gradient(grad_x=grad_y, grad_y=grad_x,
+                                                         x_side=Y, y_side=X, x=self.state['old_min'],
+                                                         tol=tol, atol=atol, nsteps=self.max_iter)
+                old_min = cg_y
+                torch.mul(cg_y, Y.sqrt_lr, out=Y.update).neg_()
+                hcg = X.hvp(grad_y, Y.update_views)
+                hcg.add_(X.grad_d)
+                torch.mul(hcg, X.lr, out=X.update)
+                old_max = torch.mul(hcg, X.sqrt_lr, out=X.old)
+            else:
+                X.b.mul_(X.sqrt_lr)
+                cg_x, iter_num = self.conjugate_gradient(grad_x=grad_x, grad_y=grad_y,
+                                                         x_side=X, y_side=Y, x=self.state['old_max'],
+                                                         tol=tol, atol=atol, nsteps=self.max_iter)
+                old_max = cg_x
+                torch.mul(cg_x, X.sqrt_lr, out=X.update)
+                hcg = Y.hvp(grad_x, X.update_views)
+                hcg.add_(Y.grad_d)
+                torch.mul(hcg, Y.lr, out=Y.update).neg_()
+                old_min = torch.mul(hcg, Y.sqrt_lr, out=Y.old)
+            self.state.update({'old_max': old_max, 'old_min': old_min})
+
+            if self.collect_info:
+                timer = time.time() - timer
+                self.info.update({'time': timer, 'iter_num': iter_num,
+                                  'hvp_x': norm_px, 'hvp_y': norm_py})
+
+            X.data.add_(X.update)
+            Y.data.add_(Y.update)
+
+            if self.collect_info:
+                norm_gx = torch.norm(X.grad_d, p=2).item()
+                norm_gy = torch.norm(Y.grad_d, p=2).item()
+                norm_cgx = torch.norm(X.update, p=2).item()
+                norm_cgy = torch.norm(Y.update, p=2).item()
+                self.info.update({'grad_x': norm_gx, 'grad_y': norm_gy,
+                                  'cg_x': norm_cgx, 'cg_y': norm_cgy})
         self.state['solve_x'] = False if self.state['solve_x'] else True
@@ -0,0 +1,777 @@
+# CPU micro-benchmarks for the training step
+# e.g. python benchmark.py gp -- --gp 10 --batch-size 32
+# everything after -- is passed to main.parse_args to set the model config
+# --json saves the results, and --baseline compares them with saved ones, flagging (and exiting with an error on) regressions
+
+import torch
+import torch.nn.functional as F
+from model import Graph_GAN
+import utils
+from main import parse_args
+from acgd import ACGD, a_norm_scale
+from ema import EMA
+import checkpoint
+import export
+import registry
+import profiling
+import evaluation
+import save_outputs
+import estimate
+import threads
+from torch.distributions.normal import Normal
+
+import numpy as np
+import matplotlib.pyplot as plt
+
+import torch.optim as optim
+
+import io
+import os
+import sys
+import json
+import time
+import itertools
+import contextlib
+import argparse
+import tempfile
+import subprocess
+import threading
+from copy import deepcopy
+from os.path import dirname, realpath
+
+
+def bench_args(argv):
+    args = parse_args(argv)
+    args.device = torch.device('cpu')
+    return args
+
+
+# setup, if given, runs untimed before every call
+def timeit(fn, iters, warmup, setup=None):
+    for i in range(warmup):
+        if setup is not None: setup()
+        fn()
+
+    times = []
+    for i in range(iters):
+        if setup is not None: setup()
+        start = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - start)
+
+    times.sort()
+    return {'median_ms': 1000 * times[len(times) // 2], 'min_ms': 1000 * times[0]}
+
+
+def random_data(args, batch_size):
+    return (torch.rand(batch_size, args.num_hits, args.node_feat_size) - 0.5).to(args.device)
+
+
+def critic_step_fn(args, D, G, data, normal_dist):
+    D_optimizer = optim.Adam(D.parameters(), lr=args.lr_disc)
+    Y_real = torch.ones(args.batch_size, 1).to(args.device)
+    Y_fake = torch.zeros(args.batch_size, 1).to(args.device)
+    step = [0]
+
+    def critic_step():
+        D.train()
+        D_optimizer.zero_grad()
+        gen_data = utils.gen(args, G, normal_dist, args.batch_size)
+        D_real_output = D(data.clone())
+        D_fake_output = D(gen_data)
+        D_loss, D_loss_items = utils.calc_D_loss(args, D, data, gen_data, D_real_output, D_fake_output, args.batch_size, Y_real, Y_fake, step=step[0])
+        D_loss.backward()
+        D_optimizer.step()
+        step[0] += 1
+
+    return critic_step
+
+
+def bench_gp(args, opts):
+    """critic step cost without the gradient penalty, with the full penalty, and with lazy and sub-batch penalties"""
+    torch.manual_seed(4)
+    G = Graph_GAN(gen=True, args=deepcopy(args)).to(args.device)
+    D = Graph_GAN(gen=False, args=deepcopy(args)).to(args.device)
+    normal_dist = Normal(torch.tensor(0.).to(args.device), torch.tensor(args.sd).to(args.device))
+    data = random_data(args, args.batch_size)
+
+    gp = args.gp if args.gp else 10
+    settings = [('no gp', 0, 1, 0), ('gp', gp, 1, 0), ('gp every ' + str(opts.gp_every), gp, opts.gp_every, 0), ('gp batch ' + str(opts.gp_batch_size), gp, 1, opts.gp_batch_size)]
+
+    results = {}
+    for name, gp_weight, gp_every, gp_batch_size in settings:
+        args.gp, args.gp_every, args.gp_batch_size = gp_weight, gp_every, gp_batch_size
+        # lazy settings are timed over whole gp_every cycles so the average includes the penalty steps
+        results[name] = timeit(critic_step_fn(args, D, G, data, normal_dist), opts.iters * gp_every, opts.warmup * gp_every)
+
+    return results
+
+
+def generator_step_fn(args, D, G, data, normal_dist):
+    D_optimizer = optim.Adam(D.parameters(), lr=args.lr_disc)
+    G_optimizer = optim.Adam(G.parameters(), lr=args.lr_gen)
+    Y_real = torch.ones(args.batch_size, 1).to(args.device)
+    Y_fake = torch.zeros(args.batch_size, 1).to(args.device)
+
+    def generator_step():
+        G.train()
+        G_optimizer.zero_grad()
+        gen_data = utils.gen(args, G, normal_dist, args.batch_size)
+        D_unrolled = utils.unrolled_D(args, D, D_optimizer, data, gen_data, Y_real, Y_fake) if args.unrolled_steps > 0 else D
+        G_loss = utils.calc_G_loss(args, D_unrolled(gen_data), Y_real)
+        G_loss.backward()
+        G_optimizer.step()
+
+    return generator_step
+
+
+def bench_unrolled(args, opts):
+    """generator step cost for increasing numbers of functional unrolled D steps"""
+    torch.manual_seed(4)
+    G = Graph_GAN(gen=True, args=deepcopy(args)).to(args.device)
+    D = Graph_GAN(gen=False, args=deepcopy(args)).to(args.device)
+    normal_dist = Normal(torch.tensor(0.).to(args.device), torch.tensor(args.sd).to(args.device))
+    data = random_data(args, args.batch_size)
+
+    results = {}
+    for unrolled_steps in [0] + list(range(2, opts.max_unrolled_steps + 1)):
+        args.unrolled_steps = unrolled_steps
+        results['unrolled steps ' + str(unrolled_steps)] = timeit(generator_step_fn(args, D, G, data, normal_dist), opts.iters, opts.warmup)
+
+    return results
+
+
+# the adaptive warm start's rescaled previous solution is never further from the solution in the A-norm than the
+# unscaled one, on a small symmetric positive definite system like ACGD's, I plus a Gram matrix
+def check_warm_start_scale():
+    generator = torch.Generator().manual_seed(4)
+    M = torch.randn(16, 4, generator=generator, dtype=torch.float64)
+    A = torch.eye(16, dtype=torch.float64) + M @ M.T
+    solution = torch.randn(16, generator=generator, dtype=torch.float64)
+    b = A @ solution
+
+    def error(x):
+        return torch.dot(x - solution, A @ (x - solution)).item()
+
+    for x in [solution + 0.5 * torch.randn(16, generator=generator, dtype=torch.float64), 3 * solution, -solution]:
+        scale = max(a_norm_scale(x, b, A @ x), 0)
+        assert error(scale * x) <= error(x) + 1e-9, "adaptive warm start's A-norm error is worse than the unscaled start's"
+
+
+def bench_acgd(args, opts):
+    """ACGD step on Graph_GAN G and D, including the conjugate gradient solve, for a few solver budgets"""
+    check_warm_start_scale()
+    normal_dist = Normal(torch.tensor(0.).to(args.device), torch.tensor(args.sd).to(args.device))
+    data = random_data(args, args.batch_size)
+    Y_real = torch.ones(args.batch_size, 1).to(args.device)
+    Y_fake = torch.zeros(args.batch_size, 1).to(args.device)
+
+    settings = [('default', {}), ('max iter ' + str(opts.cg_max_iter), {'max_iter': opts.cg_max_iter}),
+                ('adaptive warm start', {'warm_start': 'adaptive'}), ('preconditioned', {'precondition': True})]
+
+    results = {}
+    for name, kwargs in settings:
+        torch.manual_seed(4)
+        G = Graph_GAN(gen=True, args=deepcopy(args)).to(args.device)
+        D = Graph_GAN(gen=False, args=deepcopy(args)).to(args.device)
+        # spectral norm's power iteration vectors are parameters which don't require grad
+        optimizer = ACGD(max_params=[p for p in G.parameters() if p.requires_grad], min_params=[p for p in D.parameters() if p.requires_grad], lr_max=args.lr_gen, lr_min=args.lr_disc, device=args.device, **kwargs)
+        infos = []
+
+        def acgd_step():
+            optimizer.zero_grad()
+            gen_data = utils.gen(args, G, normal_dist, args.batch_size)
+            D_loss, D_loss_items = utils.calc_D_loss(args, D, data, gen_data, D(data.clone()), D(gen_data), args.batch_size, Y_real, Y_fake)
+            optimizer.step(loss=D_loss)
+            infos.append(dict(optimizer.get_info()))
+
+        results[name] = timeit(acgd_step, opts.iters, opts.warmup)
+        results[name]['cg_iters'] = sum(info['iter_num'] for info in infos) / len(infos)
+        results[name]['cg_final_rel_residual'] = sum(info['residuals'][-1] / info['residuals'][0] for info in infos) / len(infos)
+
+    return results
+
+
+def bench_ema(args, opts):
+    """G weights EMA update against a full critic + generator training step - the update should cost under 1% of the step"""
+    torch.manual_seed(4)
+    G = Graph_GAN(gen=True, args=deepcopy(args)).to(args.device)
+    D = Graph_GAN(gen=False, args=deepcopy(args)).to(args.device)
+    normal_dist = Normal(torch.tensor(0.).to(args.device), torch.tensor(args.sd).to(args.device))
+    data = random_data(args, args.batch_size)
+    G_ema = EMA(G, args.ema_decay)
+
+    critic_step = critic_step_fn(args, D, G, data, normal_dist)
+    generator_step = generator_step_fn(args, D, G, data, normal_dist)
+
+    def training_step():
+        critic_step()
+        generator_step()
+
+    results = {'training step': timeit(training_step, opts.iters, opts.warmup), 'ema update': timeit(G_ema.update, opts.iters * 10, opts.warmup)}
+    results['ema update']['step_fraction'] = results['ema update']['median_ms'] / results['training step']['median_ms']
+    if results['ema update']['step_fraction'] >= 0.01: print("WARNING: ema update costs more than 1% of a training step")
+
+    return results
+
+
+def bench_checkpoint(args, opts):
+    """time training is blocked per save - pickling the modules synchronously against the background state_dict writer"""
+    torch.manual_seed(4)
+    G = Graph_GAN(gen=True, args=deepcopy(args)).to(args.device)
+    D = Graph_GAN(gen=False, args=deepcopy(args)).to(args.device)
+    optimizers = (optim.Adam(D.parameters(), lr=args.lr_disc), optim.Adam(G.parameters(), lr=args.lr_gen))
+    generator_step_fn(args, D, G, random_data(args, args.batch_size), Normal(torch.tensor(0.).to(args.device), torch.tensor(args.sd).to(args.device)))()  # so the optimizer state is populated
+    G_ema = EMA(G, args.ema_decay)
+
+    with tempfile.TemporaryDirectory() as dir:
+        args.model_path, args.name = dir + "/", "bench"
+        os.mkdir(dir + "/bench")
+
+        def pickled_save():
+            torch.save(D, dir + "/D.pt")
+            torch.save(G, dir + "/G.pt")
+            torch.save(optimizers[0].state_dict(), dir + "/D_optim.pt")
+            torch.save(optimizers[1].state_dict(), dir + "/G_optim.pt")
+
+        writer = checkpoint.CheckpointWriter(args)
+        epoch = [0]
+
+        def background_save():
+            epoch[0] += 1
+            writer.save(epoch[0], D, G, optimizers, G_ema=G_ema)
+
+        results = {'pickled': timeit(pickled_save, opts.iters, opts.warmup)}
+        # waiting for the previous write before each timed save, so only the snapshot is measured rather than queueing behind it
+        results['background'] = timeit(background_save, opts.iters, opts.warmup, setup=writer.wait)
+        results['background write'] = timeit(lambda: (background_save(), writer.wait()), opts.iters, opts.warmup)
+
+        G_loaded, D_loaded = checkpoint.load_models(args, checkpoint.load(dir + "/bench/", checkpoint.latest_epoch(dir + "/bench/")))
+        assert all(torch.equal(a, b) for a, b in zip(G.state_dict().values(), G_loaded.state_dict().values())), "loaded G doesn't match"
+
+    return results
+
+
+def dir_size(path):
+    return sum(os.path.getsize(os.path.join(dir, f)) for dir, dirs, files in os.walk(path) for f in files)
+
+
+def bench_checkpoint_storage(args, opts):
+    """disk usage and background write time over a run of saves every 5 epochs, keeping every pickled checkpoint against the
+    deduplicated store with its retention policy, at full and half precision - the weights get a random optimizer step between saves"""
+    torch.manual_seed(4)
+    G = Graph_GAN(gen=True, args=deepcopy(args)).to(args.device)
+    D = Graph_GAN(gen=False, args=deepcopy(args)).to(args.device)
+    params = list(D.parameters()) + list(G.parameters())
+    optimizers = (optim.Adam(D.parameters(), lr=args.lr_disc), optim.Adam(G.parameters(), lr=args.lr_gen))
+    G_ema = EMA(G, args.ema_decay)
+
+    def train():
+        for p in params: p.grad = torch.randn_like(p)
+        for optimizer in optimizers: optimizer.step()
+        G_ema.update()
+
+    results = {}
+    with tempfile.TemporaryDirectory() as dir:
+        def pickled_save():
+            train()
+            torch.save(D, dir + "/D.pt")
+            torch.save(G, dir + "/G.pt")
+            torch.save(optimizers[0].state_dict(), dir + "/D_optim.pt")
+            torch.save(optimizers[1].state_dict(), dir + "/G_optim.pt")
+
+        # every pickled checkpoint is the same size, so the run's usage is one checkpoint's times the number of saves
+        results['pickled'] = timeit(pickled_save, opts.iters, opts.warmup)
+        results['pickled']['disk_mb'] = dir_size(dir) * opts.ckpt_saves / 1e6
+        results['pickled']['kept'] = opts.ckpt_saves
+
+    for name, dtype, compression in [('store', 'float32', 'none'), ('store fp16 zlib', 'float16', 'zlib')]:
+        with tempfile.TemporaryDirectory() as dir:
+            args.model_path, args.name = dir + "/", "bench"
+            args.ckpt_dtype, args.ckpt_compression = dtype, compression
+            os.mkdir(dir + "/bench")
+            writer = checkpoint.CheckpointWriter(args)
+            epoch = [0]
+
+            def save():
+                train()
+                epoch[0] += 5
+                if writer.best_metric is not None: writer.record_metric(epoch[0], writer.best_metric, torch.rand(1).item())
+                writer.save(epoch[0], D, G, optimizers, G_ema=G_ema)
+                writer.wait()
+
+            results[name] = timeit(save, opts.ckpt_saves, 0)
+            results[name]['disk_mb'] = dir_size(dir) / 1e6
+            results[name]['kept'] = len(checkpoint.read_manifest(dir + "/bench/")['epochs'])
+
+    return results
+
+
+# run in a fresh interpreter, from the model's directory so the pickled G can be unpickled, timed from before importing torch.
+# {path} is replaced with the saved G and {noise} with the shape of a sample's noise
+first_sample = {
+    'pickled': """
+import time
+start = time.perf_counter()
+import torch
+G = torch.load("{path}", weights_only=False)
+G.eval()
+G(torch.randn({noise}))
+print(time.perf_counter() - start)
+""",
+    'exported': """
+import time
+start = time.perf_counter()
+import torch
+import export
+G = export.load_generator("{path}")
+G(torch.randn({noise}))
+print(time.perf_counter() - start)
+"""}
+
+
+def bench_load(args, opts):
+    """time to the first sample from a saved G in a new process, unpickling the whole module against the exported
+    weights-only files, and the time to load G alone in this process (with torch already imported) for each"""
+    torch.manual_seed(4)
+    G = Graph_GAN(gen=True, args=deepcopy(args))
+    noise = (1, args.num_hits, args.latent_node_size if args.latent_node_size else args.hidden_node_size)
+
+    with tempfile.TemporaryDirectory() as dir:
+        paths = {'pickled': dir + "/G.pt", 'exported': dir + "/" + export.generator_name(0)}
+        torch.save(G, paths['pickled'])
+        export.save_generator(paths['exported'], G.state_dict(), checkpoint.args_dict(args))
+
+        loads = {'pickled': lambda: torch.load(paths['pickled'], weights_only=False), 'exported': lambda: export.load_generator(paths['exported'])}
+        x = torch.randn(noise)
+        G.eval()
+        assert torch.equal(G(x), loads['exported']()(x)), "exported G doesn't match"
+
+        def run(name):
+            script = first_sample[name].replace("{path}", paths[name]).replace("{noise}", str(noise))
+            out = subprocess.run([sys.executable, "-c", script], cwd=dirname(realpath(__file__)), check=True, capture_output=True).stdout
+            return float(out.decode().split()[-1])
+
+        # alternating between the two so they're equally affected by anything else running
+        times = {'pickled': [], 'exported': []}
+        for i in range(opts.iters):
+            for name in times: times[name].append(run(name))
+
+        results = {}
+        for name in times:
+            times[name].sort()
+            results[name + ' first sample'] = {'median_ms': 1000 * times[name][len(times[name]) // 2], 'min_ms': 1000 * times[name][0]}
+            results[name + ' load'] = timeit(loads[name], opts.iters, opts.warmup)
+
+    results['exported first sample']['speedup'] = results['pickled first sample']['median_ms'] / results['exported first sample']['median_ms']
+    return results
+
+
+def bench_registry(args, opts):
+    """time to log an epoch's metrics to the registry with runs writing at the same time from separate threads (each
+    write on its own connection, as from separate processes), and to query the best epoch of each config once they're done"""
+    with tempfile.TemporaryDirectory() as dir:
+        runs = registry.Registry(dir + "/")
+        times = []
+
+        # 10 configs differing in learning rate, with the rest of the runs repeats of them
+        def run(r):
+            name = "run" + str(r)
+            runs.register_run(name, dict(checkpoint.args_dict(args), lr_gen=args.lr_gen * (1 + r % 10)))
+            for epoch in range(opts.registry_epochs):
+                start = time.perf_counter()
+                runs.log_metrics(name, epoch + 1, {'D': torch.rand(1).item(), 'G': torch.rand(1).item(), 'fid': torch.rand(1).item()})
+                times.append(time.perf_counter() - start)
+
+        threads = [threading.Thread(target=run, args=(r,)) for r in range(opts.registry_runs)]
+        for thread in threads: thread.start()
+        for thread in threads: thread.join()
+
+        times.sort()
+        results = {'log epoch': {'median_ms': 1000 * times[len(times) // 2], 'min_ms': 1000 * times[0], 'max_ms': 1000 * times[-1]}}
+        results['best per config'] = timeit(lambda: runs.best('fid'), opts.iters, opts.warmup)
+        results['best per config']['configs'] = len(runs.best('fid'))
+        results['runs'] = timeit(runs.runs, opts.iters, opts.warmup)
+        results['runs']['rows'] = len(runs.runs())
+
+    return results
+
+
+def bench_layers(args, opts):
+    """time, FLOPs and memory of each message passing stage of G and D in a training step, from a LayerProfiler, and
+    the step with and without it attached - unattached it should cost nothing"""
+    torch.manual_seed(4)
+    G = Graph_GAN(gen=True, args=deepcopy(args)).to(args.device)
+    D = Graph_GAN(gen=False, args=deepcopy(args)).to(args.device)
+    normal_dist = Normal(torch.tensor(0.).to(args.device), torch.tensor(args.sd).to(args.device))
+    data = random_data(args, args.batch_size)
+
+    critic_step = critic_step_fn(args, D, G, data, normal_dist)
+    generator_step = generator_step_fn(args, D, G, data, normal_dist)
+
+    def training_step():
+        critic_step()
+        generator_step()
+
+    results = {'training step': timeit(training_step, opts.iters, opts.warmup)}
+
+    profiler = profiling.LayerProfiler()
+    profiler.attach(G)
+    profiler.attach(D)
+    training_step()
+    profiler.reset()
+    results['profiled step'] = timeit(training_step, opts.iters, 0)
+    profiler.detach()
+    results['training step again'] = timeit(training_step, opts.iters, opts.warmup)
+
+    print(profiler.summary())
+    return results
+
+
+def grid_argv(opts):
+    norms = {'none': [], 'spectral': ['--spectral-norm-gen', '--spectral-norm-disc'], 'batch': ['--batch-norm-gen', '--batch-norm-disc'], 'both': ['--spectral-norm-gen', '--spectral-norm-disc', '--batch-norm-gen', '--batch-norm-disc']}
+    for num_hits, batch_size, hidden_node_size, mp_iters, norm in itertools.product(opts.grid_num_hits, opts.grid_batch_size, opts.grid_hidden_node_size, opts.grid_mp_iters, opts.grid_norm):
+        name = "num hits %d batch %d hidden %d mp %d %s norm" % (num_hits, batch_size, hidden_node_size, mp_iters, norm)
+        yield name, ['--num-hits', str(num_hits), '--batch-size', str(batch_size), '--hidden-node-size', str(hidden_node_size), '--mp-iters', str(mp_iters)] + norms[norm]
+
+
+# G and D with inputs for each - noise or graphs
+def models_and_inputs(args):
+    torch.manual_seed(4)
+    # the module lists printed by Graph_GAN would bury the results
+    with contextlib.redirect_stdout(io.StringIO()):
+        G = Graph_GAN(gen=True, args=deepcopy(args)).to(args.device).train()
+        D = Graph_GAN(gen=False, args=deepcopy(args)).to(args.device).train()
+    G.activation_checkpointing = D.activation_checkpointing = args.activation_checkpointing
+    G.precision = D.precision = args.precision
+    noise = torch.randn(args.batch_size, args.num_hits, args.latent_node_size if args.latent_node_size else args.hidden_node_size).to(args.device)
+    return [('G', G, noise), ('D', D, random_data(args, args.batch_size))]
+
+
+def bench_models(args, opts):
+    """forward and forward + backward time and peak memory of G and D over a grid of sizes and normalizations. Forward
+    passes record autograd graphs as in training"""
+    results = {}
+    for name, argv in grid_argv(opts):
+        args = bench_args(opts.model_argv + argv)
+        for model, M, x in models_and_inputs(args):
+            passes = {'forward': lambda: M(x), 'forward + backward': lambda: M(x).mean().backward()}
+            for pass_name, fn in passes.items():
+                result = timeit(fn, opts.iters, opts.warmup)
+                peak = profiling.peak_memory(fn, args.device)
+                if peak is not None: result['peak_mb'] = peak / 2 ** 20
+                results[name + " " + model + " " + pass_name] = result
+                M.zero_grad()
+
+    return results
+
+
+def bench_estimate(args, opts):
+    """estimate.py's estimates over the models scenario's grid against built models - the parameter count, and the
+    FLOPs and activations kept of a forward pass counted by a LayerProfiler, and the peak memory of a forward + backward
+    pass - as ratios of estimated to measured, with the time the estimate takes"""
+    results = {}
+    for name, argv in grid_argv(opts):
+        args = bench_args(opts.model_argv + argv)
+        for model, M, x in models_and_inputs(args):
+            result = timeit(lambda: estimate.estimate(model == 'G', args), opts.iters, opts.warmup)
+            cost = estimate.estimate(model == 'G', args)
+            result['parameters_ratio'] = cost['parameters'] / sum(parameter.numel() for parameter in M.parameters() if parameter.requires_grad)
+
+            profiler = profiling.LayerProfiler()
+            profiler.attach(M)
+            M(x)
+            profiler.detach()
+            result['flops_ratio'] = sum(stage['forward_flops'] for stage in cost['stages'].values()) / sum(record['flops'] for record in profiler.records.values())
+            # the profiler's saved tensor hooks take the place of activation checkpointing's, so it counts everything kept without it
+            result['saved_ratio'] = estimate.estimate(model == 'G', args, checkpointing='none')['saved'] / sum(record['saved'] for record in profiler.records.values())
+
+            peak = profiling.peak_memory(lambda: M(x).mean().backward(), args.device)
+            if peak is not None: result['peak_ratio'] = cost['peak'] / peak
+            results[name + " " + model] = result
+
+    return results
+
+
+def bench_activation_checkpointing(args, opts):
+    """forward + backward time and peak memory of G and D over the models scenario's grid with each activation
+    checkpointing mode, with their ratios to those without checkpointing - the time recomputing activations costs for
+    the memory it saves"""
+    results = {}
+    for name, argv in grid_argv(opts):
+        baseline = {}
+        for mode in ['none', 'edges', 'iterations']:
+            args = bench_args(opts.model_argv + argv + ['--activation-checkpointing', mode])
+            for model, M, x in models_and_inputs(args):
+                fn = lambda: M(x).mean().backward()
+                result = timeit(fn, opts.iters, opts.warmup)
+                peak = profiling.peak_memory(fn, args.device)
+                if peak is not None: result['peak_mb'] = peak / 2 ** 20
+                M.zero_grad()
+
+                if mode == 'none': baseline[model] = result
+                else:
+                    result['time_ratio'] = result['median_ms'] / baseline[model]['median_ms']
+                    if peak is not None: result['peak_ratio'] = result['peak_mb'] / baseline[model]['peak_mb']
+                results[name + " " + model + " " + mode + " checkpointing"] = result
+
+    return results
+
+
+def bench_precision(args, opts):
+    """G and D training steps (least squares loss, RMSprop) in fp32 and with bf16 autocast over the models scenario's
+    grid, from the same initialization on the same random batches - the time per step, and as a stability check how far
+    the bf16 losses drift from the fp32 ones (the mean absolute difference relative to the mean fp32 loss) and whether
+    they all stayed finite"""
+    results = {}
+    for name, argv in grid_argv(opts):
+        baseline = {}
+        for precision in ['fp32', 'bf16']:
+            args = bench_args(opts.model_argv + argv + ['--precision', precision])
+            (g, G, noise), (d, D, x) = models_and_inputs(args)
+            G_optimizer = optim.RMSprop(G.parameters(), lr=args.lr_gen)
+            D_optimizer = optim.RMSprop(D.parameters(), lr=args.lr_disc)
+            ones = torch.ones(args.batch_size, 1).to(args.device)
+            zeros = torch.zeros(args.batch_size, 1).to(args.device)
+
+            torch.manual_seed(5)
+            batches = [(random_data(args, args.batch_size), torch.randn_like(noise)) for i in range(opts.precision_steps)]
+            losses = {'D': [], 'G': []}
+            times = []
+            for data, noise in batches:
+                start = time.perf_counter()
+                D_optimizer.zero_grad()
+                D_loss = F.mse_loss(D(data), ones) + F.mse_loss(D(G(noise).detach()), zeros)
+                D_loss.backward()
+                D_optimizer.step()
+
+                G_optimizer.zero_grad()
+                G_loss = F.mse_loss(D(G(noise)), ones)
+                G_loss.backward()
+                G_optimizer.step()
+                times.append(time.perf_counter() - start)
+
+                losses['D'].append(D_loss.item())
+                losses['G'].append(G_loss.item())
+
+            times.sort()
+            result = {'median_ms': 1000 * times[len(times) // 2], 'min_ms': 1000 * times[0]}
+            if precision == 'fp32': baseline = dict(losses, median_ms=result['median_ms'])
+            else:
+                result['time_ratio'] = result['median_ms'] / baseline['median_ms']
+                for key in ['D', 'G']:
+                    result[key + '_drift'] = np.mean(np.abs(np.array(losses[key]) - baseline[key])) / np.mean(np.abs(baseline[key]))
+                result['finite'] = float(np.isfinite(losses['D'] + losses['G']).all())
+            results[name + " " + precision] = result
+
+    return results
+
+
+# a G and D training step (least squares loss, RMSprop) on random data, as in the precision scenario
+def training_step_fn(args):
+    (g, G, noise), (d, D, x) = models_and_inputs(args)
+    G_optimizer = optim.RMSprop(G.parameters(), lr=args.lr_gen)
+    D_optimizer = optim.RMSprop(D.parameters(), lr=args.lr_disc)
+    ones = torch.ones(args.batch_size, 1).to(args.device)
+    zeros = torch.zeros(args.batch_size, 1).to(args.device)
+
+    def training_step():
+        D_optimizer.zero_grad()
+        F.mse_loss(D(x), ones).backward()
+        F.mse_loss(D(G(noise).detach()), zeros).backward()
+        D_optimizer.step()
+
+        G_optimizer.zero_grad()
+        F.mse_loss(D(G(noise)), ones).backward()
+        G_optimizer.step()
+
+    return training_step
+
+
+# times training steps of the config in argv in a new process, with its thread settings applied first
+training_steps = """
+import sys
+import json
+import threads
+from benchmark import bench_args, timeit, training_step_fn
+args = bench_args(sys.argv[1:])
+threads.apply(args)
+print(json.dumps(timeit(training_step_fn(args), {iters}, {warmup})))
+"""
+
+
+def bench_threads(args, opts):
+    """G and D training steps per second of the config with each thread setting (see threads.py) - intra-op threads
+    (by default powers of two up to the physical cores), inter-op threads and CPU affinities (by default none, cores and,
+    on more than one NUMA node, numa) - each timed in a new process, as torch's inter-op threads can only be set once and
+    its intra-op threads keep the cores they start on. The fastest setting is marked best"""
+    cpus = os.sched_getaffinity(0)
+    cores = len(threads.physical_cores(cpus))
+    intra_op = opts.threads_intra_op or sorted(set([2 ** i for i in range(cores.bit_length())] + [cores]))
+    affinities = opts.threads_affinity or ['none', 'cores'] + (['numa'] if len(threads.numa_nodes(cpus)) > 1 else [])
+
+    results = {}
+    for intra_op_threads, inter_op_threads, affinity in itertools.product(intra_op, opts.threads_inter_op, affinities):
+        argv = opts.model_argv + ['--intra-op-threads', str(intra_op_threads), '--inter-op-threads', str(inter_op_threads), '--cpu-affinity', affinity]
+        script = training_steps.replace("{iters}", str(opts.iters)).replace("{warmup}", str(opts.warmup))
+        out = subprocess.run([sys.executable, "-c", script] + argv, cwd=dirname(realpath(__file__)), check=True, capture_output=True).stdout
+        result = json.loads(out.decode().strip().split("\n")[-1])
+        result['steps_per_s'] = 1000 / result['median_ms']
+        results["intra %d inter %d %s" % (intra_op_threads, inter_op_threads, affinity)] = result
+
+    best = max(results, key=lambda key: results[key]['steps_per_s'])
+    results[best]['best'] = 1
+    return results
+
+
+# replaces each (object, attribute) function with one timing its calls as the stage, restoring them on exit
+@contextlib.contextmanager
+def staged(timer, patches):
+    def timed(fn, stage):
+        def call(*args, **kwargs):
+            with timer.phase(stage):
+                return fn(*args, **kwargs)
+        return call
+
+    originals = [(obj, attr, getattr(obj, attr)) for obj, attr, stage in patches]
+    for obj, attr, stage in patches:
+        setattr(obj, attr, timed(getattr(obj, attr), stage))
+    try:
+        yield
+    finally:
+        for obj, attr, fn in originals:
+            setattr(obj, attr, fn)
+
+
+# time of fn and of each of its stages per call, with the rest of its time as the remainder stage, and the peak memory
+# of its first call, which is untimed as it also loads what's only loaded once e.g. fonts
+def time_stages(fn, patches, remainder, iters, device):
+    timer = profiling.PhaseTimer()
+    with staged(timer, patches):
+        peak = profiling.peak_memory(fn, device)
+        timer.epoch_totals()
+
+        def run():
+            with timer.phase('total'):
+                fn()
+
+        result = timeit(run, iters, 0)
+        totals = timer.epoch_totals()
+
+    total = totals.pop('total')
+    for stage, seconds in totals.items():
+        result[stage + '_ms'] = 1000 * seconds / iters
+    result[remainder + '_ms'] = 1000 * (total - sum(totals.values())) / iters
+    if peak is not None: result['peak_mb'] = peak / 2 ** 20
+    return result
+
+
+def bench_evaluation(args, opts):
+    """get_fid and save_sample_outputs with a randomly initialised G and FID classifier, timed per stage - generation,
+    graph transform, classifier, frechet distance, plotting and io (loading the noise, rendering and saving the figures) -
+    with their peak memory. Runs offline, with a standard normal as the classifier's statistics of real data"""
+    torch.manual_seed(4)
+    with contextlib.redirect_stdout(io.StringIO()):
+        G = Graph_GAN(gen=True, args=deepcopy(args)).to(args.device)
+    normal_dist = Normal(torch.tensor(0.).to(args.device), torch.tensor(args.sd).to(args.device))
+    C = evaluation.MoNet(25).to(args.device)
+    mu2, sigma2 = np.zeros(128), np.eye(128)
+
+    results = {}
+    patches = [(utils, 'gen', 'generation'), (utils, 'tg_transform', 'graph_transform'), (C, 'forward', 'classifier'), (utils, 'calculate_frechet_distance', 'frechet')]
+    results['get_fid'] = time_stages(lambda: evaluation.get_fid(args, C, G, normal_dist, mu2, sigma2), patches, 'other', opts.eval_iters, args.device)
+
+    with tempfile.TemporaryDirectory() as dir:
+        args.name = "bench"
+        args.noise_path = args.figs_path = args.losses_path = dir + "/"
+        os.mkdir(dir + "/" + args.name)
+        args.noise_file_name = "noise.pt"
+        lns = args.latent_node_size if args.latent_node_size else args.hidden_node_size
+        torch.save(normal_dist.sample((args.num_samples, args.num_hits, lns)), args.noise_path + args.noise_file_name)
+
+        epoch = 100
+        losses = {key: np.random.rand(epoch).tolist() for key in ['D', 'Dr', 'Df', 'G', 'gp', 'fid']}
+        patches = [(utils, 'gen', 'generation'), (torch, 'load', 'io'), (plt, 'savefig', 'io')]
+        results['save_sample_outputs'] = time_stages(lambda: save_outputs.save_sample_outputs(args, None, G, normal_dist, args.name, epoch, losses), patches, 'plotting', opts.eval_iters, args.device)
+
+    return results
+
+
+scenarios = {'gp': bench_gp, 'unrolled': bench_unrolled, 'acgd': bench_acgd, 'ema': bench_ema, 'checkpoint': bench_checkpoint, 'checkpoint-storage': bench_checkpoint_storage, 'load': bench_load, 'registry': bench_registry, 'layers': bench_layers, 'models': bench_models, 'evaluation': bench_evaluation, 'estimate': bench_estimate, 'activation-checkpointing': bench_activation_checkpointing, 'precision': bench_precision, 'threads': bench_threads}
+
+
+def print_results(name, results):
+    print(name)
+    for key in results:
+        extra = "".join("    %s %.4g" % (k, results[key][k]) for k in results[key] if k not in ['median_ms', 'min_ms'])
+        print("    %-20s median %8.2f ms    min %8.2f ms%s" % (key, results[key]['median_ms'], results[key]['min_ms'], extra))
+
+
+# measurements of results (dicts of scenario -> measurement -> values, as saved by --json) more than tolerance (a
+# fraction) slower or larger in peak memory than in the baseline. Measurements only in one of the two are skipped
+def regressions(results, baseline, tolerance):
+    found = []
+    for scenario in results:
+        for key in results[scenario]:
+            if key not in baseline.get(scenario, {}): continue
+            for value in ['median_ms', 'peak_mb']:
+                new, old = results[scenario][key].get(value), baseline[scenario][key].get(value)
+                if new is not None and old and new > old * (1 + tolerance):
+                    found.append((scenario, key, value, old, new))
+    return found
+
+
+if __name__ == "__main__":
+    argv = sys.argv[1:]
+    model_argv = argv[argv.index('--') + 1:] if '--' in argv else []
+    argv = argv[:argv.index('--')] if '--' in argv else argv
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("scenarios", type=str, nargs='*', default=list(scenarios.keys()), help="scenarios to run - options are " + ", ".join(scenarios.keys()))
+    parser.add_argument("--iters", type=int, default=10, help="timed iterations per measurement")
+    parser.add_argument("--warmup", type=int, default=2, help="untimed iterations before each measurement")
+    parser.add_argument("--threads", type=int, default=0, help="number of torch threads - 0 means torch default")
+    parser.add_argument("--gp-every", type=int, default=4, help="lazy gradient penalty interval to compare")
+    parser.add_argument("--gp-batch-size", type=int, default=4, help="gradient penalty sub-batch size to compare")
+    parser.add_argument("--cg-max-iter", type=int, default=4, help="acgd conjugate gradient iteration budget to compare")
+    parser.add_argument("--max-unrolled-steps", type=int, default=4, help="largest number of unrolled D steps to compare")
+    parser.add_argument("--ckpt-saves", type=int, default=400, help="number of checkpoint saves in the checkpoint storage scenario (400 is a 2000 epoch run)")
+    parser.add_argument("--registry-runs", type=int, default=40, help="number of runs written at once in the registry scenario")
+    parser.add_argument("--registry-epochs", type=int, default=500, help="number of epochs of metrics each run writes in the registry scenario")
+    parser.add_argument("--grid-num-hits", type=int, nargs='+', default=[30, 75, 100, 150], help="numbers of hits in the models scenario's grid")
+    parser.add_argument("--grid-batch-size", type=int, nargs='+', default=[16], help="batch sizes in the models scenario's grid")
+    parser.add_argument("--grid-hidden-node-size", type=int, nargs='+', default=[32], help="hidden node sizes in the models scenario's grid")
+    parser.add_argument("--grid-mp-iters", type=int, nargs='+', default=[2], help="numbers of message passing iterations in the models scenario's grid")
+    parser.add_argument("--grid-norm", type=str, nargs='+', default=['none', 'spectral', 'batch'], choices=['none', 'spectral', 'batch', 'both'], help="normalizations of G and D in the models scenario's grid")
+    parser.add_argument("--precision-steps", type=int, default=20, help="training steps in each precision in the precision scenario")
+    parser.add_argument("--threads-intra-op", type=int, nargs='*', default=[], help="intra-op thread counts in the threads scenario - none means powers of two up to the physical cores")
+    parser.add_argument("--threads-inter-op", type=int, nargs='+', default=[0, 1], help="inter-op thread counts in the threads scenario - 0 is torch's default")
+    parser.add_argument("--threads-affinity", type=str, nargs='*', default=[], help="cpu affinities in the threads scenario - none means none, cores and numa if there's more than one NUMA node")
+    parser.add_argument("--eval-iters", type=int, default=3, help="timed calls of each entry point in the evaluation scenario")
+    parser.add_argument("--json", type=str, default="", help="file to save the results to as JSON")
+    parser.add_argument("--baseline", type=str, default="", help="JSON results file of an earlier run to compare with")
+    parser.add_argument("--tolerance", type=float, default=0.1, help="fraction a measurement can be slower or larger than the baseline's before it's flagged")
+    opts = parser.parse_args(argv)
+    opts.model_argv = model_argv
+
+    if opts.threads: torch.set_num_threads(opts.threads)
+
+    all_results = {}
+    for scenario in opts.scenarios:
+        all_results[scenario] = scenarios[scenario](bench_args(model_argv), opts)
+        print_results(scenario, all_results[scenario])
+
+    if opts.json:
+        with open(opts.json, "w") as f:
+            json.dump(all_results, f, indent=2)
+
+    if opts.baseline:
+        with open(opts.baseline, "r") as f:
+            baseline = json.load(f)
+        found = regressions(all_results, baseline, opts.tolerance)
+        for scenario, key, value, old, new in found:
+            print("REGRESSION %s: %s %s %.4g -> %.4g (%+.1f%%)" % (scenario, key, value, old, new, 100 * (new / old - 1)))
+        if len(found):
+            print(str(len(found)) + " regressions against " + opts.baseline + " - exiting")
+            sys.exit(1)
+        print("no regressions against " + opts.baseline)
@@ -0,0 +1,152 @@
+# data parallel training over several processes (ranks) with torch.distributed's gloo backend, on one host or several.
+# Every rank trains on its own shard of each epoch's graphs (see checkpoint.ResumableSampler), with --batch-size graphs
+# per batch, and G and D are wrapped in DistributedDataParallel, which averages their gradients over the ranks in the
+# backward pass so every rank takes the same optimizer steps - a step trains world size * batch size graphs. Ranks are
+# started with torchrun, which sets the rank, world size and address to meet at in the environment
+#     torchrun --nproc-per-node 4 main.py --name ddp ...                                 (on one host)
+#     torchrun --nnodes 2 --node-rank <0 or 1> --master-addr <host 0> --nproc-per-node 16 main.py --name ddp ...
+# or on this host with python main.py --world-size 4 ..., which spawns them. Only rank 0 prints, evaluates, plots and
+# writes the args, checkpoints, metrics and registry, and the losses it logs are averaged over the ranks.
+# Buffers aren't broadcast with every forward pass - spectral norm's u and v (parameters without gradients) are updated
+# by every rank from the same weights, and batch norm's running statistics by each rank from its own batches - so
+# before each evaluation and checkpoint synchronize() averages batch norm's statistics over the ranks and copies rank
+# 0's u and v to the others, in case floating point differences between hosts have made them drift apart.
+# Batch norm normalizes by the statistics of each rank's batch, as SyncBatchNorm only runs on GPU
+
+import torch
+import torch.distributed as dist
+import torch.multiprocessing as mp
+from torch.nn.parallel import DistributedDataParallel
+
+import os
+import sys
+import random
+import socket
+
+import numpy as np
+
+
+BACKEND = 'gloo'
+
+
+def world_size():
+    return dist.get_world_size() if dist.is_initialized() else 1
+
+
+def rank():
+    return dist.get_rank() if dist.is_initialized() else 0
+
+
+def is_main():
+    return rank() == 0
+
+
+# number of ranks on this host
+def local_world_size():
+    return int(os.environ.get('LOCAL_WORLD_SIZE', 1))
+
+
+# joins the other ranks when started by torchrun or spawn(). threads.apply() then splits the host's cores between its
+# ranks (torchrun leaves each one thread)
+def init():
+    if dist.is_initialized() or int(os.environ.get('WORLD_SIZE', 1)) == 1: return
+    dist.init_process_group(BACKEND)
+    if not is_main(): sys.stdout = open(os.devnull, "w")
+
+
+# the device of this rank - on GPU each rank on a host uses its own
+def device(default):
+    if default.type == 'cuda' and world_size() > 1: return torch.device('cuda', int(os.environ.get('LOCAL_RANK', 0)))
+    return default
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('', 0))
+        return s.getsockname()[1]
+
+
+def run(local_rank, fn, args, world_size, port):
+    os.environ.update({'MASTER_ADDR': '127.0.0.1', 'MASTER_PORT': str(port), 'RANK': str(local_rank), 'LOCAL_RANK': str(local_rank),
+                       'WORLD_SIZE': str(world_size), 'LOCAL_WORLD_SIZE': str(world_size)})
+    init()
+    try:
+        fn(args)
+    finally:
+        dist.destroy_process_group()
+
+
+# runs fn(args) in world_size processes on this host, as torchrun --nproc-per-node world_size would
+def spawn(fn, args, world_size):
+    mp.spawn(run, args=(fn, args, world_size, free_port()), nprocs=world_size)
+
+
+# the model's DistributedDataParallel wrapper when training on several ranks, otherwise the model itself. Wrapping
+# copies rank 0's weights to every rank. A forward pass of the wrapper has its gradients averaged over the ranks in the
+# backward pass, while one of the model itself only accumulates them locally, e.g. G's in D's step, which aren't used.
+# find_unused_parameters is needed if some parameters aren't used in the forward pass
+def wrap(model, find_unused_parameters=False):
+    if world_size() == 1: return model
+    parameter = next(model.parameters())
+    return DistributedDataParallel(model, device_ids=[parameter.device] if parameter.is_cuda else None, broadcast_buffers=False, find_unused_parameters=find_unused_parameters)
+
+
+def unwrap(model):
+    return model.module if isinstance(model, DistributedDataParallel) else model
+
+
+# gives each rank its own random numbers (noise, dropout, augmentation), drawn from the ones every rank shares so that
+# resuming from a checkpoint is still deterministic
+def seed_ranks():
+    if world_size() == 1: return
+    seed = int(torch.randint(2 ** 31, ())) + rank()
+    torch.manual_seed(seed)
+    random.seed(seed)
+    np.random.seed(seed)
+
+
+# means over the ranks of a list of numbers, e.g. the loss sums of an epoch
+def mean(values):
+    if world_size() == 1: return values
+    tensor = torch.tensor([float(value) for value in values], dtype=torch.float64)
+    dist.all_reduce(tensor)
+    return (tensor / world_size()).tolist()
+
+
+# whether each flag is set on any rank, for decisions every rank has to take together e.g. saving a step checkpoint
+def any_rank(*flags):
+    if world_size() == 1: return [bool(flag) for flag in flags]
+    tensor = torch.tensor([int(bool(flag)) for flag in flags])
+    dist.all_reduce(tensor, op=dist.ReduceOp.MAX)
+    return [bool(flag) for flag in tensor.tolist()]
+
+
+# obj as on rank 0, on every rank
+def broadcast_object(obj):
+    if world_size() == 1: return obj
+    objects = [obj]
+    dist.broadcast_object_list(objects, src=0)
+    return objects[0]
+
+
+def barrier():
+    if world_size() > 1: dist.barrier()
+
+
+# copies all of rank 0's weights and buffers to the other ranks e.g. after reinitializing a model
+@torch.no_grad()
+def broadcast(model):
+    if world_size() == 1: return
+    for tensor in list(unwrap(model).parameters()) + list(unwrap(model).buffers()): dist.broadcast(tensor.data, 0)
+
+
+# averages batch norm's running statistics over the ranks and copies rank 0's spectral norm u and v to the others
+@torch.no_grad()
+def synchronize(model):
+    if world_size() == 1: return
+    for parameter in unwrap(model).parameters():
+        if not parameter.requires_grad: dist.broadcast(parameter.data, 0)
+    for buffer in unwrap(model).buffers():
+        if buffer.is_floating_point():
+            dist.all_reduce(buffer)
+            buffer /= world_size()
@@ -0,0 +1,68 @@
+# weights-only generator files for the generation and evaluation tools, written alongside the checkpoints. <name>.json
+# holds the args G is built from and where each tensor is in <name>.bin, which is memory-mapped when loading rather than
+# read and unpickled, and G is built on the meta device and given the mapped tensors so its weights aren't initialised
+# only to be overwritten. Loading needs only torch and the model definitions
+
+import torch
+from model import Graph_GAN, GaussianGenerator
+
+import os
+import json
+import math
+from argparse import Namespace
+
+
+# offsets of tensors in the .bin file are aligned to this so every tensor can be viewed in place with its own dtype
+ALIGNMENT = 64
+
+
+def generator_name(epoch):
+    return "G_" + str(epoch) + "_weights"
+
+
+def build_generator(args):
+    return GaussianGenerator(args=args) if getattr(args, 'gcnn', False) else Graph_GAN(gen=True, args=args)
+
+
+# state_dict is G's (with the averaged weights if they're kept), args the plain values G is built from (see checkpoint.args_dict)
+def save_generator(path, state_dict, args):
+    tensors = []
+    offset = 0
+    with open(path + ".bin.tmp", "wb") as f:
+        for name, tensor in state_dict.items():
+            padding = -offset % ALIGNMENT
+            f.write(bytes(padding))
+            offset += padding
+            data = tensor.detach().cpu().contiguous().view(-1).view(torch.uint8).numpy().tobytes()
+            tensors.append({'name': name, 'dtype': str(tensor.dtype).split('.')[-1], 'shape': list(tensor.shape), 'offset': offset})
+            f.write(data)
+            offset += len(data)
+        f.flush()
+        os.fsync(f.fileno())
+
+    with open(path + ".json.tmp", "w") as f:
+        json.dump({'args': args, 'size': offset, 'tensors': tensors}, f)
+        f.flush()
+        os.fsync(f.fileno())
+
+    # the spec is renamed last, so there's never one pointing into a .bin file that isn't complete
+    os.replace(path + ".bin.tmp", path + ".bin")
+    os.replace(path + ".json.tmp", path + ".json")
+
+
+def load_generator(path, device='cpu'):
+    with open(path + ".json", "r") as f:
+        spec = json.load(f)
+
+    # mapped privately - the file is never written to, and pages are only read from disk as they're used
+    data = torch.from_file(path + ".bin", shared=False, size=spec['size'], dtype=torch.uint8)
+    state_dict = {}
+    for tensor in spec['tensors']:
+        dtype = getattr(torch, tensor['dtype'])
+        size = math.prod(tensor['shape']) * torch.empty((), dtype=dtype).element_size()
+        state_dict[tensor['name']] = data[tensor['offset']:tensor['offset'] + size].view(dtype).view(tensor['shape'])
+
+    with torch.device('meta'):
+        G = build_generator(Namespace(**spec['args']))
+    G.load_state_dict(state_dict, assign=True)
+    return G.to(device).eval()
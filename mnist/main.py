@@ -2,20 +2,22 @@
 
 import torch
 from model import Graph_GAN, MoNet, GaussianGenerator  # , Graph_Generator, Graph_Discriminator, Gaussian_Discriminator
-import utils, save_outputs, evaluation, augment
+import utils, save_outputs, evaluation, augment, ema, checkpoint, metrics, registry, stopping, profiling, distributed, threads
 from superpixels_dataset import SuperpixelsDataset
 from graph_dataset_mnist import MNISTGraphDataset
 from acgd import ACGD
-from torch.utils.data import DataLoader
 from torch.distributions.normal import Normal
+from torch.utils.data import DataLoader
 
 import torch.optim as optim
 from tqdm import tqdm
 
-from os import listdir, mkdir
+from os import listdir, mkdir, environ
 from os.path import exists, dirname, realpath
 
 import sys
+import time
+import signal
 import argparse
 from copy import deepcopy
 
@@ -29,7 +31,7 @@ import numpy as np
 device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
 
 
-def parse_args():
+def parse_args(argv=None):
     dir_path = dirname(realpath(__file__))
 
     parser = argparse.ArgumentParser()
@@ -64,7 +66,10 @@ def parse_args():
 
     utils.add_bool_arg(parser, "save-zero", "save the initial figure", default=False)
 
-    utils.add_bool_arg(parser, "debug", "debug mode", default=False)
+    parser.add_argument("--debug", type=int, nargs='?', const=1, default=0, help="debug level - 1 prints what's being trained, 2 also turns on autograd anomaly detection, which slows every backward")
+    parser.add_argument("--no-debug", dest="debug", action="store_const", const=0, help="don't debug - the same as --debug 0")
+    parser.add_argument("--profile-steps", type=int, default=0, help="number of training steps (batches) to trace with torch.profiler, saved as a chrome trace in the losses dir - 0 means none")
+    parser.add_argument("--profile-start", type=int, default=10, help="training step of this run the profiler trace starts from")
 
     # architecture
 
@@ -110,9 +115,22 @@ def parse_args():
     parser.add_argument("--beta2", type=float, default=0.999, help="Adam optimizer beta2")
     parser.add_argument("--batch-size", type=int, default=10, help="batch size")
 
+    parser.add_argument("--cg-max-iter", type=int, default=0, help="max conjugate gradient iterations per acgd step - 0 means no limit")
+    parser.add_argument("--cg-rtol", type=float, default=1e-6, help="conjugate gradient tolerance on the residual norm relative to the initial residual, for acgd")
+    parser.add_argument("--cg-warm-start", type=str, default="previous", help="conjugate gradient starting point for acgd - options are none, previous or adaptive (rescaled previous solution)")
+    utils.add_bool_arg(parser, "cg-precondition", "precondition acgd's conjugate gradient with the squared gradient averages", default=False)
+
     parser.add_argument("--num-critic", type=int, default=1, help="number of critic updates for each generator update")
     parser.add_argument("--num-gen", type=int, default=1, help="number of generator updates for each critic update (num-critic must be 1 for this to apply)")
 
+    parser.add_argument("--activation-checkpointing", type=str, default="none", help="message passing activations to recompute in the backward pass instead of keeping, saving memory for time - options are none, edges (each iteration's edge network) or iterations (whole iterations)")
+    parser.add_argument("--precision", type=str, default="fp32", help="precision of G's and D's message passing - options are fp32 or bf16 (autocast, with the weights, losses, spectral norm and gradient penalty in fp32)")
+    parser.add_argument("--world-size", type=int, default=1, help="number of processes to spawn on this host for data parallel training, each with batches of batch size - not needed when started with torchrun, see distributed.py")
+    parser.add_argument("--intra-op-threads", type=int, default=threads.env_default("intra-op-threads", 0), help="number of threads torch uses within ops - 0 means one per core the process is pinned to, or torch's default split between the data parallel ranks on the host")
+    parser.add_argument("--inter-op-threads", type=int, default=threads.env_default("inter-op-threads", 0), help="number of threads torch runs independent ops in parallel on - 0 means torch's default")
+    parser.add_argument("--cpu-affinity", type=str, default=threads.env_default("cpu-affinity", "none"), help="cores each process is pinned to - options are none, cores (a block of physical cores for each data parallel rank on the host) or numa (ranks placed on the NUMA nodes in turn), see threads.py")
+    parser.add_argument("--num-workers", type=int, default=threads.env_default("num-workers", 0), help="number of DataLoader worker processes, each with one thread - 0 means loading in the training process")
+
     # regularization
 
     utils.add_bool_arg(parser, "batch-norm-disc", "use batch normalization", default=False)
@@ -128,6 +146,9 @@ def parse_args():
 
     # utils.add_bool_arg(parser, "gp", "use gradient penalty", default=False)
     parser.add_argument("--gp", type=float, default=0, help="WGAN generator penalty weight - 0 means not used")
+    parser.add_argument("--gp-every", type=int, default=1, help="lazy regularization - apply the gradient penalty every this many D steps, with its weight scaled by the same factor")
+    parser.add_argument("--gp-batch-size", type=int, default=0, help="number of samples in the batch to compute the gradient penalty on - 0 means the whole batch")
+    utils.add_bool_arg(parser, "gp-real-edges", "reuse the real graphs' edges for the interpolated graphs in the gcnn gradient penalty", default=True)
 
     utils.add_bool_arg(parser, "gom", "use gen only mode", default=False)
     utils.add_bool_arg(parser, "bgm", "use boost g mode", default=False)
@@ -150,14 +171,34 @@ def parse_args():
     utils.add_bool_arg(parser, "adaptive-prob", "adaptive augment probability", default=False)
     parser.add_argument("--aug-prob", type=float, default=1.0, help="probability of being augmented")
 
+    # checkpoints
+
+    parser.add_argument("--ckpt-dtype", type=str, default="float32", help="dtype model weights are stored in in checkpoints - options are float32, float16 or bfloat16")
+    parser.add_argument("--ckpt-compression", type=str, default="none", help="checkpoint compression - options are none, zlib or lzma")
+    parser.add_argument("--ckpt-keep-last", type=int, default=5, help="number of most recent checkpoints to keep - 0 means keep all")
+    parser.add_argument("--ckpt-keep-every", type=int, default=100, help="also keep the checkpoints every this many epochs - 0 means none")
+    utils.add_bool_arg(parser, "ckpt-keep-best", "also keep the checkpoint with the best fid", default=True)
+    parser.add_argument("--ckpt-interval", type=float, default=0, help="also save a mid-epoch checkpoint to resume from every this many minutes - 0 means only at the end of epochs")
+
+    utils.add_bool_arg(parser, "registry", "record the run's config, metrics, checkpoints and timings in registry.db in the dir path", default=True)
+
     # evaluation
 
+    utils.add_bool_arg(parser, "ema", "evaluate, plot and export an exponential moving average of G's weights", default=True)
+    parser.add_argument("--ema-decay", type=float, default=0.999, help="G weights EMA decay per G update")
+
     utils.add_bool_arg(parser, "fid", "calc fid", default=True)
     parser.add_argument("--fid-eval-size", type=int, default=8192, help="number of samples generated for evaluating fid")
     parser.add_argument("--fid-batch-size", type=int, default=32, help="batch size when generating samples for fid eval")
     parser.add_argument("--gpu-batch", type=int, default=50, help="")
 
-    args = parser.parse_args()
+    # early stopping
+
+    parser.add_argument("--early-stopping-patience", type=int, default=0, help="stop training once the fid hasn't improved in this many epochs - 0 means always train for num epochs")
+    parser.add_argument("--early-stopping-min-delta", type=float, default=0, help="fraction of the best fid so far an evaluation has to be lower by to improve on it")
+    parser.add_argument("--early-stopping-smoothing", type=float, default=0, help="weight of the previous average in the exponential moving average of the fid early stopping compares - 0 means no smoothing")
+
+    args = parser.parse_args(argv)
 
     if isinstance(args.num, list) and len(args.num) == 1:
         args.num = args.num[0]
@@ -190,6 +231,62 @@ def parse_args():
         print("acgd can't have num critic or num gen > 1 - exiting")
         sys.exit()
 
+    if(not(args.cg_warm_start == 'none' or args.cg_warm_start == 'previous' or args.cg_warm_start == 'adaptive')):
+        print("invalid cg warm start - exiting")
+        sys.exit()
+
+    if(not(args.activation_checkpointing == 'none' or args.activation_checkpointing == 'edges' or args.activation_checkpointing == 'iterations')):
+        print("invalid activation checkpointing - exiting")
+        sys.exit()
+
+    if(not(args.precision == 'fp32' or args.precision == 'bf16')):
+        print("invalid precision - exiting")
+        sys.exit()
+
+    if(not(args.cpu_affinity == 'none' or args.cpu_affinity == 'cores' or args.cpu_affinity == 'numa')):
+        print("invalid cpu affinity - exiting")
+        sys.exit()
+
+    if(args.intra_op_threads < 0 or args.inter_op_threads < 0 or args.num_workers < 0):
+        print("intra-op threads, inter-op threads and num workers can't be negative - exiting")
+        sys.exit()
+
+    if(args.world_size < 1):
+        print("world size must be at least 1 - exiting")
+        sys.exit()
+
+    if((args.world_size > 1 or 'WORLD_SIZE' in environ) and (args.optimizer == 'acgd' or args.gcnn)):
+        print("data parallel training not implemented with acgd or GCNN yet - exiting")
+        sys.exit()
+
+    if(args.ema and not (0 <= args.ema_decay < 1)):
+        print("ema decay must be in [0, 1) - exiting")
+        sys.exit()
+
+    if(args.profile_steps < 0 or args.profile_start < 0):
+        print("profile steps and start can't be negative - exiting")
+        sys.exit()
+
+    if(not(args.ckpt_dtype == 'float32' or args.ckpt_dtype == 'float16' or args.ckpt_dtype == 'bfloat16')):
+        print("invalid checkpoint dtype - exiting")
+        sys.exit()
+
+    if(not(args.ckpt_compression == 'none' or args.ckpt_compression == 'zlib' or args.ckpt_compression == 'lzma')):
+        print("invalid checkpoint compression - exiting")
+        sys.exit()
+
+    if(args.early_stopping_patience < 0 or not (0 <= args.early_stopping_min_delta < 1) or not (0 <= args.early_stopping_smoothing < 1)):
+        print("early stopping patience can't be negative and min delta and smoothing must be in [0, 1) - exiting")
+        sys.exit()
+
+    if(args.early_stopping_patience and not args.fid):
+        print("early stopping needs the fid to be calculated - exiting")
+        sys.exit()
+
+    if(args.gp_every < 1):
+        print("gp every must be at least 1 - exiting")
+        sys.exit()
+
     if(args.n and args.lx):
         print("can't be on nautilus and lxplus both - exiting")
         sys.exit()
@@ -221,10 +318,7 @@ def parse_args():
     return args
 
 
-def init(args):
-    torch.manual_seed(4)
-    torch.autograd.set_detect_anomaly(True)
-
+def set_paths(args):
     args.model_path = args.dir_path + '/models/'
     args.losses_path = args.dir_path + '/losses/'
     args.args_path = args.dir_path + '/args/'
@@ -234,57 +328,86 @@ def init(args):
     args.eval_path = args.dir_path + '/evaluation/'
     args.noise_path = args.dir_path + '/noise/'
 
-    if(not exists(args.model_path)):
-        mkdir(args.model_path)
-    if(not exists(args.losses_path)):
-        mkdir(args.losses_path)
-    if(not exists(args.args_path)):
-        mkdir(args.args_path)
-    if(not exists(args.figs_path)):
-        mkdir(args.figs_path)
-    if(not exists(args.err_path)):
-        mkdir(args.err_path)
-    if(not exists(args.noise_path)):
-        mkdir(args.noise_path)
-    if(not exists(args.dataset_path)):
-        mkdir(args.dataset_path)
-        print("Downloading dataset")
-        if(not args.sparse_mnist):
-            import tarfile, urllib
-            # url = 'http://ls7-www.cs.uni-dortmund.de/cvpr_geometric_dl/mnist_superpixels.tar.gz'
-            url = 'https://ls7-www.cs.tu-dortmund.de/fileadmin/ls7-www/misc/cvpr/mnist_superpixels.tar.gz'
-            try:
-                # python2
-                file_tmp = urllib.urlretrieve(url)[0]
-            except:
-                # python3
-                file_tmp = urllib.request.urlretrieve(url)[0]
-
-            tar = tarfile.open(file_tmp)
-            tar.extractall(args.dataset_path)
-        else:
-            import requests
-            r = requests.get('https://pjreddie.com/media/files/mnist_train.csv', allow_redirects=True)
-            open(args.dataset_path + 'mnist_train.csv', 'wb').write(r.content)
-            r = requests.get('https://pjreddie.com/media/files/mnist_test.csv', allow_redirects=True)
-            open(args.dataset_path + 'mnist_test.csv', 'wb').write(r.content)
 
-        print("Downloaded dataset")
+def download_dataset(args):
+    print("Downloading dataset")
+    if(not args.sparse_mnist):
+        import tarfile, urllib
+        # url = 'http://ls7-www.cs.uni-dortmund.de/cvpr_geometric_dl/mnist_superpixels.tar.gz'
+        url = 'https://ls7-www.cs.tu-dortmund.de/fileadmin/ls7-www/misc/cvpr/mnist_superpixels.tar.gz'
+        try:
+            # python2
+            file_tmp = urllib.urlretrieve(url)[0]
+        except:
+            # python3
+            file_tmp = urllib.request.urlretrieve(url)[0]
+
+        tar = tarfile.open(file_tmp)
+        tar.extractall(args.dataset_path)
+    else:
+        import requests
+        r = requests.get('https://pjreddie.com/media/files/mnist_train.csv', allow_redirects=True)
+        open(args.dataset_path + 'mnist_train.csv', 'wb').write(r.content)
+        r = requests.get('https://pjreddie.com/media/files/mnist_test.csv', allow_redirects=True)
+        open(args.dataset_path + 'mnist_test.csv', 'wb').write(r.content)
+
+    print("Downloaded dataset")
+
 
-    prev_models = [f[:-4] for f in listdir(args.args_path)]  # removing .txt
+def load_dataset(args):
+    if(args.sparse_mnist):
+        return MNISTGraphDataset(args.dataset_path, args.num_hits, train=args.train, num=args.num)
+    elif(args.gcnn):
+        def pf(data):
+            return data.y == args.num
 
-    if (args.name in prev_models):
-        print("name already used")
-        # if(not args.load_model):
-        #    sys.exit()
+        pre_filter = pf if args.num != -1 else None
+        return MNISTSuperpixels(args.dir_path, train=args.train, pre_transform=T.Cartesian(), pre_filter=pre_filter)
     else:
-        mkdir(args.losses_path + args.name)
-        mkdir(args.model_path + args.name)
-        mkdir(args.figs_path + args.name)
+        return SuperpixelsDataset(args.dataset_path, args.num_hits, train=args.train, num=args.num)
+
+
+def init(args):
+    torch.manual_seed(4)
+    torch.autograd.set_detect_anomaly(args.debug >= 2)
+
+    set_paths(args)
+
+    # the other ranks wait for rank 0 to set up the directories and download the dataset
+    if(distributed.is_main()):
+        if(not exists(args.model_path)):
+            mkdir(args.model_path)
+        if(not exists(args.losses_path)):
+            mkdir(args.losses_path)
+        if(not exists(args.args_path)):
+            mkdir(args.args_path)
+        if(not exists(args.figs_path)):
+            mkdir(args.figs_path)
+        if(not exists(args.err_path)):
+            mkdir(args.err_path)
+        if(not exists(args.noise_path)):
+            mkdir(args.noise_path)
+        if(not exists(args.dataset_path)):
+            mkdir(args.dataset_path)
+            download_dataset(args)
+
+        prev_models = [f[:-4] for f in listdir(args.args_path)]  # removing .txt
+
+        if (args.name in prev_models):
+            print("name already used")
+            # if(not args.load_model):
+            #    sys.exit()
+        else:
+            mkdir(args.losses_path + args.name)
+            mkdir(args.model_path + args.name)
+            mkdir(args.figs_path + args.name)
+    distributed.barrier()
 
     if args.load_model:
         if args.start_epoch == -1:
-            prev_models = [int(f[:-3].split('_')[-1]) for f in listdir(args.model_path + args.name + '/')]
+            args.start_epoch = checkpoint.latest_epoch(args.model_path + args.name + '/')
+            # runs from before the checkpoint manifest only have the pickled models
+            prev_models = [int(f[:-3].split('_')[-1]) for f in listdir(args.model_path + args.name + '/') if f.endswith('.pt')] if args.start_epoch is None else [args.start_epoch]
             if len(prev_models):
                 args.start_epoch = max(prev_models)
             else:
@@ -295,9 +418,10 @@ def init(args):
         args.start_epoch = 0
 
     if(not args.load_model):
-        f = open(args.args_path + args.name + ".txt", "w+")
-        f.write(str(vars(args)))
-        f.close()
+        if(distributed.is_main()):
+            f = open(args.args_path + args.name + ".txt", "w+")
+            f.write(str(vars(args)))
+            f.close()
     elif(not args.override_args):
         temp = args.start_epoch, args.num_epochs
         f = open(args.args_path + args.name + ".txt", "r")
@@ -311,37 +435,40 @@ def init(args):
         args.load_model = True
         args.start_epoch, args.num_epochs = temp
 
-    args.device = device
+    args.device = distributed.device(device)
 
     return args
 
 
-def main(args):
+# X is the dataset when already loaded e.g. into shared memory by sweep.py, for all of its runs, and member the run's
+# pbt.Member when it's one of a population
+def main(args, X=None, member=None):
+    distributed.init()
+    thread_config = threads.apply(args)
     args = init(args)
-
-    def pf(data):
-        return data.y == args.num
-
-    pre_filter = pf if args.num != -1 else None
+    main_rank = distributed.is_main()
 
     print("loading data")
 
-    if(args.sparse_mnist):
-        X = MNISTGraphDataset(args.dataset_path, args.num_hits, train=args.train, num=args.num)
-        X_loaded = DataLoader(X, shuffle=True, batch_size=args.batch_size, pin_memory=True)
+    if X is None: X = load_dataset(args)
+    if(args.gcnn and not args.sparse_mnist):
+        X_loaded, sampler = checkpoint.resumable_loader(X, args.batch_size, loader=tgDataLoader)
     else:
-        if(args.gcnn):
-            X = MNISTSuperpixels(args.dir_path, train=args.train, pre_transform=T.Cartesian(), pre_filter=pre_filter)
-            X_loaded = tgDataLoader(X, shuffle=True, batch_size=args.batch_size)
-        else:
-            X = SuperpixelsDataset(args.dataset_path, args.num_hits, train=args.train, num=args.num)
-            X_loaded = DataLoader(X, shuffle=True, batch_size=args.batch_size, pin_memory=True)
+        X_loaded, sampler = checkpoint.resumable_loader(X, args.batch_size, num_replicas=distributed.world_size(), rank=distributed.rank(), num_workers=args.num_workers, worker_init_fn=threads.worker_init_fn(thread_config), pin_memory=True)
+
+    # every rank has to draw the same order to take its shard of
+    sampler.load_state_dict(distributed.broadcast_object(sampler.state_dict()))
+    distributed.seed_ranks()
 
     print("loaded data")
 
     # model
 
-    if(args.load_model):
+    state = None
+    if(args.load_model and checkpoint.find(args.model_path + args.name + '/', args.start_epoch) is not None):
+        state = checkpoint.load(args.model_path + args.name + '/', checkpoint.find(args.model_path + args.name + '/', args.start_epoch), args.device)
+        G, D = checkpoint.load_models(args, state)
+    elif(args.load_model):
         G = torch.load(args.model_path + args.name + "/G_" + str(args.start_epoch) + ".pt", map_location=args.device)
         D = torch.load(args.model_path + args.name + "/D_" + str(args.start_epoch) + ".pt", map_location=args.device)
 
@@ -358,6 +485,14 @@ def main(args):
             print("Discriminator")
             D = Graph_GAN(gen=False, args=deepcopy(args)).to(args.device)
 
+    if(not args.gcnn):
+        G.activation_checkpointing = D.activation_checkpointing = args.activation_checkpointing
+        G.precision = D.precision = args.precision
+
+    # G and D's forward passes to average the gradients of over the ranks - the batch norms of the last fn (and fnd)
+    # layers aren't used
+    G_parallel, D_parallel = distributed.wrap(G, args.batch_norm_gen), distributed.wrap(D, args.batch_norm_disc)
+
     print("Models loaded")
 
     # optimizer
@@ -365,7 +500,7 @@ def main(args):
     if args.spectral_norm_gen: G_params = filter(lambda p: p.requires_grad, G.parameters())
     else: G_params = G.parameters()
 
-    if args.spectral_norm_gen: D_params = filter(lambda p: p.requires_grad, D.parameters())
+    if args.spectral_norm_disc: D_params = filter(lambda p: p.requires_grad, D.parameters())
     else: D_params = D.parameters()
 
     if(args.optimizer == 'rmsprop'):
@@ -375,7 +510,8 @@ def main(args):
         G_optimizer = optim.Adadelta(G_params, lr=args.lr_gen)
         D_optimizer = optim.Adadelta(D_params, lr=args.lr_disc)
     elif(args.optimizer == 'acgd'):
-        optimizer = ACGD(max_params=G_params, min_params=D_params, lr_max=args.lr_gen, lr_min=args.lr_disc, device=args.device)
+        optimizer = ACGD(max_params=G_params, min_params=D_params, lr_max=args.lr_gen, lr_min=args.lr_disc, tol=args.cg_rtol ** 2, device=args.device,
+                         max_iter=args.cg_max_iter if args.cg_max_iter else None, warm_start=args.cg_warm_start, precondition=args.cg_precondition)
     elif(args.optimizer == 'adam' or args.optimizer == 'None'):
         G_optimizer = optim.Adam(G_params, lr=args.lr_gen, weight_decay=5e-4, betas=(args.beta1, args.beta2))
         D_optimizer = optim.Adam(D_params, lr=args.lr_disc, weight_decay=5e-4, betas=(args.beta1, args.beta2))
@@ -383,16 +519,26 @@ def main(args):
     if(args.load_model):
         try:
             if(not args.optimizer == 'acgd'):
-                G_optimizer.load_state_dict(torch.load(args.model_path + args.name + "/G_optim_" + str(args.start_epoch) + ".pt", map_location=args.device))
-                D_optimizer.load_state_dict(torch.load(args.model_path + args.name + "/D_optim_" + str(args.start_epoch) + ".pt", map_location=args.device))
+                G_optimizer.load_state_dict(state['G_optim'] if state is not None else torch.load(args.model_path + args.name + "/G_optim_" + str(args.start_epoch) + ".pt", map_location=args.device))
+                D_optimizer.load_state_dict(state['D_optim'] if state is not None else torch.load(args.model_path + args.name + "/D_optim_" + str(args.start_epoch) + ".pt", map_location=args.device))
             else:
-                optimizer.load_state_dict(torch.load(args.model_path + args.name + "/optim_" + str(args.start_epoch) + ".pt", map_location=args.device))
+                optimizer.load_state_dict(state['optim'] if state is not None else torch.load(args.model_path + args.name + "/optim_" + str(args.start_epoch) + ".pt", map_location=args.device))
         except:
             print("Error loading optimizer")
 
     print("optimizers loaded")
 
-    if args.fid: C, mu2, sigma2 = evaluation.load(args, X_loaded)
+    G_ema = ema.EMA(G, args.ema_decay) if args.ema else None
+
+    if(args.load_model and args.ema):
+        try:
+            if state is not None: G_ema.load_state_dict(state['G_ema'])
+            else: G_ema.load_model(torch.load(args.model_path + args.name + "/G_ema_" + str(args.start_epoch) + ".pt", map_location=args.device))
+        except:
+            print("Error loading G ema - starting from the current G weights")
+
+    # the real graphs' statistics are of the whole dataset, not rank 0's shard
+    if args.fid and main_rank: C, mu2, sigma2 = evaluation.load(args, X_loaded if distributed.world_size() == 1 else DataLoader(X, batch_size=args.batch_size))
 
     normal_dist = Normal(torch.tensor(0.).to(args.device), torch.tensor(args.sd).to(args.device))
 
@@ -403,7 +549,7 @@ def main(args):
 
     noise_file_names = listdir(args.noise_path)
 
-    if args.noise_file_name not in noise_file_names:
+    if args.noise_file_name not in noise_file_names and main_rank:
         if(args.gcnn):
             torch.save(normal_dist.sample((args.num_samples * 5, 2 + args.channels[0])), args.noise_path + args.noise_file_name)
         else:
@@ -411,35 +557,66 @@ def main(args):
 
     losses = {}
 
-    if(args.load_model):
-        try:
-            losses['D'] = np.loadtxt(args.losses_path + args.name + "/" + "D.txt").tolist()[:args.start_epoch]
-            losses['Dr'] = np.loadtxt(args.losses_path + args.name + "/" + "Dr.txt").tolist()[:args.start_epoch]
-            losses['Df'] = np.loadtxt(args.losses_path + args.name + "/" + "Df.txt").tolist()[:args.start_epoch]
-            losses['G'] = np.loadtxt(args.losses_path + args.name + "/" + "G.txt").tolist()[:args.start_epoch]
-            if args.fid: losses['fid'] = np.loadtxt(args.losses_path + args.name + "/" + "fid.txt").tolist()[:args.start_epoch]
-            if(args.gp): losses['gp'] = np.loadtxt(args.losses_path + args.name + "/" + "gp.txt").tolist()[:args.start_epoch]
-        except:
-            print("couldn't load losses")
-            losses['D'] = []
-            losses['Dr'] = []
-            losses['Df'] = []
-            losses['G'] = []
-            if args.fid: losses['fid'] = []
-            if(args.gp): losses['gp'] = []
+    # only rank 0 logs
+    metrics_log = metrics.MetricsLog(args.losses_path + args.name + "/") if main_rank else None
+    # runs from before the metrics log only have the losses saved as text files
+    if(main_rank and args.load_model and not exists(metrics_log.file)):
+        metrics.convert(args.losses_path + args.name + "/")
+        metrics_log = metrics.MetricsLog(args.losses_path + args.name + "/")
+    # the epochs after the one resumed from are trained again
+    if(main_rank): metrics_log.truncate(args.start_epoch if args.load_model else -1)
 
-    else:
-        losses['D'] = []
-        losses['Dr'] = []
-        losses['Df'] = []
-        losses['G'] = []
-        if args.fid: losses['fid'] = []
-        if(args.gp): losses['gp'] = []
+    runs = registry.Registry(args.dir_path + "/") if args.registry and main_rank else None
+    if(runs is not None):
+        runs.register_run(args.name, checkpoint.args_dict(args))
+        runs.truncate(args.name, args.start_epoch if args.load_model else -1)
+
+    # exact progress through training when the checkpoint has it, otherwise the losses are read from the metrics log
+    progress = state['progress'] if state is not None and 'progress' in state else None
+
+    if(progress is not None):
+        losses = checkpoint.map_tensors(progress['losses'], lambda tensor: tensor.cpu().numpy())
+    elif(args.load_model and main_rank):
+        losses = metrics_log.read()
+
+    for key in ['D', 'Dr', 'Df', 'G'] + (['fid'] if args.fid else []) + (['gp'] if args.gp else []):
+        losses.setdefault(key, [])
 
     Y_real = torch.ones(args.batch_size, 1).to(args.device)
     Y_fake = torch.zeros(args.batch_size, 1).to(args.device)
 
-    def train_D(data, gen_data=None, unrolled=False):
+    checkpoints = checkpoint.CheckpointWriter(args, registry=runs) if main_rank else None
+
+    # stops training once the fid plateaus, continuing from its values already in the metrics log when resuming
+    best_key = 'fid'
+    stopper = stopping.EarlyStopping(args.early_stopping_patience, args.early_stopping_min_delta, args.early_stopping_smoothing) if args.early_stopping_patience and main_rank else None
+    if(stopper is not None and best_key in metrics_log.columns):
+        for epoch, value in zip(*metrics_log.column(best_key)): stopper.step(epoch, np.sum(value))
+
+    # a checkpoint is saved whenever the fid improves on its lowest value so far, so the best checkpoint is of the best
+    # evaluated epoch - epoch 0's initial evaluation has no checkpoint
+    best_value = float('inf')
+    if(main_rank and best_key in metrics_log.columns):
+        best_value = min([float(np.sum(value)) for epoch, value in zip(*metrics_log.column(best_key)) if epoch > 0 and np.isfinite(np.sum(value))] + [best_value])
+
+    optimizers = optimizer if args.optimizer == 'acgd' else (D_optimizer, G_optimizer)
+
+    D_steps = progress['D_steps'] if progress is not None else 0
+
+    timer = profiling.PhaseTimer()
+    trace = profiling.TraceWindow(args.losses_path + args.name + "/trace.json", args.profile_start, args.profile_steps) if args.profile_steps and main_rank else None
+
+    # on preemption save a step checkpoint after the current batch and exit
+    stop = []
+    signal.signal(signal.SIGTERM, lambda signum, frame: stop.append(signum))
+
+    # everything besides the models and optimizers needed to continue training exactly from after the given number of batches of the epoch
+    def progress_state(epoch, batches, accumulators):
+        return {'epoch': epoch, 'batch': batches, 'accumulators': accumulators, 'losses': losses, 'rng': checkpoint.rng_state(),
+                'sampler': sampler.state_dict(batches), 'D_steps': D_steps}
+
+    def train_D(data, gen_data=None):
+        nonlocal D_steps
         if args.debug: print("dtrain")
         D.train()
         D_optimizer.zero_grad()
@@ -447,21 +624,29 @@ def main(args):
         run_batch_size = data.shape[0] if not args.gcnn else data.y.shape[0]
 
         if gen_data is None:
-            gen_data = utils.gen(args, G, normal_dist, run_batch_size)
-            if(args.gcnn): gen_data = utils.convert_to_batch(args, gen_data, run_batch_size)
+            with timer.phase('G forward'):
+                gen_data = utils.gen(args, G, normal_dist, run_batch_size)
+                if(args.gcnn): gen_data = utils.convert_to_batch(args, gen_data, run_batch_size)
 
         if args.augment:
-            p = args.aug_prob if not args.adaptive_prob else losses['p'][-1]
-            data = augment.augment(args, data, p)
-            gen_data = augment.augment(args, gen_data, p)
-
-        D_real_output = D(data.clone())
-        D_fake_output = D(gen_data)
-
-        D_loss, D_loss_items = utils.calc_D_loss(args, D, data, gen_data, D_real_output, D_fake_output, run_batch_size, Y_real, Y_fake)
-        D_loss.backward(create_graph=unrolled)
-
-        D_optimizer.step()
+            with timer.phase('augment'):
+                p = args.aug_prob if not args.adaptive_prob else losses['p'][-1]
+                data = augment.augment(args, data, p)
+                gen_data = augment.augment(args, gen_data, p)
+
+        with timer.phase('D forward real'):
+            D_real_output = D_parallel(data.clone())
+        with timer.phase('D forward fake'):
+            D_fake_output = D_parallel(gen_data)
+
+        with timer.phase('D loss'):
+            D_loss, D_loss_items = utils.calc_D_loss(args, D_parallel, data, gen_data, D_real_output, D_fake_output, run_batch_size, Y_real, Y_fake, step=D_steps)
+        with timer.phase('backward'):
+            D_loss.backward()
+
+        with timer.phase('optimizer step'):
+            D_optimizer.step()
+        D_steps += 1
         return D_loss_items
 
     def train_G(data):
@@ -469,27 +654,31 @@ def main(args):
         G.train()
         G_optimizer.zero_grad()
 
-        gen_data = utils.gen(args, G, normal_dist, args.batch_size)
-        if(args.gcnn): gen_data = utils.convert_to_batch(args, gen_data, args.batch_size)
+        with timer.phase('G forward'):
+            gen_data = utils.gen(args, G_parallel, normal_dist, args.batch_size)
+            if(args.gcnn): gen_data = utils.convert_to_batch(args, gen_data, args.batch_size)
 
         if args.augment:
-            p = args.aug_prob if not args.adaptive_prob else losses['p'][-1]
-            gen_data = augment.augment(args, gen_data, p)
+            with timer.phase('augment'):
+                p = args.aug_prob if not args.adaptive_prob else losses['p'][-1]
+                gen_data = augment.augment(args, gen_data, p)
 
-        if(args.unrolled_steps > 0):
-            D_backup = deepcopy(D)
-            for i in range(args.unrolled_steps - 1):
-                train_D(data, gen_data=gen_data, unrolled=True)
+        # unrolled D weights only exist as tensors in the graph, D itself is never modified
+        D_unrolled = D
+        if args.unrolled_steps > 0:
+            with timer.phase('D unroll'):
+                D_unrolled = utils.unrolled_D(args, D, D_optimizer, data, gen_data, Y_real, Y_fake, p=p if args.augment else None, step=D_steps)
 
-        D_fake_output = D(gen_data)
+        with timer.phase('D forward fake'):
+            D_fake_output = D_unrolled(gen_data)
 
         G_loss = utils.calc_G_loss(args, D_fake_output, Y_real)
 
-        G_loss.backward()
-        G_optimizer.step()
-
-        if(args.unrolled_steps > 0):
-            D.load(D_backup)
+        with timer.phase('backward'):
+            G_loss.backward()
+        with timer.phase('optimizer step'):
+            G_optimizer.step()
+            if args.ema: G_ema.update()
 
         return G_loss.item()
 
@@ -501,46 +690,84 @@ def main(args):
 
         run_batch_size = data.shape[0] if not args.gcnn else data.y.shape[0]
 
-        gen_data = utils.gen(args, G, normal_dist, run_batch_size)
-        if(args.gcnn): gen_data = utils.convert_to_batch(args, gen_data, run_batch_size)
+        with timer.phase('G forward'):
+            gen_data = utils.gen(args, G, normal_dist, run_batch_size)
+            if(args.gcnn): gen_data = utils.convert_to_batch(args, gen_data, run_batch_size)
 
         if args.augment:
-            p = args.aug_prob if not args.adaptive_prob else losses['p'][-1]
-            data = utils.rand_translate(args, data, p)
-            gen_data = utils.rand_translate(args, gen_data, p)
+            with timer.phase('augment'):
+                p = args.aug_prob if not args.adaptive_prob else losses['p'][-1]
+                data = augment.augment(args, data, p)
+                gen_data = augment.augment(args, gen_data, p)
+
+        with timer.phase('D forward real'):
+            D_real_output = D(data.clone())
+        with timer.phase('D forward fake'):
+            D_fake_output = D(gen_data)
 
-        D_real_output = D(data.clone())
-        D_fake_output = D(gen_data)
+        with timer.phase('D loss'):
+            D_loss, D_loss_items = utils.calc_D_loss(args, D, data, gen_data, D_real_output, D_fake_output, run_batch_size, Y_real, Y_fake)
 
-        D_loss, D_loss_items = utils.calc_D_loss(args, D, data, gen_data, D_real_output, D_fake_output, run_batch_size)
+        # the gradients and conjugate gradient solve are all in the acgd step
+        with timer.phase('optimizer step'):
+            optimizer.step(loss=D_loss)
+            if args.ema: G_ema.update()
 
-        optimizer.step(loss=D_loss)
+        if args.debug:
+            info = optimizer.get_info()
+            print("cg iters: " + str(info['iter_num']) + ", time: " + str(info['time']) + ", residuals: " + str(info['residuals']))
 
         G.eval()
         with torch.no_grad():
-            G_loss = utils.calc_G_loss(args, D_fake_output)
+            G_loss = utils.calc_G_loss(args, D_fake_output, Y_real[:run_batch_size])
 
         return D_loss_items, G_loss.item()
 
+    # appends the losses added since the last call to the metrics log and the registry, with the seconds spent in each phase
+    def log_metrics(epoch, timings):
+        if(not main_rank): return
+        for values in metrics_log.extend(epoch, losses, {'time_' + key: seconds for key, seconds in timings.items()}):
+            if(runs is not None): runs.log_metrics(args.name, epoch, values)
+        if(runs is not None and len(timings)): runs.log_timings(args.name, epoch, timings)
+
     def train():
+        nonlocal best_value
         k = 0
         temp_ng = args.num_gen
-        if(args.fid): losses['fid'].append(evaluation.get_fid(args, C, G, normal_dist, mu2, sigma2))
-        if(args.save_zero): save_outputs.save_sample_outputs(args, D, G, normal_dist, args.name, 0, losses)
+        # the initial evaluation is already in the losses restored with the progress
+        if(progress is None):
+            with ema.averaged(G_ema), threads.widened(thread_config):
+                with timer.phase('evaluation'):
+                    if(args.fid and main_rank): losses['fid'].append(evaluation.get_fid(args, C, G, normal_dist, mu2, sigma2))
+                with timer.phase('plotting'):
+                    if(args.save_zero and main_rank): save_outputs.save_sample_outputs(args, D, G, normal_dist, args.name, 0, losses)
+            log_metrics(0, timer.epoch_totals())
+        else:
+            sampler.load_state_dict(progress['sampler'])
+            checkpoint.set_rng_state(progress['rng'])
+            distributed.seed_ranks()
+
+        last_save = time.time()
         for i in range(args.start_epoch, args.num_epochs):
             print("Epoch %d %s" % ((i + 1), args.name))
+            epoch_start = time.time()
             Dr_loss = 0
             Df_loss = 0
             G_loss = 0
             D_loss = 0
             gp_loss = 0
+            start_batch = 0
+            if(i == args.start_epoch and progress is not None and progress['batch']):
+                D_loss, Dr_loss, Df_loss, G_loss, gp_loss = [progress['accumulators'][key] for key in ['D', 'Dr', 'Df', 'G', 'gp']]
+                start_batch = progress['batch']
             lenX = len(X_loaded)
-            for batch_ndx, data in tqdm(enumerate(X_loaded), total=lenX):
-                data = data.to(args.device)
-                if(args.gcnn):
-                    data.pos = (data.pos - 14) / 28
-                    row, col = data.edge_index
-                    data.edge_attr = (data.pos[col] - data.pos[row]) / (2 * args.cutoff) + 0.5
+            for batch_ndx, data in tqdm(enumerate(timer.iterate('data', X_loaded), start_batch), total=lenX, initial=start_batch, disable=not main_rank):
+                with timer.phase('data'):
+                    data = data.to(args.device)
+                    if(args.gcnn):
+                        data.pos = (data.pos - 14) / 28
+                        row, col = data.edge_index
+                        data.edge_attr = (data.pos[col] - data.pos[row]) / (2 * args.cutoff) + 0.5
 
                 if(not args.optimizer == 'acgd'):
                     if(args.num_critic > 1):
@@ -572,6 +799,27 @@ def main(args):
                     if(batch_ndx == 10):
                         return
 
+                if(trace is not None): trace.step()
+
+                # every rank stops and saves together, and the checkpoint has the loss sums averaged over the ranks
+                stopping, due = distributed.any_rank(len(stop), args.ckpt_interval and time.time() - last_save > args.ckpt_interval * 60)
+                if(stopping or due):
+                    distributed.synchronize(D)
+                    distributed.synchronize(G)
+                    accumulators = dict(zip(['D', 'Dr', 'Df', 'G', 'gp'], distributed.mean([D_loss, Dr_loss, Df_loss, G_loss, gp_loss])))
+                    if(main_rank): checkpoints.save_step(D, G, optimizers, G_ema, progress_state(i, batch_ndx + 1, accumulators))
+                    last_save = time.time()
+                    if stopping:
+                        if(main_rank): checkpoints.wait()
+                        print("saved step checkpoint - exiting")
+                        sys.exit()
+
+            train_time = time.time() - epoch_start
+
+            D_loss, Dr_loss, Df_loss, G_loss, gp_loss = distributed.mean([D_loss, Dr_loss, Df_loss, G_loss, gp_loss])
+            distributed.synchronize(D)
+            distributed.synchronize(G)
+
             losses['D'].append(D_loss / (lenX / args.num_gen))
             losses['Dr'].append(Dr_loss / (lenX / args.num_gen))
             losses['Df'].append(Df_loss / (lenX / args.num_gen))
@@ -619,8 +867,9 @@ def main(args):
                         losses['Df'].append(dfloss)
                         losses['G'].append(gloss)
 
-                        if(j % 5 == 0):
-                            save_outputs.save_sample_outputs(args, D, G, normal_dist, args.name, i + 1, losses, k=k, j=j)
+                        if(j % 5 == 0 and main_rank):
+                            with ema.averaged(G_ema), timer.phase('plotting'):
+                                save_outputs.save_sample_outputs(args, D, G, normal_dist, args.name, i + 1, losses, k=k, j=j)
 
                         j += 1
 
@@ -629,20 +878,53 @@ def main(args):
                 if(i > 20 and gloss > dloss + args.bag):
                     print("gloss too high, resetting D params")
                     D.reset_params()
-
-            if((i + 1) % 5 == 0):
-                optimizers = optimizer if args.optimizer == 'acgd' else (D_optimizer, G_optimizer)
-                save_outputs.save_models(args, D, G, optimizers, args.name, i + 1)
-
-            if(args.fid and (i + 1) % 1 == 0):
-                losses['fid'].append(evaluation.get_fid(args, C, G, normal_dist, mu2, sigma2))
-
-            if((i + 1) % 5 == 0):
-                save_outputs.save_sample_outputs(args, D, G, normal_dist, args.name, i + 1, losses)
+                    distributed.broadcast(D)
+
+            evaluations = len(losses.get(best_key, []))
+
+            with ema.averaged(G_ema), threads.widened(thread_config):
+                if(args.fid and (i + 1) % 1 == 0 and main_rank):
+                    with timer.phase('evaluation'):
+                        losses['fid'].append(evaluation.get_fid(args, C, G, normal_dist, mu2, sigma2))
+
+                if((i + 1) % 5 == 0 and main_rank):
+                    with timer.phase('plotting'):
+                        save_outputs.save_sample_outputs(args, D, G, normal_dist, args.name, i + 1, losses)
+
+            log_metrics(i + 1, dict(timer.epoch_totals(), train=train_time))
+
+            # every rank stops together, after saving a checkpoint, once an evaluation leaves the fid without an
+            # improvement for the patience
+            evaluated = len(losses.get(best_key, [])) > evaluations
+            value = float(np.sum(losses[best_key][-1])) if evaluated else None
+            new_best = evaluated and value < best_value
+            if(new_best): best_value = value
+            plateaued = stopper is not None and evaluated and stopper.step(i + 1, value)
+            plateaued, = distributed.any_rank(plateaued)
+
+            # a member of a population may take over a better member's models and optimizers with new hyperparameters,
+            # before the checkpoint so resuming continues from them
+            if(member is not None and (i + 1) % member.interval == 0 and i + 1 < args.num_epochs and not plateaued):
+                member.exploit(i + 1, args, losses, D, G, optimizers, G_ema)
+
+            # after the evaluation so the checkpoint's losses include this epoch's, and its metric is there for the retention policy
+            if(((i + 1) % 5 == 0 or new_best or plateaued) and main_rank):
+                if(evaluated): checkpoints.record_metric(i + 1, checkpoints.best_metric, value)
+                checkpoints.save(i + 1, D, G, optimizers, G_ema=G_ema, progress=progress_state(i + 1, 0, dict.fromkeys(['D', 'Dr', 'Df', 'G', 'gp'], 0)))
+
+            if(plateaued):
+                if(main_rank):
+                    checkpoints.wait()
+                    print("fid hasn't improved since epoch %d - stopping, the best checkpoint is epoch %s" % (stopper.best_epoch, checkpoints.manifest.get('best')))
+                break
 
     train()
+    if(trace is not None): trace.stop()
+    if(main_rank): checkpoints.wait()
 
 
 if __name__ == "__main__":
     args = parse_args()
-    main(args)
+    # started by torchrun when the world size is in the environment
+    if(args.world_size > 1 and 'WORLD_SIZE' not in environ): distributed.spawn(main, args, args.world_size)
+    else: main(args)
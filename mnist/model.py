@@ -11,8 +11,24 @@ import torch_geometric.transforms as T
 
 from spectral_normalization import SpectralNorm
 
+from torch.utils.checkpoint import checkpoint
+
+from contextlib import nullcontext
+
+
+# reusable, so unprofiled forward passes don't create a context manager per region
+NO_REGION = nullcontext()
+
 
 class Graph_GAN(nn.Module):
+    # set by profiling.LayerProfiler.attach - a class attribute so models pickled before it existed load without it
+    profiler = None
+    # message passing activations recomputed in the backward pass rather than kept - 'none', 'edges' (each iteration's
+    # edge network) or 'iterations' (whole iterations). Set by main, as it changes memory use but not the model
+    activation_checkpointing = 'none'
+    # 'bf16' runs the message passing under bf16 autocast, keeping the weights and everything after it in fp32. Set by main
+    precision = 'fp32'
+
     def __init__(self, gen, args):
         super(Graph_GAN, self).__init__()
         self.args = args
@@ -152,37 +168,13 @@ class Graph_GAN(nn.Module):
             print(self.fnd)
 
     def forward(self, x):
-        batch_size = x.shape[0]
-
         # if(self.D): x = F.pad(x, (0, self.args.hidden_node_size - self.args.node_feat_size, 0, 0, 0, 0))
 
-        for i in range(self.args.mp_iters):
-            node_size = x.size(2)
-            fe_in_size = self.args.fe_in_size if i else self.args.fe1_in_size
-            fe_out_size = self.args.fe_out_size if i else self.args.fe1_out_size
-
-            # message passing
-            A = self.getA(x, batch_size, fe_in_size)
-
-            for j in range(len(self.fe[i])):
-                A = F.leaky_relu(self.fe[i][j](A), negative_slope=self.args.leaky_relu_alpha)
-                if(self.args.batch_norm): A = self.bne[i][j](A)  # try before activation
-                # if(self.args.spectral_norm): A = SpectralNorm(A)
-                A = self.dropout(A)
-
-            # message aggregation into new features
-            A = A.view(batch_size, self.args.num_hits, self.args.num_hits, fe_out_size)
-            A = torch.sum(A, 2) if self.args.sum else torch.mean(A, 2)
-            x = torch.cat((A, x), 2).view(batch_size * self.args.num_hits, fe_out_size + node_size)
-
-            for j in range(len(self.fn[i]) - 1):
-                x = F.leaky_relu(self.fn[i][j](x), negative_slope=self.args.leaky_relu_alpha)
-                if(self.args.batch_norm): x = self.bnn[i][j](x)
-                # if(self.args.spectral_norm): x = SpectralNorm(x)
-                x = self.dropout(x)
-
-            x = self.dropout(self.fn[i][-1](x))
-            x = x.view(batch_size, self.args.num_hits, self.args.hidden_node_size)
+        with self.autocast(x):
+            for i in range(self.args.mp_iters):
+                if self.activation_checkpointing == 'iterations' and torch.is_grad_enabled(): x = self.checkpointed(self.iteration, x, i)
+                else: x = self.iteration(x, i)
+        x = x.float()
 
         # print(x)
 
@@ -191,13 +183,14 @@ class Graph_GAN(nn.Module):
             return x
         else:
             if(self.args.dea):
-                x = torch.sum(x, 1) if self.args.sum else torch.mean(x, 1)
-                for i in range(len(self.fnd) - 1):
-                    x = F.leaky_relu(self.fnd[i](x), negative_slope=self.args.leaky_relu_alpha)
-                    if(self.args.batch_norm): x = self.bnd[i](x)
-                    # if(self.args.spectral_norm): x = SpectralNorm(x)
-                    x = self.dropout(x)
-                x = self.dropout(self.fnd[-1](x))
+                with self.region("dea", x):
+                    x = torch.sum(x, 1) if self.args.sum else torch.mean(x, 1)
+                    for i in range(len(self.fnd) - 1):
+                        x = F.leaky_relu(self.fnd[i](x), negative_slope=self.args.leaky_relu_alpha)
+                        if(self.args.batch_norm): x = self.bnd[i](x)
+                        # if(self.args.spectral_norm): x = SpectralNorm(x)
+                        x = self.dropout(x)
+                    x = self.dropout(self.fnd[-1](x))
             else:
                 # x = torch.sum(x[:, :, :1], 1) if self.args.sum else torch.mean(x[:, :, :1], 1)
                 x = torch.mean(x[:, :, :1], 1)
@@ -208,6 +201,103 @@ class Graph_GAN(nn.Module):
             return x if (self.args.loss == 'w' or self.args.loss == 'hinge') else torch.sigmoid(x)
             # return torch.sigmoid(x)
 
+    # message passing iteration i
+    def iteration(self, x, i):
+        batch_size = x.shape[0]
+        if self.activation_checkpointing == 'edges' and torch.is_grad_enabled(): x = self.checkpointed(self.edges, x, i)
+        else: x = self.edges(x, i)
+
+        with self.region("fn", x, i):
+            for j in range(len(self.fn[i]) - 1):
+                x = F.leaky_relu(self.fn[i][j](x), negative_slope=self.args.leaky_relu_alpha)
+                if(self.args.batch_norm): x = self.bnn[i][j](x)
+                # if(self.args.spectral_norm): x = SpectralNorm(x)
+                x = self.dropout(x)
+
+            x = self.dropout(self.fn[i][-1](x))
+            x = x.view(batch_size, self.args.num_hits, self.args.hidden_node_size)
+
+        return x
+
+    # the messages along every edge of iteration i, aggregated into each node's new features (concatenated with its
+    # current ones) - the batch_size * num_hits ** 2 edge activations, most of a forward pass's memory, are within
+    def edges(self, x, i):
+        batch_size = x.shape[0]
+        node_size = x.size(2)
+        fe_in_size = self.args.fe_in_size if i else self.args.fe1_in_size
+        fe_out_size = self.args.fe_out_size if i else self.args.fe1_out_size
+
+        # message passing
+        with self.region("getA", x, i):
+            A = self.getA(x, batch_size, fe_in_size)
+
+        with self.region("fe", x, i):
+            for j in range(len(self.fe[i])):
+                A = F.leaky_relu(self.fe[i][j](A), negative_slope=self.args.leaky_relu_alpha)
+                if(self.args.batch_norm): A = self.bne[i][j](A)  # try before activation
+                # if(self.args.spectral_norm): A = SpectralNorm(A)
+                A = self.dropout(A)
+
+        # message aggregation into new features
+        with self.region("aggregate", x, i):
+            A = A.view(batch_size, self.args.num_hits, self.args.num_hits, fe_out_size)
+            A = torch.sum(A, 2) if self.args.sum else torch.mean(A, 2)
+            x = torch.cat((A, x), 2).view(batch_size * self.args.num_hits, fe_out_size + node_size)
+
+        return x
+
+    # fn(*inputs), with its activations recomputed in the backward pass rather than kept. The random number generator
+    # state is restored for the recomputation so dropout masks are the same, and batch norm's running statistics and
+    # spectral norm's power iteration aren't updated a second time
+    def checkpointed(self, fn, *inputs):
+        vectors = []
+
+        def run(*inputs):
+            if len(vectors): return self.recompute(fn, inputs, vectors[0])
+            output = fn(*inputs)
+            # spectral norm's u and v as this pass left them, as later passes update them before the backward pass
+            vectors.append(self.spectral_norm_vectors())
+            return output
+
+        # while a LayerProfiler is attached its saved tensor hooks take the place of the checkpoint's, so everything is kept
+        return checkpoint(run, *inputs, use_reentrant=False, preserve_rng_state=True)
+
+    # u, v and the number of power iterations of every spectral norm - SpectralNorm replaces u and v rather than
+    # updating them in place, so they're kept as they are
+    def spectral_norm_vectors(self):
+        return [(module, getattr(module.module, module.name + "_u").data, getattr(module.module, module.name + "_v").data, module.power_iterations) for module in self.modules() if isinstance(module, SpectralNorm)]
+
+    def set_spectral_norm_vectors(self, vectors, power_iterations=None):
+        for module, u, v, iterations in vectors:
+            getattr(module.module, module.name + "_u").data = u
+            getattr(module.module, module.name + "_v").data = v
+            module.power_iterations = iterations if power_iterations is None else power_iterations
+
+    def recompute(self, fn, inputs, vectors):
+        batch_norms = [module for module in self.modules() if isinstance(module, nn.BatchNorm1d)]
+        momenta = [(module.momentum, module.num_batches_tracked.clone()) for module in batch_norms]
+        current = self.spectral_norm_vectors()
+        try:
+            for module in batch_norms: module.momentum = 0
+            self.set_spectral_norm_vectors(vectors, power_iterations=0)
+            return fn(*inputs)
+        finally:
+            for module, (momentum, tracked) in zip(batch_norms, momenta):
+                module.momentum = momentum
+                module.num_batches_tracked.copy_(tracked)
+            self.set_spectral_norm_vectors(current)
+
+    # the linear layers run in bf16 within, and their outputs, the edge activations included, are kept in bf16
+    def autocast(self, x):
+        if self.precision == 'fp32': return NO_REGION
+        return torch.autocast(x.device.type, dtype=torch.bfloat16)
+
+    # a named region of the forward pass (of message passing iteration i if given), timed and counted by the attached
+    # profiler if there is one
+    def region(self, name, x, i=None):
+        if self.profiler is None: return NO_REGION
+        return self.profiler.region(("G " if self.G else "D ") + ("mp%d " % i if i is not None else "") + name, x.device)
+
     def getA(self, x, batch_size, fe_in_size):
         node_size = x.size(2)
         x1 = x.repeat(1, 1, self.args.num_hits).view(batch_size, self.args.num_hits * self.args.num_hits, node_size)
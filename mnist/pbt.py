@@ -0,0 +1,211 @@
+# population based training - a population of runs of main.py trained in parallel, each pinned to its own block of cores
+# and sharing one dataset in shared memory as the runs of a sweep do (see sweep.py). Every --interval epochs the members
+# are ranked by their latest FID, lowest first, and each of the bottom --truncation of the population takes over the
+# models, EMA and optimizer states of a random one of the top --truncation (exploit), then continues training with that
+# member's hyperparameters perturbed (explore) - learning rates scaled by 0.8 or 1.2, dropout moved by 0.05 within
+# [0, 0.9] and num critic by 1. States are handed over through pipes to the driver, in shared memory, rather than
+# written to checkpoint files and loaded. The hyperparameters tuned can be any of HYPERPARAMETERS, each given with the
+# values the population starts from as in sweep.py e.g. lr-disc=log:1e-5:1e-3 for log-uniform random ones. Member i is
+# named <population>_<i>, and its new hyperparameters are written to its args file so that it resumes with them. The
+# registry's sweeps table has each member's current hyperparameters, so python registry.py sweep fid --sweep
+# <population> lists the population
+# python pbt.py <population> <flag>=<values> ... [--size 8] [--interval 10] -- <main.py args>
+# e.g. python pbt.py p lr-disc=log:1e-5:1e-3 lr-gen=log:1e-6:1e-4 num-critic=int:1:3 disc-dropout=uniform:0.2:0.6
+
+import torch.multiprocessing as mp
+import main
+import sweep
+import checkpoint
+import registry
+
+import sys
+import random
+import signal
+import argparse
+from os import mkdir
+from os.path import exists
+
+import numpy as np
+
+
+# hyperparameters which can be changed while training
+HYPERPARAMETERS = ['lr-disc', 'lr-gen', 'num-critic', 'disc-dropout', 'gen-dropout']
+MAX_DROPOUT = 0.9
+
+
+def perturb(rng, hyperparameters):
+    perturbed = {}
+    for flag, value in hyperparameters.items():
+        if flag == 'num-critic': perturbed[flag] = max(1, value + rng.choice([-1, 1]))
+        elif flag.endswith('dropout'): perturbed[flag] = round(min(max(value + rng.choice([-0.05, 0.05]), 0), MAX_DROPOUT), 4)
+        else: perturbed[flag] = value * rng.choice([0.8, 1.2])
+    return perturbed
+
+
+# latest value of the metric the population is ranked by, inf if it hasn't been computed yet
+def score(args, losses, metric):
+    value = float(losses[metric][-1]) if len(losses.get(metric, [])) else float('inf')
+    return value if np.isfinite(value) else float('inf')
+
+
+def set_hyperparameters(args, D, G, optimizers, hyperparameters):
+    for flag, value in hyperparameters.items():
+        setattr(args, flag.replace('-', '_'), value)
+    for group in optimizers[0].param_groups: group['lr'] = args.lr_disc
+    for group in optimizers[1].param_groups: group['lr'] = args.lr_gen
+    D.dropout.p, G.dropout.p = args.disc_dropout, args.gen_dropout
+
+
+class Member(object):
+    # a run's end of its pipe to the driver, passed to main
+    def __init__(self, conn, interval, metric, tuned):
+        self.conn = conn
+        self.interval = interval
+        self.metric = metric
+        self.tuned = tuned
+
+    # reports the run's score and hyperparameters and waits for the driver to rank the population - which may ask for
+    # the run's state for a worse member, and may send a better member's state and hyperparameters to continue from
+    def exploit(self, epoch, args, losses, D, G, optimizers, G_ema):
+        self.conn.send((epoch, score(args, losses, self.metric), {flag: getattr(args, flag.replace('-', '_')) for flag in self.tuned}))
+        message = self.conn.recv()
+        if message == 'send':
+            self.conn.send(checkpoint.snapshot({'D': D.state_dict(), 'G': G.state_dict(), 'D_optim': optimizers[0].state_dict(), 'G_optim': optimizers[1].state_dict(),
+                                                'G_ema': G_ema.state_dict() if G_ema is not None else None}))
+            message = self.conn.recv()
+        if message is None: return
+
+        donor, state, hyperparameters = message
+        D.load_state_dict(state['D'])
+        G.load_state_dict(state['G'])
+        optimizers[0].load_state_dict(state['D_optim'])
+        optimizers[1].load_state_dict(state['G_optim'])
+        if G_ema is not None and state['G_ema'] is not None: G_ema.load_state_dict(state['G_ema'])
+        set_hyperparameters(args, D, G, optimizers, hyperparameters)
+        print("continuing from " + donor + "'s models with " + str(hyperparameters))
+
+        f = open(args.args_path + args.name + ".txt", "w")
+        f.write(str(checkpoint.args_dict(args)))
+        f.close()
+
+
+def population_based_training(name, space, base_argv, size=8, interval=10, truncation=0.25, metric='fid', seed=0):
+    if any(flag not in HYPERPARAMETERS for flag in space):
+        print("only " + ", ".join(HYPERPARAMETERS) + " can be tuned - exiting")
+        sys.exit()
+
+    members = [(name + "_" + str(i), params) for i, params in enumerate(sweep.configs(space, size, seed))]
+    argvs = {member_name: sweep.run_argv(base_argv, params, member_name) for member_name, params in members}
+    args = {member_name: main.parse_args(argv) for member_name, argv in argvs.items()}
+    first = args[members[0][0]]
+
+    if(first.world_size > 1):
+        print("members are single processes, they can't have a world size - exiting")
+        sys.exit()
+
+    if(first.gcnn or first.optimizer == 'acgd'):
+        print("population based training doesn't support gcnn or acgd - exiting")
+        sys.exit()
+
+    if(not first.fid):
+        print("fid isn't calculated, run with --fid - exiting")
+        sys.exit()
+
+    runs_registry = registry.Registry(first.dir_path + "/")
+    log_path = first.dir_path + "/sweeps/" + name + "/"
+    if(not exists(first.dir_path + "/sweeps/")):
+        mkdir(first.dir_path + "/sweeps/")
+    if(not exists(log_path)):
+        mkdir(log_path)
+
+    # the members only differ in hyperparameters the dataset doesn't depend on
+    print("loading data")
+    main.set_paths(first)
+    X = sweep.share(main.load_dataset(first))
+
+    # on SIGTERM the members save a step checkpoint and exit
+    stop = []
+    processes, conns = {}, {}
+
+    def terminate(signum, frame):
+        stop.append(signum)
+        for process in processes.values(): process.terminate()
+
+    signal.signal(signal.SIGTERM, terminate)
+
+    context = mp.get_context('spawn')
+    for slot, (member_name, params) in enumerate(members):
+        conn, member_conn = context.Pipe()
+        processes[member_name] = context.Process(target=sweep.run, args=(argvs[member_name], X, slot, size, log_path + member_name + ".txt", Member(member_conn, interval, metric, list(space))))
+        processes[member_name].start()
+        member_conn.close()
+        conns[member_name] = conn
+        hyperparameters = {flag: getattr(args[member_name], flag.replace('-', '_')) for flag in space}
+        runs_registry.add_sweep_run(name, member_name, hyperparameters)
+        print("started " + member_name + " " + str(hyperparameters))
+
+    def finish(member_name):
+        processes[member_name].join()
+        del conns[member_name]
+        status = 'stopped' if len(stop) else 'finished' if processes[member_name].exitcode == 0 else 'failed'
+        runs_registry.finish_sweep_run(name, member_name, status)
+        print(member_name + " " + status)
+
+    rng = random.Random(seed)
+    while len(conns):
+        reports = {}
+        for member_name in list(conns):
+            try:
+                reports[member_name] = conns[member_name].recv()
+            except EOFError:
+                finish(member_name)
+
+        ranked = sorted(reports, key=lambda member_name: reports[member_name][1])
+        cut = max(1, int(len(ranked) * truncation)) if truncation and len(ranked) > 1 else 0
+        donors = {member_name: rng.choice(ranked[:cut]) for member_name in ranked[len(ranked) - cut:]}
+        if len(ranked): print("epoch %d: " % reports[ranked[0]][0] + ", ".join("%s %s %.6g" % (member_name, metric, reports[member_name][1]) for member_name in ranked))
+
+        states = {}
+        for donor in set(donors.values()):
+            try:
+                conns[donor].send('send')
+                states[donor] = conns[donor].recv()
+            except (EOFError, BrokenPipeError):
+                finish(donor)
+
+        for member_name in reports:
+            if member_name not in conns: continue
+            try:
+                if member_name in donors and donors[member_name] in states:
+                    donor = donors[member_name]
+                    hyperparameters = perturb(rng, reports[donor][2])
+                    conns[member_name].send((donor, states[donor], hyperparameters))
+                    runs_registry.update_sweep_run(name, member_name, hyperparameters)
+                    print("%s <- %s with %s" % (member_name, donor, str(hyperparameters)))
+                else: conns[member_name].send(None)
+            except BrokenPipeError:
+                finish(member_name)
+
+    for row in runs_registry.sweep(name, metric):
+        print("%-20s %-9s epoch %5s    %s %s    %s" % (row[0], row[2], row[3] if row[3] is not None else "-", metric, "%.6g" % row[4] if row[4] is not None else "-", row[1]))
+
+
+if __name__ == "__main__":
+    argv = sys.argv[1:]
+    base_argv = argv[argv.index('--') + 1:] if '--' in argv else []
+    argv = argv[:argv.index('--')] if '--' in argv else argv
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("name", type=str, help="name of the population, its members are named <name>_<index>")
+    parser.add_argument("space", type=str, nargs='+', help="hyperparameters to tune as <flag>=<values> with the values to start from, e.g. lr-disc=log:1e-5:1e-3")
+    parser.add_argument("--size", type=int, default=8, help="number of members of the population, all trained at once")
+    parser.add_argument("--interval", type=int, default=10, help="epochs between rankings of the population")
+    parser.add_argument("--truncation", type=float, default=0.25, help="fraction of the population replaced by, and taken from, at each ranking")
+    parser.add_argument("--seed", type=int, default=0, help="seed of the initial hyperparameters and of the exploit and explore steps")
+    opts = parser.parse_args(argv)
+
+    if(opts.size < 1 or opts.interval < 1 or not (0 <= opts.truncation <= 0.5)):
+        print("size and interval must be at least 1 and truncation in [0, 0.5] - exiting")
+        sys.exit()
+
+    population_based_training(opts.name, sweep.parse_space(opts.space), base_argv, opts.size, opts.interval, opts.truncation, seed=opts.seed)
@@ -0,0 +1,189 @@
+# where training time goes - wall time per phase of the training step (data loading, forward passes, backward, optimizer
+# steps) and of evaluation and plotting, summed over each epoch and saved with the epoch's metrics, and an optional
+# window of steps traced with torch.profiler and saved as a Chrome trace (open in chrome://tracing or ui.perfetto.dev).
+# LayerProfiler breaks a Graph_GAN's forward pass down further, into each message passing iteration's stages, and
+# peak_memory measures the most memory a function allocates
+
+import torch
+
+import os
+import time
+import ctypes
+from collections import defaultdict
+from contextlib import contextmanager
+
+
+class PhaseTimer(object):
+    # phases are also labelled in profiler traces. On GPU the times are of the host side only, as kernels run asynchronously
+    def __init__(self):
+        self.totals = defaultdict(float)
+
+    @contextmanager
+    def phase(self, name):
+        start = time.perf_counter()
+        try:
+            with torch.profiler.record_function(name):
+                yield
+        finally:
+            self.totals[name] += time.perf_counter() - start
+
+    # the iterable's items, with the time taken getting each counted as the phase e.g. waiting for the data loader
+    def iterate(self, name, iterable):
+        iterator = iter(iterable)
+        while True:
+            with self.phase(name):
+                try:
+                    item = next(iterator)
+                except StopIteration:
+                    return
+            yield item
+
+    # seconds spent in each phase since the last call
+    def epoch_totals(self):
+        totals = dict(self.totals)
+        self.totals.clear()
+        return totals
+
+
+class TraceWindow(object):
+    # traces the steps from start (counted from the first step of this run) for the given number of steps, then saves
+    # the trace to path and stops the profiler so the rest of training runs without it
+    def __init__(self, path, start, steps):
+        activities = [torch.profiler.ProfilerActivity.CPU] + ([torch.profiler.ProfilerActivity.CUDA] if torch.cuda.is_available() else [])
+        # one untraced warmup step before the window, as the first traced step carries the profiler's startup cost
+        schedule = torch.profiler.schedule(wait=max(start - 1, 0), warmup=min(start, 1), active=steps, repeat=1)
+        self.path = path
+        self.remaining = start + steps
+        self.profiler = torch.profiler.profile(activities=activities, schedule=schedule, record_shapes=True, profile_memory=True, on_trace_ready=self.save)
+        self.profiler.start()
+
+    def save(self, profiler):
+        profiler.export_chrome_trace(self.path)
+        print("saved profiler trace to " + self.path)
+
+    def step(self):
+        if self.profiler is None: return
+        self.profiler.step()
+        self.remaining -= 1
+        if self.remaining == 0: self.stop()
+
+    # also saves the trace if training ends during the window
+    def stop(self):
+        if self.profiler is None: return
+        self.profiler.stop()
+        self.profiler = None
+
+
+class LayerProfiler(object):
+    # time, FLOPs and memory of the named regions of the forward passes of the Graph_GANs attached to it - each message
+    # passing iteration's getA, edge network (fe), aggregation and node network (fn), e.g. "G mp1 fe". FLOPs are of the
+    # linear layers (2 * in features * out features per row), which are nearly all of a Graph_GAN's. saved is the bytes of
+    # the activations kept for the backward pass, and peak the most allocated at once above the start of the region on GPU,
+    # or on CPU the largest tensor a layer of the region takes or returns or the region keeps. On GPU every region
+    # synchronizes, so the times are of the kernels but training is slower while attached. callback, if given, is called
+    # with the region's name and record at the end of each region
+    def __init__(self, callback=None):
+        self.callback = callback
+        self.records = {}
+        self.current = None
+        self.models = []
+        # parameters are saved for the backward pass too, but aren't counted as they're kept anyway
+        self.parameters = set()
+
+    def attach(self, model):
+        handles = [layer.register_forward_hook(self.count) for layers in list(model.fe) + list(model.fn) for layer in layers]
+        if model.args.dea: handles += [layer.register_forward_hook(self.count) for layer in model.fnd]
+        model.profiler = self
+        self.models.append((model, handles))
+        self.parameters.update(parameter.data_ptr() for parameter in model.parameters())
+
+    def detach(self):
+        for model, handles in self.models:
+            for handle in handles: handle.remove()
+            model.profiler = None
+        self.models = []
+        self.parameters = set()
+
+    def count(self, layer, inputs, output):
+        if self.current is None: return
+        self.current['flops'] += 2 * output.numel() * inputs[0].size(-1)
+        if not output.is_cuda:
+            self.current['peak'] = max(self.current['peak'], inputs[0].numel() * inputs[0].element_size(), output.numel() * output.element_size())
+
+    def save(self, tensor):
+        # tensors saved by more than one op (e.g. a layer's input and the activation before it) count once
+        if self.current is not None and tensor.data_ptr() not in self.current['tensors'] and tensor.data_ptr() not in self.parameters:
+            self.current['tensors'].add(tensor.data_ptr())
+            self.current['saved'] += tensor.numel() * tensor.element_size()
+            if not tensor.is_cuda: self.current['peak'] = max(self.current['peak'], tensor.numel() * tensor.element_size())
+        return tensor
+
+    @contextmanager
+    def region(self, name, device):
+        cuda = device.type == 'cuda'
+        if cuda:
+            torch.cuda.synchronize(device)
+            allocated = torch.cuda.memory_allocated(device)
+            torch.cuda.reset_peak_memory_stats(device)
+
+        self.current = {'flops': 0, 'saved': 0, 'peak': 0, 'tensors': set()}
+        start = time.perf_counter()
+        try:
+            with torch.profiler.record_function(name), torch.autograd.graph.saved_tensors_hooks(self.save, lambda tensor: tensor):
+                yield
+        finally:
+            if cuda:
+                torch.cuda.synchronize(device)
+                self.current['peak'] = torch.cuda.max_memory_allocated(device) - allocated
+            record = {'calls': 1, 'seconds': time.perf_counter() - start, 'flops': self.current['flops'], 'saved': self.current['saved'], 'peak': self.current['peak']}
+            self.current = None
+            self.add(name, record)
+
+    def add(self, name, record):
+        if name in self.records:
+            total = self.records[name]
+            for key in ['calls', 'seconds', 'flops', 'saved']: total[key] += record[key]
+            total['peak'] = max(total['peak'], record['peak'])
+        else:
+            self.records[name] = dict(record)
+        if self.callback is not None: self.callback(name, record)
+
+    def reset(self):
+        self.records = {}
+
+    # per call averages of each region, in the order they were first run
+    def summary(self):
+        lines = ["%-18s %8s %10s %10s %10s %10s" % ("region", "calls", "ms", "MFLOPs", "saved MB", "peak MB")]
+        for name, record in self.records.items():
+            calls = record['calls']
+            lines.append("%-18s %8d %10.3f %10.2f %10.2f %10.2f" % (name, calls, 1000 * record['seconds'] / calls, record['flops'] / calls / 1e6, record['saved'] / calls / 2 ** 20, record['peak'] / 2 ** 20))
+        return "\n".join(lines)
+
+
+def proc_status(key):
+    with open("/proc/self/status", "r") as f:
+        for line in f:
+            if line.startswith(key): return int(line.split()[1]) * 1024
+
+
+# most memory allocated at once while running fn, above what was allocated before it. On CPU this is the process's peak
+# resident memory, reset (Linux only) after returning freed memory to the system so it starts from what's in use - None
+# where that's not possible
+def peak_memory(fn, device):
+    if device.type == 'cuda':
+        torch.cuda.synchronize(device)
+        start = torch.cuda.memory_allocated(device)
+        torch.cuda.reset_peak_memory_stats(device)
+        fn()
+        torch.cuda.synchronize(device)
+        return torch.cuda.max_memory_allocated(device) - start
+
+    if not os.path.exists("/proc/self/clear_refs"): return None
+    try:
+        ctypes.CDLL("libc.so.6").malloc_trim(0)
+        with open("/proc/self/clear_refs", "w") as f: f.write("5")
+    except OSError:
+        return None
+    start = proc_status("VmRSS")
+    fn()
+    return proc_status("VmHWM") - start
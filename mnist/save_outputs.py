@@ -116,13 +116,6 @@ def save_sample_outputs(args, D, G, dist, name, epoch, losses, k=-1, j=-1):
         plt.savefig(args.losses_path + name + "_fid.pdf", bbox_inches='tight')
         plt.close()
 
-    if(args.gp): np.savetxt(args.losses_path + args.name + "/" + "gp.txt", losses['gp'])
-    np.savetxt(args.losses_path + args.name + "/" + "D.txt", losses['D'])
-    np.savetxt(args.losses_path + args.name + "/" + "G.txt", losses['G'])
-    np.savetxt(args.losses_path + args.name + "/" + "Dr.txt", losses['Dr'])
-    np.savetxt(args.losses_path + args.name + "/" + "Df.txt", losses['Df'])
-    if args.fid: np.savetxt(args.losses_path + args.name + "/" + "fid.txt", losses['fid'])
-
     try:
         if(j == -1):
             remove(args.losses_path + args.name + "/" + str(epoch - 5) + ".pdf")
@@ -132,14 +125,3 @@ def save_sample_outputs(args, D, G, dist, name, epoch, losses, k=-1, j=-1):
         print("couldn't remove loss file")
 
     print("saved figs")
-
-
-def save_models(args, D, G, optimizers, name, epoch, k=-1, j=-1):
-    g_only = "_g_only_" + str(k) + "_" + str(j) if j > -1 else ""
-    torch.save(D, args.model_path + args.name + "/D_" + str(epoch) + g_only + ".pt")
-    torch.save(G, args.model_path + args.name + "/G_" + str(epoch) + g_only + ".pt")
-    if(args.optimizer == 'acgd'):
-        torch.save(optimizers.state_dict(), args.model_path + args.name + "/optim_" + str(epoch) + g_only + ".pt")
-    else:
-        torch.save(optimizers[0].state_dict(), args.model_path + args.name + "/D_optim_" + str(epoch) + g_only + ".pt")
-        torch.save(optimizers[1].state_dict(), args.model_path + args.name + "/G_optim_" + str(epoch) + g_only + ".pt")
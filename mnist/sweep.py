@@ -0,0 +1,192 @@
+# hyperparameter sweeps - runs of main.py over a grid or random search space of its args, run concurrently on this host.
+# Each arg swept over is given as <flag>=<values>, with the values either listed e.g. lr-disc=1e-5,3e-5,1e-4 (true and
+# false for flags like batch-norm-disc) or drawn from a distribution over [low, high] - uniform:<low>:<high>,
+# log:<low>:<high> (log-uniform) or int:<low>:<high> - and every combination of the listed values is run, or with
+# --samples that many random configs. The runs are started in new processes, --parallel at a time, each pinned to its
+# own block of --cores-per-run physical cores or more (as the data parallel ranks of a host are by threads.py). The
+# dataset is loaded and normalized once, here, and its tensors moved into shared memory, which every run maps instead of
+# loading its own copy - one load for each combination of the args it depends on, so only one unless they're swept over.
+# Run i is named <sweep>_<i> and records its metrics in the registry as usual, where the sweeps table has the values it
+# was given and whether it finished, so python registry.py sweep <metric> --sweep <sweep> compares them. Its output goes
+# to sweeps/<sweep>/<sweep>_<i>.txt in the dir path. Running a sweep again skips the runs that finished and resumes the
+# rest from their checkpoints - on SIGTERM the running ones save a step checkpoint and the sweep exits
+# python sweep.py <sweep> <flag>=<values> ... [--samples 16] [--cores-per-run 2] -- <main.py args>
+# e.g. python sweep.py lr lr-disc=log:1e-5:1e-3 lr-gen=log:1e-6:1e-4 --samples 16 -- --num-epochs 100
+
+import torch
+import torch.multiprocessing as mp
+from torch_geometric.data import Data
+import main
+import registry
+import threads
+
+import os
+import sys
+import math
+import random
+import signal
+import argparse
+import itertools
+from os import mkdir
+from os.path import exists
+from multiprocessing.connection import wait
+
+
+# args the dataset depends on - runs differing in any of them can't share one
+DATASET_ARGS = ['dir_path', 'sparse_mnist', 'gcnn', 'num_hits', 'train', 'num']
+DISTRIBUTIONS = ['uniform', 'log', 'int']
+
+
+# flag -> list of values, or (distribution, low, high)
+def parse_space(specs):
+    space = {}
+    for spec in specs:
+        if '=' not in spec:
+            print("invalid search space " + spec + " - exiting")
+            sys.exit()
+        flag, values = spec.split('=', 1)
+        parts = values.split(':')
+        if parts[0] in DISTRIBUTIONS and len(parts) == 3: space[flag.replace('_', '-')] = (parts[0], float(parts[1]), float(parts[2]))
+        else: space[flag.replace('_', '-')] = values.split(',')
+    return space
+
+
+def sample(rng, values):
+    if isinstance(values, list): return rng.choice(values)
+    distribution, low, high = values
+    if distribution == 'int': return str(rng.randint(int(low), int(high)))
+    if distribution == 'log': return "%.3g" % math.exp(rng.uniform(math.log(low), math.log(high)))
+    return "%.3g" % rng.uniform(low, high)
+
+
+# the values of the flags of each run - every combination of the listed values, or samples random ones
+def configs(space, samples=0, seed=0):
+    if samples:
+        rng = random.Random(seed)
+        return [{flag: sample(rng, values) for flag, values in space.items()} for i in range(samples)]
+
+    if any(not isinstance(values, list) for values in space.values()):
+        print("a grid can only have listed values, give --samples for random ones - exiting")
+        sys.exit()
+    return [dict(zip(space, values)) for values in itertools.product(*space.values())]
+
+
+def run_argv(base_argv, params, name):
+    argv = list(base_argv)
+    for flag, value in params.items():
+        if value == 'true': argv.append('--' + flag)
+        elif value == 'false': argv.append('--no-' + flag)
+        else: argv += ['--' + flag] + value.split()
+    return argv + ['--name', name]
+
+
+# moves the dataset's tensors into shared memory, so processes it's passed to map them instead of copying them - those
+# stored as its attributes, and for the gcnn's in memory torch_geometric dataset those of its Data object and slices
+def share(dataset):
+    for value in vars(dataset).values():
+        if torch.is_tensor(value): value.share_memory_()
+        elif isinstance(value, Data): value.apply(lambda tensor: tensor.share_memory_())
+        elif isinstance(value, dict):
+            for tensor in value.values():
+                if torch.is_tensor(tensor): tensor.share_memory_()
+    return dataset
+
+
+# runs main.py in this process as the slot'th of parallel runs sharing the host's cores, as a member of a population
+# if given (see pbt.py)
+def run(argv, X, slot, parallel, log, member=None):
+    os.environ.update({'LOCAL_RANK': str(slot), 'LOCAL_WORLD_SIZE': str(parallel)})
+    os.environ.setdefault(threads.ENV_PREFIX + 'CPU_AFFINITY', 'cores')
+    sys.stdout = sys.stderr = open(log, "w", buffering=1)
+    main.main(main.parse_args(argv), X, member)
+
+
+def sweep(name, space, base_argv, samples=0, seed=0, cores_per_run=1, parallel=0, metric="fid"):
+    runs = [(name + "_" + str(i), params) for i, params in enumerate(configs(space, samples, seed))]
+    args = {run_name: main.parse_args(run_argv(base_argv, params, run_name)) for run_name, params in runs}
+    if any(run_args.world_size > 1 for run_args in args.values()):
+        print("sweep runs are single processes, they can't have a world size - exiting")
+        sys.exit()
+
+    dir_path = args[runs[0][0]].dir_path
+    runs_registry = registry.Registry(dir_path + "/")
+    finished = [row[0] for row in runs_registry.sweep(name, metric) if row[2] == 'finished']
+    runs = [(run_name, params) for run_name, params in runs if run_name not in finished]
+    print("%d runs, %d already finished" % (len(runs) + len(finished), len(finished)))
+
+    log_path = dir_path + "/sweeps/" + name + "/"
+    if(not exists(dir_path + "/sweeps/")):
+        mkdir(dir_path + "/sweeps/")
+    if(not exists(log_path)):
+        mkdir(log_path)
+
+    # one dataset for each combination of the args it depends on
+    datasets, X = {}, {}
+    for run_name, params in runs:
+        key = tuple(str(getattr(args[run_name], arg)) for arg in DATASET_ARGS)
+        if key not in datasets:
+            print("loading data")
+            main.set_paths(args[run_name])
+            if(not exists(args[run_name].dataset_path)):
+                mkdir(args[run_name].dataset_path)
+                main.download_dataset(args[run_name])
+            datasets[key] = share(main.load_dataset(args[run_name]))
+        X[run_name] = datasets[key]
+
+    if not parallel: parallel = max(1, len(threads.physical_cores(os.sched_getaffinity(0))) // cores_per_run)
+    print("running %d at a time" % parallel)
+
+    # on SIGTERM the running runs save a step checkpoint and exit, and no more are started
+    stop = []
+    signal.signal(signal.SIGTERM, lambda signum, frame: stop.append(signum))
+
+    context = mp.get_context('spawn')
+    free = list(range(parallel))
+    running = {}
+    terminated = False
+    while (len(runs) and not len(stop)) or len(running):
+        while len(runs) and len(free) and not len(stop):
+            run_name, params = runs.pop(0)
+            slot = free.pop(0)
+            process = context.Process(target=run, args=(run_argv(base_argv, params, run_name), X[run_name], slot, parallel, log_path + run_name + ".txt"))
+            process.start()
+            running[process.sentinel] = (run_name, slot, process)
+            runs_registry.add_sweep_run(name, run_name, params)
+            print("started " + run_name + " " + str(params))
+
+        if len(stop) and not terminated:
+            for run_name, slot, process in running.values(): process.terminate()
+            terminated = True
+
+        for sentinel in wait(list(running), timeout=1):
+            run_name, slot, process = running.pop(sentinel)
+            process.join()
+            free.append(slot)
+            status = 'finished' if process.exitcode == 0 and not len(stop) else 'stopped' if len(stop) else 'failed'
+            runs_registry.finish_sweep_run(name, run_name, status)
+            print(run_name + " " + status + ("" if process.exitcode == 0 else " with exit code " + str(process.exitcode)))
+
+    for row in runs_registry.sweep(name, metric):
+        print("%-20s %-9s epoch %5s    %s %s    %s" % (row[0], row[2], row[3] if row[3] is not None else "-", metric, "%.6g" % row[4] if row[4] is not None else "-", row[1]))
+
+
+if __name__ == "__main__":
+    argv = sys.argv[1:]
+    base_argv = argv[argv.index('--') + 1:] if '--' in argv else []
+    argv = argv[:argv.index('--')] if '--' in argv else argv
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("name", type=str, help="name of the sweep, its runs are named <name>_<index>")
+    parser.add_argument("space", type=str, nargs='+', help="args to sweep over as <flag>=<values>, e.g. lr-disc=1e-5,3e-5 or lr-gen=log:1e-6:1e-4")
+    parser.add_argument("--samples", type=int, default=0, help="number of random configs to run - 0 means every combination of the listed values")
+    parser.add_argument("--seed", type=int, default=0, help="seed of the random configs")
+    parser.add_argument("--cores-per-run", type=int, default=1, help="physical cores each run is pinned to")
+    parser.add_argument("--parallel", type=int, default=0, help="number of runs at a time - 0 means as many as the cores allow")
+    parser.add_argument("--metric", type=str, default="fid", help="metric the runs are listed by at the end")
+    opts = parser.parse_args(argv)
+
+    if(opts.samples < 0 or opts.cores_per_run < 1 or opts.parallel < 0):
+        print("samples and parallel can't be negative and cores per run must be at least 1 - exiting")
+        sys.exit()
+
+    sweep(opts.name, parse_space(opts.space), base_argv, opts.samples, opts.seed, opts.cores_per_run, opts.parallel, opts.metric)
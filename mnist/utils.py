@@ -1,8 +1,11 @@
 import torch
 from torch_geometric.data import Batch, Data
 
-from torch.autograd import Variable
 from torch.autograd import grad as torch_grad
+from torch.func import functional_call
+
+# augment only uses utils when called, so importing each other is fine
+import augment
 
 import numpy as np
 from scipy import linalg
@@ -96,48 +99,63 @@ def tg_transform(args, X):
 
 # from https://github.com/EmilienDupont/wgan-gp
 def gradient_penalty(args, D, real_data, generated_data, batch_size):
+    # the penalty can be computed on a sub-batch - the mean over it is still an unbiased estimate
+    gp_batch_size = min(args.gp_batch_size, batch_size) if args.gp_batch_size else batch_size
+
     # Calculate interpolation
+    alpha = torch.rand(gp_batch_size, 1, 1).to(args.device)
+
     if(not args.gcnn):
-        alpha = torch.rand(batch_size, 1, 1).to(args.device)
-        alpha = alpha.expand_as(real_data)
-        interpolated = alpha * real_data + (1 - alpha) * generated_data
-        interpolated = Variable(interpolated, requires_grad=True).to(args.device)
+        interpolated = alpha * real_data[:gp_batch_size] + (1 - alpha) * generated_data[:gp_batch_size]
+        interpolated = interpolated.detach().requires_grad_(True)
+        inputs = [interpolated]
+    elif(args.gp_real_edges):
+        interpolated, inputs = interpolate_graphs(args, real_data, generated_data, alpha, gp_batch_size)
     else:
-        alpha = torch.rand(batch_size, 1, 1).to(args.device)
-        alpha_x = alpha.expand((batch_size, args.num_hits, 1))
-        interpolated_x = alpha_x * real_data.x.reshape(batch_size, args.num_hits, 1) + (1 - alpha_x) * generated_data.x.reshape(batch_size, args.num_hits, 1)
-        alpha_pos = alpha.expand((batch_size, args.num_hits, 2))
-        interpolated_pos = alpha_pos * real_data.pos.reshape(batch_size, args.num_hits, 2) + (1 - alpha_pos) * generated_data.pos.reshape(batch_size, args.num_hits, 2)
-        interpolated_X = Variable(torch.cat(((interpolated_pos - 14) / 28, interpolated_x - 0.5), dim=2), requires_grad=True)
+        alpha_x = alpha.expand((gp_batch_size, args.num_hits, 1))
+        interpolated_x = alpha_x * real_data.x[:gp_batch_size * args.num_hits].reshape(gp_batch_size, args.num_hits, 1) + (1 - alpha_x) * generated_data.x[:gp_batch_size * args.num_hits].reshape(gp_batch_size, args.num_hits, 1)
+        alpha_pos = alpha.expand((gp_batch_size, args.num_hits, 2))
+        interpolated_pos = alpha_pos * real_data.pos[:gp_batch_size * args.num_hits].reshape(gp_batch_size, args.num_hits, 2) + (1 - alpha_pos) * generated_data.pos[:gp_batch_size * args.num_hits].reshape(gp_batch_size, args.num_hits, 2)
+        interpolated_X = torch.cat(((interpolated_pos - 14) / 28, interpolated_x - 0.5), dim=2).detach().requires_grad_(True)
         interpolated = tg_transform(args, interpolated_X)
-
-    del alpha
-    torch.cuda.empty_cache()
+        inputs = [interpolated_X]
 
     # Calculate probability of interpolated examples
     prob_interpolated = D(interpolated)
 
     # Calculate gradients of probabilities with respect to examples
-    if(not args.gcnn):
-        gradients = torch_grad(outputs=prob_interpolated, inputs=interpolated, grad_outputs=torch.ones(prob_interpolated.size()).to(args.device), create_graph=True, retain_graph=True, allow_unused=True)[0].to(args.device)
-    if(args.gcnn):
-        gradients = torch_grad(outputs=prob_interpolated, inputs=interpolated_X, grad_outputs=torch.ones(prob_interpolated.size()).to(args.device), create_graph=True, retain_graph=True, allow_unused=True)[0].to(args.device)
+    gradients = torch_grad(outputs=prob_interpolated, inputs=inputs, grad_outputs=torch.ones_like(prob_interpolated), create_graph=True, retain_graph=True, allow_unused=True)
 
-    gradients = gradients.contiguous()
-
-    # Gradients have shape (batch_size, num_channels, img_width, img_height),
-    # so flatten to easily take norm per example in batch
-    gradients = gradients.view(batch_size, -1)
+    # flatten to easily take norm per example in batch
+    gradients = torch.cat([(g if g is not None else torch.zeros_like(inp)).reshape(gp_batch_size, -1) for g, inp in zip(gradients, inputs)], dim=1)
 
     # Derivatives of the gradient close to 0 can cause problems because of
     # the square root, so manually calculate norm and add epsilon
     gradients_norm = torch.sqrt(torch.sum(gradients ** 2, dim=1) + 1e-12)
 
     # Return gradient penalty
-    gp = args.gp * ((gradients_norm - 1) ** 2).mean()
-    # print("gradient penalty")
-    # print(gp)
-    return gp
+    return args.gp * ((gradients_norm - 1) ** 2).mean()
+
+
+# interpolates the first batch_size real and generated graphs, reusing the edges of the real graphs
+# instead of rebuilding the neighbourhoods with tg_transform
+def interpolate_graphs(args, real_data, generated_data, alpha, batch_size):
+    num_nodes = batch_size * args.num_hits
+
+    x = alpha * real_data.x[:num_nodes].view(batch_size, args.num_hits, -1) + (1 - alpha) * generated_data.x[:num_nodes].view(batch_size, args.num_hits, -1)
+    pos = alpha * real_data.pos[:num_nodes].view(batch_size, args.num_hits, 2) + (1 - alpha) * generated_data.pos[:num_nodes].view(batch_size, args.num_hits, 2)
+
+    x = x.view(num_nodes, -1).detach().requires_grad_(True)
+    pos = pos.view(num_nodes, 2).detach().requires_grad_(True)
+
+    # graphs are stored contiguously so edges of the first batch_size graphs all start from a node < num_nodes
+    edge_index = real_data.edge_index
+    if num_nodes < real_data.x.size(0): edge_index = edge_index[:, edge_index[0] < num_nodes]
+
+    row, col = edge_index
+    edge_attr = (pos[col] - pos[row]) / (2 * args.cutoff) + 0.5
+
+    return Batch(batch=real_data.batch[:num_nodes], x=x, pos=pos, edge_index=edge_index, edge_attr=edge_attr), [x, pos]
 
 
 def convert_to_batch(args, data, batch_size):
@@ -152,7 +170,7 @@ bce = torch.nn.BCELoss()
 mse = torch.nn.MSELoss()
 
 
-def calc_D_loss(args, D, data, gen_data, real_outputs, fake_outputs, run_batch_size, Y_real, Y_fake):
+def calc_D_loss(args, D, data, gen_data, real_outputs, fake_outputs, run_batch_size, Y_real, Y_fake, step=0):
     if args.debug:
         print("real outputs")
         print(real_outputs[:10])
@@ -188,10 +206,12 @@ def calc_D_loss(args, D, data, gen_data, real_outputs, fake_outputs, run_batch_s
 
     D_loss = D_real_loss + D_fake_loss
 
-    if(args.gp):
-        gp = gradient_penalty(args, D, data, gen_data, run_batch_size)
+    # lazy regularization - the penalty is only applied every gp_every D steps, scaled up to compensate
+    if(args.gp and step % args.gp_every == 0):
+        gp = args.gp_every * gradient_penalty(args, D, data, gen_data, run_batch_size)
         gpitem = gp.item()
         D_loss += gp
+    elif(args.gp): gpitem = 0
     else: gpitem = None
 
     return (D_loss, {'Dr': D_real_loss.item(), 'Df': D_fake_loss.item(), 'gp': gpitem, 'D': D_real_loss.item() + D_fake_loss.item()})
@@ -210,6 +230,88 @@ def calc_G_loss(args, fake_outputs, Y_real):
     return G_loss
 
 
+# runs args.unrolled_steps - 1 functional D updates on a dict of parameter tensors and returns D evaluated with
+# the unrolled weights, so G's loss can backpropagate through the D updates. Like the real D steps, each augments the
+# data with probability p if given, and applies the lazy gradient penalty if it's due - step is the number of D steps so far
+def unrolled_D(args, D, D_optimizer, data, gen_data, Y_real, Y_fake, p=None, step=0):
+    if args.debug: print("unrolling d")
+    D.train()
+    run_batch_size = data.shape[0] if not args.gcnn else data.y.shape[0]
+
+    # forward passes in train mode update D's buffers and the parameters it doesn't train e.g. spectral norm's u and v
+    # in place, so the unrolled D has copies of them and D is left as it was
+    params = {name: param if param.requires_grad else param.clone() for name, param in D.named_parameters()}
+    buffers = {name: buffer.clone() for name, buffer in D.named_buffers()}
+    state = {}
+
+    def D_unrolled(x):
+        return functional_call(D, (params, buffers), (x,))
+
+    for i in range(args.unrolled_steps - 1):
+        step_data, step_gen_data = data, gen_data
+        if p is not None:
+            step_data = augment.augment(args, data, p)
+            step_gen_data = augment.augment(args, gen_data, p)
+
+        D_real_output = D_unrolled(step_data.clone())
+        D_fake_output = D_unrolled(step_gen_data)
+
+        D_loss, D_loss_items = calc_D_loss(args, D_unrolled, step_data, step_gen_data, D_real_output, D_fake_output, run_batch_size, Y_real, Y_fake, step=step + i)
+        params = unrolled_step(D, D_optimizer, params, state, D_loss)
+
+    return D_unrolled
+
+
+# differentiable version of one D optimizer step for unrolled G training
+# params is a dict of D's parameter tensors (as for torch.func.functional_call) and state holds the unrolled
+# optimizer moments, which start from D_optimizer's current state - neither D nor D_optimizer are modified
+def unrolled_step(D, D_optimizer, params, state, loss):
+    D_params = dict(D.named_parameters())
+    names = [name for name in params if D_params[name].requires_grad]
+    grads = torch_grad(loss, [params[name] for name in names], create_graph=True, allow_unused=True)
+
+    group = D_optimizer.param_groups[0]
+    new_params = dict(params)
+
+    for name, grad in zip(names, grads):
+        if grad is None: continue
+
+        p = params[name]
+        opt_state = D_optimizer.state[D_params[name]]
+
+        if isinstance(D_optimizer, torch.optim.Adam):
+            beta1, beta2 = group['betas']
+            if group['weight_decay']: grad = grad + group['weight_decay'] * p
+
+            if name not in state:
+                state[name] = {'step': float(opt_state['step']) if 'step' in opt_state else 0.,
+                               'exp_avg': opt_state['exp_avg'] if 'exp_avg' in opt_state else torch.zeros_like(p),
+                               'exp_avg_sq': opt_state['exp_avg_sq'] if 'exp_avg_sq' in opt_state else torch.zeros_like(p)}
+
+            s = state[name]
+            s['step'] += 1
+            s['exp_avg'] = beta1 * s['exp_avg'] + (1 - beta1) * grad
+            s['exp_avg_sq'] = beta2 * s['exp_avg_sq'] + (1 - beta2) * grad * grad
+
+            exp_avg = s['exp_avg'] / (1 - beta1 ** s['step'])
+            exp_avg_sq = s['exp_avg_sq'] / (1 - beta2 ** s['step'])
+            # eps inside the sqrt as well so its derivative stays finite for zero gradients
+            new_params[name] = p - group['lr'] * exp_avg / (torch.sqrt(exp_avg_sq + group['eps'] ** 2) + group['eps'])
+        elif isinstance(D_optimizer, torch.optim.RMSprop):
+            if group['weight_decay']: grad = grad + group['weight_decay'] * p
+
+            if name not in state:
+                state[name] = {'square_avg': opt_state['square_avg'] if 'square_avg' in opt_state else torch.zeros_like(p)}
+
+            s = state[name]
+            s['square_avg'] = group['alpha'] * s['square_avg'] + (1 - group['alpha']) * grad * grad
+            new_params[name] = p - group['lr'] * grad / (torch.sqrt(s['square_avg'] + group['eps'] ** 2) + group['eps'])
+        else:
+            new_params[name] = p - group['lr'] * grad
+
+    return new_params
+
+
 # from https://github.com/mseitzer/pytorch-fid
 def calculate_frechet_distance(mu1, sigma1, mu2, sigma2, eps=1e-6):
     """Numpy implementation of the Frechet Distance.